@@ -1,32 +1,83 @@
+import functools
+import hashlib
+import json
+import os
+import random
+import time
 from subprocess import check_output
-from time import sleep
 
+from charmhelpers.core import hookenv, unitdata
 
-def retry(times, delay_secs):
-    """Decorator for retrying a method call.
+# Read resources in 1MiB chunks so large archives never sit in memory whole.
+CHUNK_SIZE = 1024 * 1024
+
+# unitdata key recording the etcd endpoints ranked nearest first
+ETCD_RANKING_KEY = "canal.etcd.ranking"
+# where kubernetes charms wrote the CNI kubeconfig before they sent its path
+DEFAULT_KUBECONFIG_PATH = "/root/cdk/kubeconfig"
+
+
+def retry(attempts=5, base_delay=5, max_delay=60, deadline=300, jitter=0.5, defer=True):
+    """Decorator for retrying a method call with exponential backoff.
+
+    The delay starts at base_delay and doubles with each failed attempt, up to
+    max_delay, with a random part of it taken off so units don't retry in
+    lockstep. Attempts and elapsed time are kept in unitdata, so a deferred
+    retry picks up where it left off on a later dispatch.
     Args:
-        times: How many times should we retry before giving up
-        delay_secs: Delay in secs
+        attempts: How many attempts to make before giving up
+        base_delay: Delay in secs before the first retry
+        max_delay: Longest delay in secs between attempts
+        deadline: Give up once this many secs have passed since the first attempt
+        jitter: Fraction of each delay that may be randomly taken off
+        defer: Rather than sleeping, return the failure so the handler runs
+            again on a later dispatch, where calls made before the delay has
+            passed return False without being attempted
     Returns: A callable that would return the last call outcome
     """
 
     def retry_decorator(func):
         """Decorator to wrap the function provided.
         Args:
-            func: Provided function should return either True od False
+            func: Provided function should return either True or False
         Returns: A callable that would return the last call outcome
         """
+        key = "canal.retry.{}.{}".format(func.__module__, func.__name__)
 
+        @functools.wraps(func)
         def _wrapped(*args, **kwargs):
-            res = func(*args, **kwargs)
-            attempt = 0
-            while not res and attempt < times:
-                sleep(delay_secs)
+            kv = unitdata.kv()
+            state = kv.get(key) or {"attempt": 0, "first": time.time(), "next": 0}
+            wait = state["next"] - time.time()
+            if wait > 0:
+                hookenv.log("Deferring {} for {:.0f}s".format(func.__name__, wait))
+                return False
+            while True:
                 res = func(*args, **kwargs)
-                if res:
-                    break
-                attempt += 1
-            return res
+                state["attempt"] += 1
+                elapsed = time.time() - state["first"]
+                if res or state["attempt"] >= attempts or elapsed >= deadline:
+                    hookenv.log(
+                        "{} {} after {} attempt(s) in {:.1f}s".format(
+                            func.__name__,
+                            "succeeded" if res else "gave up",
+                            state["attempt"],
+                            elapsed,
+                        )
+                    )
+                    kv.unset(key)
+                    return res
+                delay = min(max_delay, base_delay * 2 ** (state["attempt"] - 1))
+                delay -= random.uniform(0, jitter * delay)
+                delay = min(delay, deadline - elapsed)
+                if defer:
+                    state["next"] = time.time() + delay
+                    kv.set(key, state)
+                    hookenv.log(
+                        "{} failed, retrying in {:.0f}s".format(func.__name__, delay)
+                    )
+                    return res
+                time.sleep(delay)
 
         return _wrapped
 
@@ -40,3 +91,192 @@ def arch():
     # Convert the binary result into a string.
     architecture = architecture.decode("utf-8")
     return architecture
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """Return the sha256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_revision(data):
+    """Return a revision string identifying some JSON-serializable config."""
+    encoded = json.dumps(data, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def render_if_changed(source, target, context, perms=0o444):
+    """Render a template to a file, writing it only if its content changed.
+
+    Args:
+        source: Template name, relative to the charm's templates directory
+        target: Path to write the rendered template to
+        context: Template context
+        perms: Mode of the written file
+    Returns: True if the file was written, False if it already had the content
+    """
+    from charmhelpers.core.templating import render
+
+    content = render(source, None, context).encode("utf-8")
+    if not write_if_changed(target, content, perms):
+        return False
+    hookenv.log("Rendered {} to {}".format(source, target))
+    return True
+
+
+def write_if_changed(target, content, perms=0o444):
+    """Write bytes to a file, only if they differ from what it already holds.
+
+    The new content replaces the old atomically, so nothing ever reads a half
+    written file.
+    Returns: True if the file was written, False if it already had the content
+    """
+    import tempfile
+
+    try:
+        with open(target, "rb") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".canal-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, perms)
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def add_snap_bin_to_path():
+    snap_bin = os.path.join(os.sep, "snap", "bin")
+    if snap_bin not in os.environ["PATH"].split(os.pathsep):
+        os.environ["PATH"] += os.pathsep + snap_bin
+
+
+def etcd_connection_string(etcd):
+    """Return the etcd connection string with the nearest endpoints first.
+
+    Falls back to the relation's own order until the current endpoints have
+    been ranked.
+    """
+    connection_string = etcd.get_connection_string()
+    ranking = unitdata.kv().get(ETCD_RANKING_KEY)
+    if ranking and ranking["endpoints"] == connection_string:
+        return ",".join(ranking["order"])
+    return connection_string
+
+
+def cni_kubeconfig_path(cni):
+    """Return the kubeconfig kubernetes gave canal over the cni relation."""
+    return cni.get_config().get("kubeconfig_path", DEFAULT_KUBECONFIG_PATH)
+
+
+class ResourceError(Exception):
+    pass
+
+
+def fetch_binaries(resource_name, label, binaries, cached=None):
+    """Fetch a resource tarball and install the binaries in it.
+
+    Like unpack_binaries, it leaves recording the digests to the caller, so it
+    is safe to run in a worker thread.
+    Args:
+        resource_name: Name of the charm resource
+        label: What to call the resource in the status
+        binaries: Dict of archive member name to install path
+        cached: Digests recorded when the binaries were last installed
+    Returns: Digests to record, or None if the binaries are up to date
+    Raises: ResourceError, with a message for the status, if the resource
+        can't be fetched or is incomplete; the underlying error is its cause
+    """
+    try:
+        archive = hookenv.resource_get(resource_name)
+    except Exception as e:
+        raise ResourceError("Error fetching the {} resource.".format(label)) from e
+    if not archive:
+        raise ResourceError("Missing {} resource.".format(label))
+    try:
+        return unpack_binaries(archive, binaries, cached)
+    except ResourceError as e:
+        raise ResourceError("Incomplete {} resource".format(label)) from e
+
+
+def unpack_binaries(archive, binaries, cached=None):
+    """Install binaries from a gzip'd resource tarball, unless already installed.
+
+    The caller records the digests this returns, in unitdata say, and passes
+    them back as cached; when the resource is unchanged and the installed
+    binaries still match them, nothing is unpacked. Nothing here touches
+    unitdata, so it is safe to run in a worker thread.
+    Args:
+        archive: Path to the resource tarball
+        binaries: Dict of archive member name to install path
+        cached: Digests recorded when the binaries were last installed
+    Returns: Digests to record for the installed binaries, or None if cached
+        shows they are up to date
+    Raises: ResourceError if the archive is unreadable or missing a binary
+    """
+    import tarfile
+
+    resource_digest = file_digest(archive)
+    cached = cached or {}
+    installed = cached.get("binaries", {})
+    if cached.get("resource") == resource_digest and all(
+        os.path.isfile(path) and file_digest(path) == installed.get(path)
+        for path in binaries.values()
+    ):
+        return None
+
+    wanted = {os.path.normpath(name): path for name, path in binaries.items()}
+    staged = {}
+    try:
+        try:
+            with tarfile.open(archive, "r|gz") as tar:
+                for member in tar:
+                    path = wanted.get(os.path.normpath(member.name))
+                    if path and member.isfile():
+                        staged[path] = _stage_binary(tar.extractfile(member), path)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            raise ResourceError("Unable to read {}: {}".format(archive, e)) from e
+        missing = [name for name, path in wanted.items() if path not in staged]
+        if missing:
+            raise ResourceError(
+                "{} is missing {}".format(archive, ", ".join(sorted(missing)))
+            )
+        for path, (tmp, _) in staged.items():
+            os.replace(tmp, path)
+    finally:
+        for tmp, _ in staged.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    digests = {path: digest for path, (_, digest) in staged.items()}
+    return {"resource": resource_digest, "binaries": digests}
+
+
+def _stage_binary(f_in, path):
+    """Copy an archive member next to its install path, hashing as we go.
+    Returns: Tuple of the staged file path and its sha256 hex digest
+    """
+    import tempfile
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".canal-")
+    with os.fdopen(fd, "wb") as f_out:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f_out.write(chunk)
+    os.chmod(tmp, 0o755)
+    return tmp, digest.hexdigest()
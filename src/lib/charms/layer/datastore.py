@@ -0,0 +1,72 @@
+ETCD = "etcd"
+KUBERNETES = "kubernetes"
+DATASTORES = (ETCD, KUBERNETES)
+
+# calico resources the Kubernetes API datastore keeps as custom resources;
+# only the last two are namespaced
+CRD_KINDS = (
+    "BGPConfiguration",
+    "BGPPeer",
+    "BlockAffinity",
+    "ClusterInformation",
+    "FelixConfiguration",
+    "GlobalNetworkPolicy",
+    "GlobalNetworkSet",
+    "HostEndpoint",
+    "IPAMBlock",
+    "IPAMConfig",
+    "IPAMHandle",
+    "IPPool",
+    "KubeControllersConfiguration",
+    "NetworkPolicy",
+    "NetworkSet",
+)
+NAMESPACED_KINDS = ("NetworkPolicy", "NetworkSet")
+CRD_GROUP = "crd.projectcalico.org"
+
+# Typha sizing, as calico recommends: a replica per 200 nodes, with three for
+# redundancy once there are three nodes to spread them over, and at most 20.
+NODES_PER_TYPHA = 200
+MIN_TYPHA_REPLICAS = 3
+MAX_TYPHA_REPLICAS = 20
+
+
+def _plural(kind):
+    kind = kind.lower()
+    return kind[:-1] + "ies" if kind.endswith("y") else kind + "s"
+
+
+def crds():
+    """Return the custom resource definitions of the calico resources.
+
+    Returns: List of dicts with the kind, plural and scope of each resource
+    """
+    return [
+        {
+            "kind": kind,
+            "plural": _plural(kind),
+            "scope": "Namespaced" if kind in NAMESPACED_KINDS else "Cluster",
+        }
+        for kind in CRD_KINDS
+    ]
+
+
+def typha_replicas(nodes):
+    """Return how many Typha replicas to run for a number of calico nodes."""
+    replicas = max(-(-nodes // NODES_PER_TYPHA), min(nodes, MIN_TYPHA_REPLICAS))
+    return min(replicas, MAX_TYPHA_REPLICAS)
+
+
+def ippool_resource(pool):
+    """Return the custom resource the Kubernetes API datastore keeps a pool as.
+
+    Args:
+        pool: projectcalico.org/v3 IPPool resource dict
+    Returns: crd.projectcalico.org/v1 IPPool resource dict with the same spec
+    """
+    return {
+        "apiVersion": CRD_GROUP + "/v1",
+        "kind": "IPPool",
+        "metadata": {"name": pool["metadata"]["name"]},
+        "spec": dict(pool["spec"]),
+    }
@@ -0,0 +1,286 @@
+import json
+import time
+from base64 import b64decode, b64encode
+from collections import namedtuple
+from itertools import combinations
+from urllib.parse import urlsplit
+
+KeyValue = namedtuple("KeyValue", ["key", "value", "mod_revision"])
+
+# clients by connection details, so each hook reuses one connection
+_clients = {}
+
+# an endpoint only moves ahead of one ranked before it if it is this much
+# faster, so the ranking doesn't flap with every probe
+RANK_TOLERANCE = 0.25
+RANK_SLACK = 0.005
+# an endpoint only drops out of the ranking, or comes back in, once this many
+# probes in a row agree its health changed, so one slow answer doesn't
+# reconfigure the services
+HEALTH_CHANGE_PROBES = 3
+
+
+class EtcdError(Exception):
+    pass
+
+
+def client(endpoints, cert=None, key=None, ca=None):
+    """Return the shared client for these connection details."""
+    details = (endpoints, cert, key, ca)
+    if details not in _clients:
+        _clients[details] = Client(endpoints, cert, key, ca)
+    return _clients[details]
+
+
+def _encode(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return b64encode(data).decode("ascii")
+
+
+def _decode(data):
+    return b64decode(data).decode("utf-8")
+
+
+def _prefix_end(prefix):
+    """Return the range end covering every key starting with prefix."""
+    end = bytearray(prefix.encode("utf-8"))
+    while end:
+        if end[-1] < 0xFF:
+            end[-1] += 1
+            return bytes(end)
+        end.pop()
+    return b"\0"
+
+
+def put_op(key, value):
+    """Return a transaction operation writing value to key."""
+    return {"request_put": {"key": _encode(key), "value": _encode(value)}}
+
+
+def delete_op(key):
+    """Return a transaction operation deleting key."""
+    return {"request_delete_range": {"key": _encode(key)}}
+
+
+def mod_revision_is(key, revision):
+    """Return a transaction comparison that key was last modified at revision.
+
+    A revision of 0 compares that the key does not exist.
+    """
+    return {
+        "key": _encode(key),
+        "target": "MOD",
+        "result": "EQUAL",
+        "mod_revision": str(revision),
+    }
+
+
+def connect(endpoint, cert=None, key=None, ca=None, timeout=10):
+    """Return an unopened HTTP(S) connection to an etcd endpoint URL."""
+    # imported here as they are slow to load, and most hooks never talk to etcd
+    import ssl
+    from http.client import HTTPConnection, HTTPSConnection
+
+    url = urlsplit(endpoint)
+    if url.scheme == "https":
+        context = ssl.create_default_context(cafile=ca)
+        if cert:
+            context.load_cert_chain(cert, key)
+        return HTTPSConnection(url.hostname, url.port, timeout=timeout, context=context)
+    return HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+
+def split_endpoints(endpoints):
+    """Return the endpoint URLs in a comma separated connection string."""
+    return [e.strip() for e in endpoints.split(",") if e.strip()]
+
+
+def _probe(endpoint, cert, key, ca, timeout):
+    from http.client import HTTPException
+
+    start = time.monotonic()
+    conn = connect(endpoint, cert, key, ca, timeout)
+    try:
+        conn.request("GET", "/health")
+        response = conn.getresponse()
+        healthy = json.loads(response.read() or "{}").get("health") == "true"
+    except (OSError, HTTPException, ValueError):
+        return None
+    finally:
+        conn.close()
+    if response.status != 200 or not healthy:
+        return None
+    return time.monotonic() - start
+
+
+def endpoint_latencies(endpoints, cert=None, key=None, ca=None, timeout=2):
+    """Measure how long each endpoint takes to answer a health check.
+
+    The endpoints are probed concurrently. Each measurement covers the TCP
+    connect, the TLS handshake and the /health round trip.
+    Returns: Dict of endpoint URL to seconds, or None if it was unhealthy
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(endpoints) or 1) as pool:
+        results = pool.map(
+            lambda endpoint: _probe(endpoint, cert, key, ca, timeout), endpoints
+        )
+        return dict(zip(endpoints, results))
+
+
+def confirm_health(latencies, current, streaks):
+    """Hold back health changes until HEALTH_CHANGE_PROBES probes agree.
+
+    Args:
+        latencies: Dict of endpoint URL to seconds, or None if unhealthy
+        current: The previous ranking, or None if there isn't one
+        streaks: Dict of endpoint URL to how many probes in a row before this
+            one disagreed with whether it is in current
+    Returns: Tuple of the latencies to rank and the new streaks. Until a change
+        is confirmed, an endpoint in current that failed ranks last, and one
+        left out of it that answered stays out.
+    """
+    if not current:
+        return dict(latencies), {}
+    confirmed = {}
+    new_streaks = {}
+    for endpoint, seconds in latencies.items():
+        ranked = endpoint in current
+        confirmed[endpoint] = seconds
+        if ranked == (seconds is not None):
+            continue
+        streak = streaks.get(endpoint, 0) + 1
+        if streak < HEALTH_CHANGE_PROBES:
+            new_streaks[endpoint] = streak
+            confirmed[endpoint] = float("inf") if ranked else None
+    return confirmed, new_streaks
+
+
+def rank_endpoints(latencies, current=None):
+    """Return the healthy endpoints, nearest first.
+
+    Args:
+        latencies: Dict of endpoint URL to seconds, or None if unhealthy
+        current: The previous ranking, kept unless an endpoint in it has become
+            unhealthy or recovered, or one ranked behind another is now faster
+            by more than RANK_TOLERANCE and RANK_SLACK
+    Returns: List of endpoint URLs; every endpoint if none are healthy
+    """
+    healthy = {e: s for e, s in latencies.items() if s is not None}
+    if not healthy:
+        return current or list(latencies)
+    if current and set(current) == set(healthy):
+        overtaken = any(
+            healthy[behind] < healthy[ahead] * (1 - RANK_TOLERANCE) - RANK_SLACK
+            for ahead, behind in combinations(current, 2)
+        )
+        if not overtaken:
+            return list(current)
+    return sorted(healthy, key=healthy.get)
+
+
+class Client:
+    """A small etcd v3 client speaking the JSON gRPC gateway.
+
+    The client keeps one keep-alive connection open to the first healthy
+    endpoint, so a hook pays for one TLS handshake no matter how many reads
+    and writes it makes.
+    """
+
+    def __init__(self, endpoints, cert=None, key=None, ca=None, timeout=10):
+        """
+        Args:
+            endpoints: Comma separated endpoint URLs, tried in order
+            cert: Client certificate path
+            key: Client key path
+            ca: CA certificate path
+            timeout: Socket timeout in seconds
+        """
+        self.endpoints = split_endpoints(endpoints)
+        self.timeout = timeout
+        self.cert = cert
+        self.key = key
+        self.ca = ca
+        self._conn = None
+
+    def _connect(self, endpoint):
+        return connect(endpoint, self.cert, self.key, self.ca, self.timeout)
+
+    def _request(self, path, body):
+        from http.client import HTTPException
+
+        payload = json.dumps(body)
+        headers = {"Content-Type": "application/json"}
+        errors = []
+        # stick with the open connection; only walk the endpoints if it fails
+        candidates = [None] if self._conn else []
+        candidates += self.endpoints
+        for endpoint in candidates:
+            if endpoint is not None:
+                self._conn = self._connect(endpoint)
+            try:
+                self._conn.request("POST", "/v3" + path, payload, headers)
+                response = self._conn.getresponse()
+                data = response.read()
+            except (OSError, HTTPException) as e:
+                errors.append("{}: {}".format(endpoint or "connection", e))
+                self.close()
+                continue
+            result = json.loads(data or "{}")
+            if response.status != 200:
+                raise EtcdError(
+                    "{} failed: {}".format(path, result.get("error", response.reason))
+                )
+            return result
+        raise EtcdError("No etcd endpoint available: {}".format("; ".join(errors)))
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def get(self, key):
+        """Return the value of key, or None if it does not exist."""
+        result = self._request("/kv/range", {"key": _encode(key)})
+        kvs = result.get("kvs", [])
+        return _decode(kvs[0].get("value", "")) if kvs else None
+
+    def get_prefix(self, prefix):
+        """Return a list of KeyValues for every key starting with prefix."""
+        result = self._request(
+            "/kv/range",
+            {"key": _encode(prefix), "range_end": _encode(_prefix_end(prefix))},
+        )
+        return [
+            KeyValue(
+                _decode(kv["key"]),
+                _decode(kv.get("value", "")),
+                int(kv.get("mod_revision", 0)),
+            )
+            for kv in result.get("kvs", [])
+        ]
+
+    def put(self, key, value):
+        self._request("/kv/put", {"key": _encode(key), "value": _encode(value)})
+
+    def delete(self, key):
+        self._request("/kv/deleterange", {"key": _encode(key)})
+
+    def txn(self, compare, success, failure=()):
+        """Run a transaction.
+
+        Args:
+            compare: List of comparisons, as from mod_revision_is()
+            success: Operations to run if every comparison holds
+            failure: Operations to run otherwise
+        Returns: True if the comparisons held and success ops were applied
+        """
+        body = {
+            "compare": list(compare),
+            "success": list(success),
+            "failure": list(failure),
+        }
+        result = self._request("/kv/txn", body)
+        return bool(result.get("succeeded", False))
@@ -0,0 +1,97 @@
+import re
+
+LOG_SEVERITIES = ("Debug", "Info", "Warning", "Error", "Fatal")
+
+# Felix settings known to matter for performance, and the values each takes.
+# Intervals are in seconds unless the name says otherwise.
+KNOWN_OPTIONS = {
+    "IptablesRefreshInterval": int,
+    "IptablesPostWriteCheckIntervalSecs": int,
+    "IptablesLockTimeoutSecs": int,
+    "IptablesLockProbeIntervalMillis": int,
+    "IpsetsRefreshInterval": int,
+    "RouteRefreshInterval": int,
+    "InterfaceRefreshInterval": int,
+    "ReportingIntervalSecs": int,
+    "MaxIpsetSize": int,
+    "ChainInsertMode": ("insert", "append"),
+    "LogSeverityFile": LOG_SEVERITIES,
+    "LogSeverityScreen": LOG_SEVERITIES,
+    "LogSeveritySys": LOG_SEVERITIES,
+    "LogFilePath": str,
+}
+
+# settings the charm manages itself, through other options or not at all
+RESERVED_OPTIONS = {
+    "DefaultEndpointToHostAction",
+    "HealthEnabled",
+    "IgnoreLooseRPF",
+    "PrometheusMetricsEnabled",
+    "PrometheusMetricsPort",
+    "TyphaK8sNamespace",
+    "TyphaK8sServiceName",
+}
+
+_NAME = re.compile(r"^[A-Z][A-Za-z0-9]*$")
+# values are written unquoted into calico-node.service, where systemd would
+# split on whitespace and expand % specifiers and $ variables
+_UNSAFE = re.compile(r"[\s%$\x00-\x1f\x7f]")
+
+
+class InvalidOption(Exception):
+    pass
+
+
+def _check(name, value, kind):
+    if kind is int:
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            raise InvalidOption("{} must be a non-negative integer".format(name))
+    elif kind is str:
+        if not isinstance(value, str):
+            raise InvalidOption("{} must be a string".format(name))
+    elif value not in kind:
+        raise InvalidOption("{} must be one of {}".format(name, ", ".join(kind)))
+
+
+def _format(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def felix_env(options):
+    """Return the calico-node environment for the felix-options config.
+
+    Args:
+        options: YAML mapping of Felix setting names to values
+    Returns: Dict of FELIX_* environment variable names to string values
+    Raises: InvalidOption if the options aren't a mapping, a known setting has
+        a value of the wrong type, a setting is reserved or malformed, or a
+        value has characters that can't go in the service file as they are
+    """
+    import yaml
+
+    try:
+        settings = yaml.safe_load(options or "") or {}
+    except yaml.YAMLError as e:
+        raise InvalidOption("not valid YAML: {}".format(e))
+    if not isinstance(settings, dict):
+        raise InvalidOption("must be a mapping of Felix settings to values")
+
+    env = {}
+    for name, value in settings.items():
+        if not isinstance(name, str) or not _NAME.match(name):
+            raise InvalidOption("{} is not a Felix setting name".format(name))
+        if name in RESERVED_OPTIONS:
+            raise InvalidOption("{} is managed by the charm".format(name))
+        if name in KNOWN_OPTIONS:
+            _check(name, value, KNOWN_OPTIONS[name])
+        elif isinstance(value, (dict, list)) or value is None:
+            raise InvalidOption("{} must be a single value".format(name))
+        value = _format(value)
+        if _UNSAFE.search(value):
+            raise InvalidOption(
+                "{} can't contain whitespace, control characters, % or $".format(name)
+            )
+        env["FELIX_" + name.upper()] = value
+    return dict(sorted(env.items()))
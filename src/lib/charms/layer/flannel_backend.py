@@ -0,0 +1,117 @@
+import os
+import re
+
+# options each flannel backend accepts, and the type of each
+BACKENDS = {
+    "vxlan": {"VNI": int, "Port": int, "GBP": bool, "DirectRouting": bool},
+    "host-gw": {},
+    "wireguard": {"PSK": str, "ListenPort": int, "PersistentKeepaliveInterval": int},
+}
+
+# the flannel release that introduced a backend or backend option
+MIN_VERSIONS = {
+    "DirectRouting": (0, 10, 0),
+    "wireguard": (0, 14, 0),
+}
+
+# bytes of each packet taken by a backend's encapsulation
+OVERHEAD = {"vxlan": 50, "host-gw": 0, "wireguard": 80}
+
+# kv key recording the interface of the backend flannel was last started with
+INTERFACE_KEY = "canal.flannel.interface"
+# kv key recording the host interface flannel was configured to bind to
+IFACE_KEY = "canal.flannel.iface"
+
+
+class InvalidBackend(Exception):
+    pass
+
+
+def parse_version(output):
+    """Return the flannel version from `flanneld -version` output as a tuple.
+
+    Returns None if no version can be found.
+    """
+    match = re.search(r"v?(\d+)\.(\d+)\.(\d+)", output)
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def _format_version(version):
+    return "v" + ".".join(str(part) for part in version)
+
+
+def _convert(name, value, kind):
+    if kind is bool:
+        if value.lower() not in ("true", "false"):
+            raise InvalidBackend("{} must be true or false".format(name))
+        return value.lower() == "true"
+    try:
+        return kind(value)
+    except ValueError:
+        raise InvalidBackend("{} must be an integer".format(name))
+
+
+def backend_config(backend_type, options="", version=None):
+    """Return the flannel Backend config for a backend type and its options.
+
+    Args:
+        backend_type: One of BACKENDS
+        options: Space separated key=value backend options
+        version: Flannel version tuple to validate against, or None to skip
+    Returns: Dict for the Backend key of flannel's network config
+    Raises: InvalidBackend if the backend or an option is unknown, malformed or
+        too new for the flannel version
+    """
+    if backend_type not in BACKENDS:
+        raise InvalidBackend(
+            "unknown backend {}; use one of {}".format(
+                backend_type, ", ".join(sorted(BACKENDS))
+            )
+        )
+    known = BACKENDS[backend_type]
+    backend = {"Type": backend_type}
+    for option in (options or "").split():
+        name, sep, value = option.partition("=")
+        if not sep or name not in known:
+            raise InvalidBackend(
+                "unknown {} option {}".format(backend_type, option.split("=")[0])
+            )
+        backend[name] = _convert(name, value, known[name])
+
+    if version:
+        for feature in [backend_type] + sorted(backend):
+            minimum = MIN_VERSIONS.get(feature)
+            if minimum and version < minimum:
+                raise InvalidBackend(
+                    "{} needs flannel {}, but the resource is {}".format(
+                        feature, _format_version(minimum), _format_version(version)
+                    )
+                )
+    return backend
+
+
+def link_mtu(iface):
+    """Return the MTU of a host network interface, or None if unreadable."""
+    try:
+        with open(os.path.join("/sys/class/net", iface, "mtu")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def pod_mtu(link_mtu, backend_type):
+    """Return the MTU left for pods once a backend has encapsulated a packet."""
+    return link_mtu - OVERHEAD.get(backend_type, 0)
+
+
+def interface(backend):
+    """Return the network interface flannel creates for a Backend config.
+
+    Returns None for backends, like host-gw, that route over the host's own
+    interfaces.
+    """
+    if backend["Type"] == "vxlan":
+        return "flannel.{}".format(backend.get("VNI", 1))
+    if backend["Type"] == "wireguard":
+        return "flannel-wg"
+    return None
@@ -0,0 +1,66 @@
+import os
+from collections import namedtuple
+from ipaddress import ip_interface, ip_network
+
+SUBNET_ENV = "/run/flannel/subnet.env"
+
+# network and subnet are ipaddress objects; mtu is None if flannel omitted it
+FlannelLease = namedtuple("FlannelLease", ["network", "subnet", "mtu", "ipmasq"])
+
+# parsed leases by path, along with the stat fingerprint they were read at
+_cache = {}
+
+
+class FlannelSubnetNotFound(Exception):
+    pass
+
+
+def parse_lease(text):
+    """Parse the contents of a flannel subnet.env file.
+
+    Blank lines, comments and lines without an '=' are skipped. Values are
+    everything after the first '=', so they may contain '=' themselves.
+    Raises: FlannelSubnetNotFound if there is no valid FLANNEL_SUBNET
+    """
+    values = {}
+    for line in text.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep and not key.startswith("#"):
+            values[key.strip()] = value.strip()
+
+    try:
+        subnet = ip_interface(values["FLANNEL_SUBNET"])
+    except (KeyError, ValueError) as e:
+        raise FlannelSubnetNotFound("No valid FLANNEL_SUBNET") from e
+    try:
+        network = ip_network(values["FLANNEL_NETWORK"], strict=False)
+    except (KeyError, ValueError):
+        network = None
+    try:
+        mtu = int(values["FLANNEL_MTU"])
+    except (KeyError, ValueError):
+        mtu = None
+    ipmasq = values.get("FLANNEL_IPMASQ", "").lower() == "true"
+    return FlannelLease(network, subnet, mtu, ipmasq)
+
+
+def read_lease(path=None):
+    """Return the FlannelLease for this unit.
+
+    The parsed lease is cached against the file's inode, mtime and size, so
+    reading it repeatedly in one dispatch costs a stat.
+    Raises: FlannelSubnetNotFound if flannel has not written a valid lease
+    """
+    path = path or SUBNET_ENV
+    try:
+        st = os.stat(path)
+        fingerprint = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if path in _cache and _cache[path][0] == fingerprint:
+            return _cache[path][1]
+        with open(path) as f:
+            text = f.read()
+    except FileNotFoundError as e:
+        raise FlannelSubnetNotFound() from e
+    lease = parse_lease(text)
+    _cache[path] = (fingerprint, lease)
+    return lease
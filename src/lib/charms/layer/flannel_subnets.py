@@ -0,0 +1,84 @@
+from collections import namedtuple
+from ipaddress import IPv4Address, IPv4Network, ip_address, ip_network
+
+# how many nodes flannel can lease a subnet to, and the pod addresses in each
+Capacity = namedtuple("Capacity", ["nodes", "pods_per_node"])
+
+# addresses of a node's subnet the host-local IPAM keeps back: the network
+# address, the gateway and the broadcast address
+RESERVED_ADDRESSES = 3
+
+
+class InvalidSubnets(Exception):
+    pass
+
+
+def _network(cidr):
+    try:
+        network = ip_network(cidr)
+    except ValueError:
+        raise InvalidSubnets("cidr {} is not a network".format(cidr))
+    if not isinstance(network, IPv4Network):
+        raise InvalidSubnets("flannel needs an IPv4 cidr")
+    return network
+
+
+def _address(name, value, network, size):
+    try:
+        address = ip_address(value)
+    except ValueError:
+        raise InvalidSubnets("{} {} is not an address".format(name, value))
+    if not isinstance(address, IPv4Address) or address not in network:
+        raise InvalidSubnets("{} {} is outside cidr {}".format(name, value, network))
+    if (int(address) - int(network.network_address)) % size:
+        raise InvalidSubnets("{} {} isn't on a subnet boundary".format(name, value))
+    return address
+
+
+def subnet_config(cidr, subnet_len=0, subnet_min="", subnet_max=""):
+    """Return the flannel network config settings sizing the node subnets.
+
+    Settings left unset aren't returned, so flannel applies its own defaults,
+    which capacity works out the same way.
+    Args:
+        cidr: The flannel network
+        subnet_len: Prefix length of each node's subnet, or 0 for the default
+        subnet_min: First subnet flannel may lease, or "" for the default
+        subnet_max: Last subnet flannel may lease, or "" for the default
+    Returns: Dict of SubnetLen, SubnetMin and SubnetMax settings
+    Raises: InvalidSubnets if the settings can't work with cidr
+    """
+    capacity(cidr, subnet_len, subnet_min, subnet_max)
+    settings = {"SubnetLen": subnet_len, "SubnetMin": subnet_min}
+    settings["SubnetMax"] = subnet_max
+    return {name: value for name, value in settings.items() if value}
+
+
+def capacity(cidr, subnet_len=0, subnet_min="", subnet_max=""):
+    """Return the Capacity of a flannel network sized like subnet_config.
+
+    Raises: InvalidSubnets if the settings can't work with cidr
+    """
+    network = _network(cidr)
+    if not subnet_len:
+        # flannel's default: a /24 each, or half the network if it's smaller
+        subnet_len = 24 if network.prefixlen < 24 else network.prefixlen + 1
+    if not network.prefixlen < subnet_len <= 30:
+        raise InvalidSubnets(
+            "subnet length must be between /{} and /30 for cidr {}".format(
+                network.prefixlen + 1, network
+            )
+        )
+    size = 2 ** (32 - subnet_len)
+
+    # flannel skips the first subnet by default
+    first = network.network_address + size
+    last = network.broadcast_address + 1 - size
+    if subnet_min:
+        first = _address("subnet minimum", subnet_min, network, size)
+    if subnet_max:
+        last = _address("subnet maximum", subnet_max, network, size)
+    if first > last:
+        raise InvalidSubnets("subnet minimum is above the subnet maximum")
+    nodes = (int(last) - int(first)) // size + 1
+    return Capacity(nodes, size - RESERVED_ADDRESSES)
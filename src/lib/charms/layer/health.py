@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# This module is also installed as the check_canal_health NRPE plugin, so it
+# must only use the standard library.
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+try:
+    from charms.layer.timing import run
+except ImportError:
+    # running as the NRPE plugin, outside the charm
+    run = subprocess.run
+
+MONITORED_SERVICES = ["flannel", "calico-node"]
+FELIX_READINESS_URL = "http://localhost:9099/readiness"
+FLANNEL_INTERFACE = "flannel.1"
+FLANNEL_SUBNET_ENV = "/run/flannel/subnet.env"
+# how long a probe result is reused, in seconds
+CACHE_TTL = 10
+
+Health = namedtuple("Health", ["failing_services", "felix_ready", "flannel_ready"])
+
+_cache = {}
+
+
+def service_states(services):
+    """Return a dict of service name to systemd ActiveState, in one call."""
+    result = run(
+        ["systemctl", "is-active"] + list(services),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    states = result.stdout.split()
+    states += ["unknown"] * (len(services) - len(states))
+    return dict(zip(services, states))
+
+
+def felix_ready(url=FELIX_READINESS_URL, timeout=2):
+    """Return True if Felix reports itself ready."""
+    from urllib.error import URLError
+    from urllib.request import urlopen
+
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            return response.status == 200
+    except (URLError, OSError):
+        return False
+
+
+def flannel_ready(interface=FLANNEL_INTERFACE):
+    """Return True if flannel has created its interface.
+
+    Backends without an interface of their own, like host-gw, are ready once
+    flannel has written its lease.
+    """
+    if not interface:
+        return os.path.exists(FLANNEL_SUBNET_ENV)
+    return os.path.exists(os.path.join("/sys/class/net", interface))
+
+
+def probe(services=MONITORED_SERVICES, ttl=CACHE_TTL, interface=FLANNEL_INTERFACE):
+    """Return the Health of the canal dataplane on this unit.
+
+    Results are reused for ttl seconds, so callers in the same dispatch share
+    one probe.
+    """
+    key = (tuple(services), interface)
+    now = time.monotonic()
+    if key in _cache and now - _cache[key][0] < ttl:
+        return _cache[key][1]
+    states = service_states(services)
+    health = Health(
+        failing_services=[s for s in services if states[s] != "active"],
+        felix_ready=felix_ready(),
+        flannel_ready=flannel_ready(interface),
+    )
+    _cache[key] = (now, health)
+    return health
+
+
+def problems(health, interface=FLANNEL_INTERFACE):
+    """Return a list of human readable problems with a Health."""
+    found = []
+    if health.failing_services:
+        found.append("not running: {}".format(", ".join(health.failing_services)))
+    if not health.felix_ready:
+        found.append("Felix not ready")
+    if not health.flannel_ready:
+        found.append("{} missing".format(interface or "flannel lease"))
+    return found
+
+
+def main(args=()):
+    """Run as an NRPE check.
+
+    Args:
+        args: Command line arguments; an optional flannel interface name, or
+            "none" for backends without one
+    """
+    interface = args[0] if args else FLANNEL_INTERFACE
+    if interface == "none":
+        interface = None
+    found = problems(probe(interface=interface), interface)
+    if found:
+        print("CRITICAL: {}".format("; ".join(found)))
+        return 2
+    print("OK: canal dataplane healthy")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
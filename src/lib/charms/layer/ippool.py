@@ -0,0 +1,81 @@
+import json
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from charms.layer.etcdv3 import EtcdError, delete_op, mod_revision_is, put_op
+
+# where calico's etcdv3 datastore keeps IPPool resources
+IPPOOL_PREFIX = "/calico/resources/v3/projectcalico.org/ippools/"
+
+Plan = namedtuple("Plan", ["creates", "updates", "deletes"])
+
+
+def _differs(desired, live):
+    """Return True if any field we manage differs from the live spec.
+
+    Fields calico defaults but we leave unset are not compared, so defaults
+    filled in by calicoctl or newer calico releases don't cause churn.
+    """
+    return any(live.get(field) != value for field, value in desired.items())
+
+
+def plan(desired, live):
+    """Work out the changes needed to turn the live pools into the desired set.
+
+    Args:
+        desired: Dict of pool name to IPPool resource dict
+        live: Dict of pool name to the IPPool resource dict in the datastore
+    Returns: Plan of pool names to create, update and delete
+    """
+    creates = sorted(name for name in desired if name not in live)
+    updates = sorted(
+        name
+        for name in desired
+        if name in live and _differs(desired[name]["spec"], live[name]["spec"])
+    )
+    deletes = sorted(name for name in live if name not in desired)
+    return Plan(creates, updates, deletes)
+
+
+def reconcile(client, desired):
+    """Make the IPPools in the datastore match the desired set.
+
+    Only the minimal set of creates, updates and deletes are issued, in a
+    single transaction that applies only if no pool changed since we read it.
+    Nothing is written when the pools already match.
+    Args:
+        client: etcdv3.Client for the calico datastore
+        desired: List of IPPool resource dicts
+    Returns: The Plan that was applied
+    Raises: EtcdError if the pools changed underneath us
+    """
+    from uuid import uuid4
+
+    desired = {pool["metadata"]["name"]: pool for pool in desired}
+    start = len(IPPOOL_PREFIX)
+    kvs = {kv.key[start:]: kv for kv in client.get_prefix(IPPOOL_PREFIX)}
+    live = {name: json.loads(kv.value) for name, kv in kvs.items()}
+    changes = plan(desired, live)
+
+    compare = []
+    ops = []
+    for name in changes.creates:
+        pool = json.loads(json.dumps(desired[name]))
+        pool["metadata"]["uid"] = str(uuid4())
+        pool["metadata"]["creationTimestamp"] = datetime.now(timezone.utc).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+        compare.append(mod_revision_is(IPPOOL_PREFIX + name, 0))
+        ops.append(put_op(IPPOOL_PREFIX + name, json.dumps(pool)))
+    for name in changes.updates:
+        pool = live[name]
+        pool["spec"].update(desired[name]["spec"])
+        compare.append(mod_revision_is(IPPOOL_PREFIX + name, kvs[name].mod_revision))
+        ops.append(put_op(IPPOOL_PREFIX + name, json.dumps(pool)))
+    for name in changes.deletes:
+        compare.append(mod_revision_is(IPPOOL_PREFIX + name, kvs[name].mod_revision))
+        ops.append(delete_op(IPPOOL_PREFIX + name))
+
+    if ops and not client.txn(compare, ops):
+        raise EtcdError("IPPools changed during reconciliation")
+    return changes
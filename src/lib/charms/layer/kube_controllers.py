@@ -0,0 +1,102 @@
+import re
+
+from charms.layer import datastore
+
+# controllers calico-kube-controllers can run against an etcd datastore
+CONTROLLERS = ("policy", "namespace", "serviceaccount", "workloadendpoint", "node")
+# and those it runs against the Kubernetes API datastore, where Kubernetes
+# itself keeps the rest up to date
+KUBERNETES_CONTROLLERS = ("node",)
+
+# resource config options, by the key of the container resources they set
+RESOURCES = {
+    ("requests", "cpu"): "kube-controllers-cpu-request",
+    ("requests", "memory"): "kube-controllers-memory-request",
+    ("limits", "cpu"): "kube-controllers-cpu-limit",
+    ("limits", "memory"): "kube-controllers-memory-limit",
+}
+
+_QUANTITY = re.compile(r"^[0-9]+(\.[0-9]+)?([mkMGTPE]|[KMGTPE]i)?$")
+_DURATION = re.compile(r"^([0-9]+(\.[0-9]+)?(ns|us|ms|s|m|h))+$")
+_LABEL_NAME = r"[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?"
+_LABEL_KEY = re.compile(r"^([a-z0-9]([-a-z0-9.]*[a-z0-9])?/)?" + _LABEL_NAME + "$")
+_LABEL_VALUE = re.compile(r"^(" + _LABEL_NAME + ")?$")
+_DNS_SUBDOMAIN = re.compile(r"^[a-z0-9]([-a-z0-9.]{0,251}[a-z0-9])?$")
+
+
+class InvalidConfig(Exception):
+    pass
+
+
+def _controllers(value, calico_datastore):
+    controllers = [c.strip() for c in (value or "").split(",") if c.strip()]
+    if not controllers:
+        raise InvalidConfig("kube-controllers-enabled needs at least one controller")
+    for controller in controllers:
+        if controller not in CONTROLLERS:
+            raise InvalidConfig(
+                "unknown controller {}; use some of {}".format(
+                    controller, ", ".join(CONTROLLERS)
+                )
+            )
+    if calico_datastore == datastore.KUBERNETES:
+        controllers = [c for c in controllers if c in KUBERNETES_CONTROLLERS]
+        if not controllers:
+            raise InvalidConfig(
+                "the kubernetes datastore only runs the {} controller".format(
+                    ", ".join(KUBERNETES_CONTROLLERS)
+                )
+            )
+    return ",".join(controllers)
+
+
+def _node_selector(value):
+    selector = {}
+    for label in (value or "").split():
+        key, sep, label_value = label.partition("=")
+        if not sep or not _LABEL_KEY.match(key) or not _LABEL_VALUE.match(label_value):
+            raise InvalidConfig("{} is not a key=value node label".format(label))
+        selector[key] = label_value
+    return selector
+
+
+def deployment_config(config):
+    """Return the policy controller manifest context for the charm config.
+
+    On the Kubernetes API datastore, controllers that only run against etcd
+    are left out of the enabled ones.
+    Args:
+        config: Mapping of charm config option names to values
+    Returns: Dict with the enabled_controllers, reconciler_period, resources,
+        node_selector and priority_class of the calico-kube-controllers
+        Deployment
+    Raises: InvalidConfig if an option isn't valid for Kubernetes or calico
+    """
+    period = config.get("kube-controllers-reconciler-period")
+    if not _DURATION.match(period or ""):
+        raise InvalidConfig(
+            "kube-controllers-reconciler-period must be a duration, like 5m"
+        )
+
+    resources = {}
+    for (kind, resource), option in RESOURCES.items():
+        value = config.get(option)
+        if not value:
+            continue
+        if not _QUANTITY.match(value):
+            raise InvalidConfig("{} must be a Kubernetes quantity".format(option))
+        resources.setdefault(kind, {})[resource] = value
+
+    priority_class = config.get("kube-controllers-priority-class") or ""
+    if priority_class and not _DNS_SUBDOMAIN.match(priority_class):
+        raise InvalidConfig("{} is not a priority class name".format(priority_class))
+
+    return {
+        "enabled_controllers": _controllers(
+            config.get("kube-controllers-enabled"), config.get("calico-datastore")
+        ),
+        "reconciler_period": period,
+        "resources": resources,
+        "node_selector": _node_selector(config.get("kube-controllers-node-selector")),
+        "priority_class": priority_class,
+    }
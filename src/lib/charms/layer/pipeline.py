@@ -0,0 +1,95 @@
+import time
+from collections import namedtuple
+
+from charmhelpers.core import hookenv
+from charms.reactive import is_flag_set
+
+from charms.layer import status, timing
+
+# the install steps are I/O bound, so they overlap well, but bound how many
+# run at once so a small unit isn't swamped
+MAX_WORKERS = 3
+
+# An install step of the pipeline, done once its flag is set.
+#   prepare: Runs in the hook's thread, returning the work to do, or None if
+#       the step can't run yet
+#   finish: Runs in the hook's thread with a callable returning the result of
+#       the work, or raising what it raised; sets the flag on success
+Step = namedtuple("Step", ["name", "flag", "prepare", "finish"])
+
+_steps = []
+# names of the steps whose work ran in this dispatch, which don't run again in it
+_attempted = set()
+
+
+def add_step(name, flag, prepare, finish):
+    """Add an install step to the pipeline, replacing any of the same name.
+
+    The work a step's prepare returns runs in a worker thread, so it mustn't
+    touch unitdata, reactive flags or the unit's status.
+    """
+    _steps[:] = [step for step in _steps if step.name != name]
+    _steps.append(Step(name, flag, prepare, finish))
+
+
+def _timed(work, durations, name):
+    start = time.monotonic()
+    try:
+        return work()
+    finally:
+        durations[name] = time.monotonic() - start
+
+
+def run():
+    """Run every install step whose flag isn't set yet, concurrently.
+
+    Steps finish in the order they were added, once all of them are done. If
+    any finish raises, the rest still finish and the first error is raised.
+    A step's work runs at most once per dispatch, so a step that failed isn't
+    retried by every handler that runs the pipeline; one that couldn't run yet
+    is prepared again.
+    Returns: Dict of step name to the seconds its work took
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    started = []
+    for step in _steps:
+        if is_flag_set(step.flag) or step.name in _attempted:
+            continue
+        work = step.prepare()
+        if work is not None:
+            _attempted.add(step.name)
+            started.append((step, work))
+    if not started:
+        return {}
+
+    status.maintenance(
+        "Preparing {}".format(", ".join(step.name for step, _ in started))
+    )
+    durations = {}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(started))) as pool:
+        futures = [
+            (step, pool.submit(_timed, work, durations, step.name))
+            for step, work in started
+        ]
+    elapsed = time.monotonic() - start
+
+    # finish every step before raising, so one failure doesn't lose the work
+    # of the others
+    failure = None
+    for step, future in futures:
+        hookenv.log("Prepared {} in {:.1f}s".format(step.name, durations[step.name]))
+        timing.step(step.name, durations[step.name])
+        try:
+            step.finish(future.result)
+        except Exception as e:
+            failure = failure or e
+    if failure is not None:
+        raise failure
+    hookenv.log(
+        "Prepared {} step(s) in {:.1f}s, {:.1f}s of work".format(
+            len(futures), elapsed, sum(durations.values())
+        )
+    )
+    return durations
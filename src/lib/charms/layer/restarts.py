@@ -0,0 +1,134 @@
+from charmhelpers.core import hookenv, unitdata
+
+from charms.layer.timing import check_call, service_restart
+
+# services in the order they restart; calico-node runs over flannel's network
+ORDER = ("flannel", "calico-node")
+
+# unitdata key counting the restarts coalesced away, over the unit's lifetime
+AVOIDED_KEY = "canal.restarts.avoided"
+
+# what this hook has asked for so far
+_pending = {"daemon-reload": False, "services": set(), "requests": 0}
+_callbacks = []
+# what the last flush restarted, for the after_restarts callbacks
+_restarted = set()
+# decides whether queued restarts may run now; see set_gate
+_gate = None
+
+
+def _queue():
+    if not _pending["requests"]:
+        hookenv.atexit(flush)
+    _pending["requests"] += 1
+
+
+def daemon_reload():
+    """Have systemd reload its unit files once, at the end of the hook."""
+    _queue()
+    _pending["daemon-reload"] = True
+
+
+def restart(service):
+    """Restart a service once, at the end of the hook.
+
+    Services are restarted in ORDER, after any daemon reload, however many
+    times and in whatever order handlers ask for them.
+    """
+    if service not in ORDER:
+        raise ValueError("{} isn't a service canal restarts".format(service))
+    _queue()
+    _pending["services"].add(service)
+
+
+def pending(service=None):
+    """Return True if service, or any service if None, is queued to restart."""
+    if service is None:
+        return bool(_pending["services"])
+    return service in _pending["services"]
+
+
+def restarted(service):
+    """Return True if the last flush of this hook restarted service.
+
+    A restart held by the gate doesn't count, so after_restarts callbacks can
+    tell whether the service runs with its new config yet.
+    """
+    return service in _restarted
+
+
+def after_restarts(callback):
+    """Call callback at the end of the hook, once the queued restarts are done.
+
+    Callbacks only run if the hook queued a restart or daemon reload.
+    """
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+
+
+def set_gate(gate):
+    """Have flush ask gate(services) before restarting services.
+
+    Restarts the gate refuses are dropped; it is up to the gate to ask for them
+    again once they may run.
+    """
+    global _gate
+    _gate = gate
+
+
+def _unit_key(unit):
+    app, _, number = unit.partition("/")
+    return app, int(number) if number.isdigit() else 0
+
+
+def next_grants(waiting, granted, batch_size):
+    """Return which units may restart, restarting at most batch_size at once.
+
+    Units keep their grant until they stop waiting, which they do once their
+    services are healthy again. Free slots go to the other waiting units, in
+    unit number order.
+    Args:
+        waiting: Units waiting to restart, or restarting and not yet healthy
+        granted: Units granted a restart so far
+        batch_size: How many units may hold a grant at once
+    Returns: Sorted list of the units granted a restart
+    """
+    kept = [unit for unit in granted if unit in waiting]
+    free = max(batch_size - len(kept), 0)
+    queued = sorted((unit for unit in waiting if unit not in kept), key=_unit_key)
+    return sorted(kept + queued[:free], key=_unit_key)
+
+
+def flush():
+    """Run the queued daemon reload and restarts, then the after_restarts calls.
+
+    Registered with hookenv.atexit by the first request of a hook.
+    """
+    if not _pending["requests"]:
+        return
+    services = [name for name in ORDER if name in _pending["services"]]
+    done = len(services) + _pending["daemon-reload"]
+    avoided = _pending["requests"] - done
+    if services and _gate is not None and not _gate(services):
+        hookenv.log("Holding restart of {}".format(", ".join(services)))
+        services = []
+    if _pending["daemon-reload"]:
+        check_call(["systemctl", "daemon-reload"])
+    for name in services:
+        service_restart(name)
+    hookenv.log(
+        "Restarted {} for {} request(s)".format(
+            ", ".join(services) or "nothing", _pending["requests"]
+        )
+    )
+    if avoided:
+        kv = unitdata.kv()
+        kv.set(AVOIDED_KEY, kv.get(AVOIDED_KEY, 0) + avoided)
+    _pending.update({"daemon-reload": False, "services": set(), "requests": 0})
+    _restarted.clear()
+    _restarted.update(services)
+
+    callbacks = list(_callbacks)
+    del _callbacks[:]
+    for callback in callbacks:
+        callback()
@@ -0,0 +1,203 @@
+import functools
+import json
+import os
+import subprocess
+import time
+from collections import defaultdict
+
+from charmhelpers.core import hookenv, host
+
+LOG_PATH = "/var/log/canal/handler-timing.jsonl"
+# rotate the log once it grows past this, keeping this many old copies
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 3
+
+# records for the handlers currently running, innermost last
+_active = []
+
+
+def enabled():
+    """Return True if the operator has opted in to handler timing."""
+    return bool(hookenv.config().get("enable-handler-timing"))
+
+
+def install():
+    """Record the wall time of every reactive handler from now on.
+
+    Wraps reactive's handler dispatch, so handlers are timed without being
+    decorated. Commands run through the wrappers in this module while a
+    handler runs are recorded with it. Nothing is recorded unless enabled().
+    """
+    from charms.reactive.bus import Handler
+
+    invoke = Handler.invoke
+    if getattr(invoke, "timed", False):
+        return
+
+    @functools.wraps(invoke)
+    def _timed(self):
+        if not enabled():
+            return invoke(self)
+        action = self._action
+        record = {
+            "handler": "{}.{}".format(action.__module__, action.__name__),
+            "hook": hookenv.hook_name(),
+            "time": time.time(),
+            "commands": [],
+        }
+        _active.append(record)
+        start = time.monotonic()
+        try:
+            return invoke(self)
+        finally:
+            record["duration"] = time.monotonic() - start
+            _active.remove(record)
+            _write(record)
+
+    _timed.timed = True
+    Handler.invoke = _timed
+
+
+def command(func, name=None):
+    """Wrap a callable that runs an external command so it gets recorded.
+
+    Args:
+        func: Callable taking the command as its first argument
+        name: Name to record; defaults to the basename of the executable
+    Returns: The wrapped callable
+    """
+
+    @functools.wraps(func)
+    def _timed(*args, **kwargs):
+        if not _active:
+            return func(*args, **kwargs)
+        cmd = name or _command_name(args[0] if args else kwargs.get("args"))
+        rc = 0
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+            # the charmhelpers service helpers report failure with False
+            if result is False:
+                rc = 1
+            elif isinstance(result, subprocess.CompletedProcess):
+                rc = result.returncode
+            return result
+        except subprocess.CalledProcessError as e:
+            rc = e.returncode
+            raise
+        except OSError:
+            rc = 127
+            raise
+        finally:
+            _active[-1]["commands"].append(
+                {"command": cmd, "duration": time.monotonic() - start, "rc": rc}
+            )
+
+    return _timed
+
+
+def step(name, duration):
+    """Record a step of the running handler whose work ran in another thread.
+
+    Args:
+        name: Name of the step
+        duration: Seconds the step's work took
+    """
+    if _active:
+        _active[-1].setdefault("steps", []).append({"step": name, "duration": duration})
+
+
+def _command_name(cmd):
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    return os.path.basename(cmd[0]) if cmd else "unknown"
+
+
+run = command(subprocess.run)
+check_call = command(subprocess.check_call)
+check_output = command(subprocess.check_output)
+service = command(host.service, "systemctl")
+service_start = command(host.service_start, "systemctl")
+service_stop = command(host.service_stop, "systemctl")
+service_restart = command(host.service_restart, "systemctl")
+service_running = command(host.service_running, "systemctl")
+
+
+def _write(record):
+    try:
+        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+        if os.path.exists(LOG_PATH) and os.path.getsize(LOG_PATH) > MAX_BYTES:
+            _rotate()
+        with open(LOG_PATH, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        hookenv.log("Unable to record handler timing: {}".format(e))
+
+
+def _rotate():
+    for i in range(BACKUP_COUNT - 1, 0, -1):
+        src = "{}.{}".format(LOG_PATH, i)
+        if os.path.exists(src):
+            os.replace(src, "{}.{}".format(LOG_PATH, i + 1))
+    os.replace(LOG_PATH, LOG_PATH + ".1")
+
+
+def read_records():
+    """Yield every recorded handler run, oldest first."""
+    paths = ["{}.{}".format(LOG_PATH, i) for i in range(BACKUP_COUNT, 0, -1)]
+    for path in paths + [LOG_PATH]:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # a partial line from an interrupted hook
+                        continue
+        except FileNotFoundError:
+            continue
+
+
+def summarize(records, count=10):
+    """Summarize the slowest handlers, commands and install steps.
+
+    Args:
+        records: Iterable of handler records, as from read_records()
+        count: How many handlers, commands and steps to report
+    Returns: Dict with 'handlers', 'commands' and 'steps' lists of stats
+        dicts, each sorted by total time spent, slowest first
+    """
+    handlers = defaultdict(list)
+    commands = defaultdict(list)
+    steps = defaultdict(list)
+    failures = defaultdict(int)
+    for record in records:
+        handlers[record["handler"]].append(record["duration"])
+        for cmd in record.get("commands", []):
+            commands[cmd["command"]].append(cmd["duration"])
+            if cmd["rc"]:
+                failures[cmd["command"]] += 1
+        for run in record.get("steps", []):
+            steps[run["step"]].append(run["duration"])
+
+    def _stats(durations):
+        stats = [
+            {
+                "name": name,
+                "count": len(times),
+                "total": round(sum(times), 3),
+                "mean": round(sum(times) / len(times), 3),
+                "max": round(max(times), 3),
+            }
+            for name, times in durations.items()
+        ]
+        return sorted(stats, key=lambda s: s["total"], reverse=True)[:count]
+
+    command_stats = _stats(commands)
+    for stat in command_stats:
+        stat["failures"] = failures[stat["name"]]
+    return {
+        "handlers": _stats(handlers),
+        "commands": command_stats,
+        "steps": _stats(steps),
+    }
@@ -1,14 +1,24 @@
+import json
 import os
-import yaml
-import gzip
 import traceback
 
+from functools import lru_cache, partial
 from socket import gethostname
-from conctl import getContainerRuntimeCtl
-from subprocess import check_call, check_output, CalledProcessError, STDOUT
-
-from charms.layer.canal import arch
-from charms.leadership import leader_set
+from subprocess import CalledProcessError, DEVNULL
+
+from charms.layer.canal import (
+    add_snap_bin_to_path,
+    arch,
+    cni_kubeconfig_path,
+    file_digest,
+    fetch_binaries,
+    config_revision,
+    etcd_connection_string,
+    render_if_changed,
+    ResourceError,
+    CHUNK_SIZE,
+)
+from charms.leadership import leader_get, leader_set
 from charms.reactive import (
     when,
     when_not,
@@ -18,9 +28,9 @@ from charms.reactive import (
     endpoint_from_flag,
     hook,
 )
-from charms.reactive.flags import clear_flag
+from charms.reactive.flags import clear_flag, is_flag_set
 from charms.reactive.helpers import data_changed
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 from charmhelpers.core.hookenv import (
     log,
     resource_get,
@@ -28,22 +38,19 @@ from charmhelpers.core.hookenv import (
     is_leader,
     env_proxy_settings,
 )
-from charmhelpers.core.host import service, service_restart
 from charmhelpers.core.templating import render
 
-from charms.layer import status
+from charms.layer import datastore, etcdv3, felix, ippool, kube_controllers
+from charms.layer import pipeline, restarts, status
+from charms.layer.etcdv3 import EtcdError
+from charms.layer.timing import check_output, service
 
 # TODO:
 #   - Handle the 'stop' hook by stopping and uninstalling all the things.
 
-os.environ["PATH"] += os.pathsep + os.path.join(os.sep, "snap", "bin")
-
-try:
-    CTL = getContainerRuntimeCtl()
-    set_state("calico.ctl.ready")
-except RuntimeError:
-    log(traceback.format_exc())
-    remove_state("calico.ctl.ready")
+# NB: reactive imports every handler module on every hook, so keep imports and
+# work at module level cheap. Heavy modules and runtime detection are deferred
+# to the handlers that need them.
 
 # This needs to match up with CALICOCTL_PATH in canal.py
 CALICOCTL_PATH = "/opt/calicoctl"
@@ -51,6 +58,38 @@ ETCD_KEY_PATH = os.path.join(CALICOCTL_PATH, "etcd-key")
 ETCD_CERT_PATH = os.path.join(CALICOCTL_PATH, "etcd-cert")
 ETCD_CA_PATH = os.path.join(CALICOCTL_PATH, "etcd-ca")
 
+CALICO_NODE_SERVICE_PATH = "/lib/systemd/system/calico-node.service"
+
+# archive member name to install path
+CALICO_BINARIES = {
+    "calicoctl": os.path.join(CALICOCTL_PATH, "calicoctl"),
+    "calico": "/opt/cni/bin/calico",
+    "calico-ipam": "/opt/cni/bin/calico-ipam",
+}
+
+# unitdata key for the digests of the installed calico binaries
+CALICO_BINARIES_KEY = "canal.calico.binaries"
+# unitdata key recording the digest of the last image resource we loaded, and
+# the container runtime we loaded it into
+CALICO_NODE_IMAGE_KEY = "canal.calico-node-image.loaded"
+# kube-controllers serves metrics on this port, from calico v3.15 on
+KUBE_CONTROLLERS_METRICS_PORT = 9094
+# unitdata key recording the hash of the last policy controller manifest applied
+NPC_MANIFEST_HASH_KEY = "canal.npc.manifest-hash"
+# unitdata key recording the datastore of the last policy controller manifest
+NPC_DATASTORE_KEY = "canal.npc.datastore"
+# peer relation between the canal units, counted to size Typha
+CANAL_PEER = "canal-peer"
+
+
+@lru_cache(maxsize=None)
+def container_runtime():
+    """Return the container runtime controller, detecting it on first use."""
+    from conctl import getContainerRuntimeCtl
+
+    add_snap_bin_to_path()
+    return getContainerRuntimeCtl()
+
 
 def set_http_proxy():
     """
@@ -86,27 +125,132 @@ def upgrade_charm():
         )
 
 
+@when_not("calico.ctl.ready")
+def detect_container_runtime():
+    try:
+        container_runtime()
+        set_state("calico.ctl.ready")
+    except RuntimeError:
+        log(traceback.format_exc())
+
+
 @when_not("calico.image.pulled")
 @when("calico.ctl.ready")
 def pull_calico_node_image():
-    image = resource_get("calico-node-image")
+    """Get the calico-node image, alongside the other pending install steps."""
+    pipeline.run()
 
-    if not image or os.path.getsize(image) == 0:
-        status.maintenance("Pulling calico-node image")
-        image = hookenv.config("calico-node-image")
-        set_http_proxy()
-        CTL.pull(image)
-    else:
-        status.maintenance("Loading calico-node image")
-        unzipped = "/tmp/calico-node-image.tar"
-        with gzip.open(image, "rb") as f_in:
-            with open(unzipped, "wb") as f_out:
-                f_out.write(f_in.read())
-        CTL.load(unzipped)
 
+def prepare_calico_node_image():
+    if not is_flag_set("calico.ctl.ready"):
+        return None
+    try:
+        runtime = container_runtime()
+    except RuntimeError:
+        # the runtime went away since it was detected; detect it again
+        log(traceback.format_exc())
+        clear_flag("calico.ctl.ready")
+        return None
+    set_http_proxy()
+    return partial(
+        fetch_calico_node_image,
+        runtime,
+        hookenv.config("calico-node-image"),
+        unitdata.kv().get(CALICO_NODE_IMAGE_KEY),
+    )
+
+
+def fetch_calico_node_image(runtime, image, loaded):
+    """Load the calico-node image resource, or pull image if there isn't one.
+
+    The load is skipped if the same resource was last loaded into the same
+    runtime, and the runtime still holds image.
+    Runs in a pipeline worker, so it leaves unitdata to finish_calico_node_image.
+    Args:
+        runtime: The container runtime controller
+        image: The image the service runs
+        loaded: What was recorded when the image resource was last loaded
+    Returns: What to record of the image resource, or None if the image was
+        pulled, and whether it was loaded
+    """
+    archive = resource_get("calico-node-image")
+    if not archive or os.path.getsize(archive) == 0:
+        runtime.pull(image)
+        return None, False
+    record = {"digest": file_digest(archive), "runtime": type(runtime).__name__}
+    if record == loaded and runtime_has_image(runtime, image):
+        return record, False
+    load_calico_node_image(archive)
+    return record, True
+
+
+def runtime_has_image(runtime, image):
+    """Return True if the container runtime holds image."""
+    if "docker" in type(runtime).__name__.lower():
+        try:
+            check_output(["docker", "image", "inspect", image], stderr=DEVNULL)
+        except CalledProcessError:
+            return False
+        return True
+    return image in check_output(["ctr", "image", "ls", "-q"]).decode().split()
+
+
+def finish_calico_node_image(fetched):
+    record, loaded = fetched()
+    if loaded:
+        unitdata.kv().set(CALICO_NODE_IMAGE_KEY, record)
+        if os.path.exists(CALICO_NODE_SERVICE_PATH):
+            # run the image just loaded
+            restarts.restart("calico-node")
+    elif record is not None:
+        log("calico-node image resource unchanged, skipping load")
     set_state("calico.image.pulled")
 
 
+def load_calico_node_image(archive):
+    """Stream a gzip'd image archive into the container runtime.
+
+    The runtime loads from a path, so hand it a fifo and decompress into that
+    from a writer thread. This keeps the decompressed image off disk and out of
+    memory, no matter how big it is.
+    """
+    import gzip
+    import shutil
+    import tempfile
+    import threading
+
+    errors = []
+
+    def _decompress(fifo):
+        try:
+            with gzip.open(archive, "rb") as f_in, open(fifo, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+        except Exception as e:
+            errors.append(e)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fifo = os.path.join(tmp, "calico-node-image.tar")
+        os.mkfifo(fifo, 0o600)
+        writer = threading.Thread(target=_decompress, args=(fifo,), daemon=True)
+        writer.start()
+        try:
+            container_runtime().load(fifo)
+        finally:
+            while writer.is_alive():
+                # the runtime may have bailed before draining the fifo; give
+                # the writer a reader that goes away so it fails out with
+                # EPIPE instead of blocking forever
+                try:
+                    fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+                except OSError:
+                    fd = None
+                writer.join(0.1)
+                if fd is not None:
+                    os.close(fd)
+    if errors:
+        raise errors[0]
+
+
 @when_any("config.changed.calico-node-image")
 def repull_calico_node_image():
     remove_state("calico.image.pulled")
@@ -115,57 +259,48 @@ def repull_calico_node_image():
 
 @when_not("calico.binaries.installed")
 def install_calico_binaries():
-    """Unpack the Calico binaries."""
+    """Unpack the Calico binaries, alongside the other pending install steps."""
+    pipeline.run()
+
+
+def prepare_calico_binaries():
     # on intel, the resource is called 'calico'; other arches have a suffix
     architecture = arch()
     if architecture == "amd64":
         resource_name = "calico"
     else:
         resource_name = "calico-{}".format(architecture)
+    cached = unitdata.kv().get(CALICO_BINARIES_KEY)
+    return partial(fetch_binaries, resource_name, "calico", CALICO_BINARIES, cached)
 
-    try:
-        archive = resource_get(resource_name)
-    except Exception:
-        message = "Error fetching the calico resource."
-        log(message)
-        status.blocked(message)
-        return
-
-    if not archive:
-        message = "Missing calico resource."
-        log(message)
-        status.blocked(message)
-        return
 
-    filesize = os.stat(archive).st_size
-    if filesize < 1000000:
-        message = "Incomplete calico resource"
-        log(message)
-        status.blocked(message)
+def finish_calico_binaries(fetched):
+    try:
+        cached = fetched()
+    except ResourceError as e:
+        log("{}: {}".format(e, e.__cause__) if e.__cause__ else str(e))
+        status.blocked(str(e))
         return
+    if cached is None:
+        log("calico resource unchanged, binaries already installed")
+    else:
+        unitdata.kv().set(CALICO_BINARIES_KEY, cached)
+    set_state("calico.binaries.installed")
 
-    status.maintenance("Unpacking calico resource.")
-
-    charm_dir = os.getenv("CHARM_DIR")
-    unpack_path = os.path.join(charm_dir, "files", "calico")
-    os.makedirs(unpack_path, exist_ok=True)
-    cmd = ["tar", "xfz", archive, "-C", unpack_path]
-    log(cmd)
-    check_call(cmd)
-
-    apps = [
-        {"name": "calicoctl", "path": CALICOCTL_PATH},
-        {"name": "calico", "path": "/opt/cni/bin"},
-        {"name": "calico-ipam", "path": "/opt/cni/bin"},
-    ]
-
-    for app in apps:
-        unpacked = os.path.join(unpack_path, app["name"])
-        app_path = os.path.join(app["path"], app["name"])
-        install = ["install", "-v", "-D", unpacked, app_path]
-        check_call(install)
 
-    set_state("calico.binaries.installed")
+# the install steps, run concurrently by whichever of their handlers runs first
+pipeline.add_step(
+    "calico binaries",
+    "calico.binaries.installed",
+    prepare_calico_binaries,
+    finish_calico_binaries,
+)
+pipeline.add_step(
+    "calico-node image",
+    "calico.image.pulled",
+    prepare_calico_node_image,
+    finish_calico_node_image,
+)
 
 
 @when("calico.binaries.installed")
@@ -207,10 +342,33 @@ def get_bind_address():
 @when(
     "calico.binaries.installed", "etcd.available", "calico.etcd-credentials.installed"
 )
+@when("calico.image.pulled")
 @when_not("calico.service.installed")
 def install_calico_service():
-    """Install the calico-node systemd service."""
+    """Install the calico-node systemd service.
+
+    calico-node is only restarted if the service changed. New etcd credentials
+    and image loads restart it themselves.
+    """
     status.maintenance("Installing calico-node service.")
+    try:
+        felix_env = calico_felix_env()
+    except felix.InvalidOption as e:
+        status.blocked("Invalid felix-options: {}".format(e))
+        return
+    calico_datastore = hookenv.config("calico-datastore")
+    if calico_datastore not in datastore.DATASTORES:
+        status.blocked(
+            "calico-datastore must be one of {}".format(", ".join(datastore.DATASTORES))
+        )
+        return
+    kubeconfig_path = None
+    if calico_datastore == datastore.KUBERNETES:
+        cni = endpoint_from_flag("cni.connected")
+        if not cni:
+            status.waiting("Waiting for the cni relation to reach kubernetes")
+            return
+        kubeconfig_path = cni_kubeconfig_path(cni)
 
     # keep track of our etcd connections so we can detect when it changes later
     etcd = endpoint_from_flag("etcd.available")
@@ -218,14 +376,13 @@ def install_calico_service():
     data_changed("calico_etcd_connections", etcd_connections)
     data_changed("calico_etcd_cert", etcd.get_client_credentials())
 
-    service_path = os.path.join(
-        os.sep, "lib", "systemd", "system", "calico-node.service"
-    )
-    render(
+    changed = render_if_changed(
         "calico-node.service",
-        service_path,
+        CALICO_NODE_SERVICE_PATH,
         {
-            "connection_string": etcd_connections,
+            "datastore": calico_datastore,
+            "kubeconfig_path": kubeconfig_path,
+            "connection_string": etcd_connection_string(etcd),
             "etcd_key_path": ETCD_KEY_PATH,
             "etcd_ca_path": ETCD_CA_PATH,
             "etcd_cert_path": ETCD_CERT_PATH,
@@ -234,13 +391,18 @@ def install_calico_service():
             "ip": get_bind_address(),
             "calico_node_image": hookenv.config("calico-node-image"),
             "ignore_loose_rpf": hookenv.config("ignore-loose-rpf"),
+            "felix_env": felix_env,
             "lc_all": os.environ.get("LC_ALL", "C.UTF-8"),
             "lang": os.environ.get("LANG", "C.UTF-8"),
         },
     )
-    check_call(["systemctl", "daemon-reload"])
-    service_restart("calico-node")
-    service("enable", "calico-node")
+    data_changed("calico.felix-env", felix_env)
+    if changed:
+        restarts.daemon_reload()
+        restarts.restart("calico-node")
+        service("enable", "calico-node")
+    else:
+        log("calico-node service unchanged, not restarting")
     set_state("calico.service.installed")
 
 
@@ -249,48 +411,172 @@ def ignore_loose_rpf_changed():
     remove_state("calico.service.installed")
 
 
+@when("config.changed.calico-datastore")
+def calico_datastore_changed():
+    """Point calico-node, the CNI and the policy controller at the datastore.
+
+    Nothing is migrated: the new datastore starts from the pool the charm
+    configures, and Calico resources made by hand must be recreated in it.
+    """
+    remove_state("calico.service.installed")
+    remove_state("calico.pool.configured")
+    remove_state("calico.npc.invalid-config")
+    remove_state("calico.npc.deployed")
+    remove_state("canal.cni.configured")
+
+
+def calico_felix_env():
+    """Return the FELIX_* environment for calico-node.
+
+    Raises: InvalidOption if felix-options is invalid
+    """
+    env = felix.felix_env(hookenv.config("felix-options"))
+    if hookenv.config("enable-metrics"):
+        env["FELIX_PROMETHEUSMETRICSENABLED"] = "true"
+        env["FELIX_PROMETHEUSMETRICSPORT"] = str(hookenv.config("felix-metrics-port"))
+    return env
+
+
+@when("calico.service.installed")
+@when_any(
+    "config.changed.felix-options",
+    "config.changed.enable-metrics",
+    "config.changed.felix-metrics-port",
+)
+def felix_options_changed():
+    """Restart calico-node only if the Felix settings it runs with changed.
+
+    Edits that don't change the settings, like reordering or comments, leave
+    it running. Invalid options are reported by install_calico_service.
+    """
+    try:
+        env = calico_felix_env()
+    except felix.InvalidOption:
+        env = None
+    if env is None or data_changed("calico.felix-env", env):
+        remove_state("calico.service.installed")
+
+
+@when_any("config.changed.enable-metrics", "config.changed.felix-metrics-port")
+def metrics_config_changed():
+    remove_state("calico.metrics.published")
+    remove_state("calico.npc.deployed")
+
+
+@when_any(
+    "config.changed.kube-controllers-enabled",
+    "config.changed.kube-controllers-reconciler-period",
+    "config.changed.kube-controllers-cpu-request",
+    "config.changed.kube-controllers-cpu-limit",
+    "config.changed.kube-controllers-memory-request",
+    "config.changed.kube-controllers-memory-limit",
+    "config.changed.kube-controllers-node-selector",
+    "config.changed.kube-controllers-priority-class",
+)
+def kube_controllers_config_changed():
+    remove_state("calico.npc.invalid-config")
+    remove_state("calico.npc.deployed")
+
+
+@when("config.changed.calico-typha-image")
+def typha_image_changed():
+    remove_state("calico.npc.deployed")
+
+
+@hook("metrics-relation-joined", "metrics-relation-changed")
+def metrics_relation_changed():
+    remove_state("calico.metrics.published")
+
+
+@when("calico.service.installed")
+@when_not("calico.metrics.published")
+def publish_metrics_targets():
+    """Advertise this unit's Felix scrape target to related Prometheus units.
+
+    kube-controllers runs once per cluster, so it is found through the
+    scrape annotations on its pod instead.
+    """
+    data = {"hostname": None, "port": None, "metrics_path": None}
+    if hookenv.config("enable-metrics"):
+        data = {
+            "hostname": get_bind_address(),
+            "port": hookenv.config("felix-metrics-port"),
+            "metrics_path": "/metrics",
+        }
+    for relation_id in hookenv.relation_ids("metrics"):
+        hookenv.relation_set(relation_id, data)
+    set_state("calico.metrics.published")
+
+
 @when(
     "calico.binaries.installed", "etcd.available", "calico.etcd-credentials.installed"
 )
 @when_not("calico.pool.configured")
 def configure_calico_pool(etcd):
-    """Configure Calico IP pool."""
-    status.maintenance("Configuring Calico IP pool")
+    """Configure Calico IP pool.
 
-    # remove unrecognized pools
-    try:
-        output = calicoctl("get", "pool", "-o", "yaml").decode("utf-8")
-    except CalledProcessError:
-        log("Failed to get pools")
-        status.waiting("Waiting to retry calico pool configuration")
-        return
+    Only the leader reconciles the pools, in etcd or as custom resources with
+    the Kubernetes API datastore, removing any others. It then publishes the
+    revision it applied, and the other units wait until the leader has applied
+    the revision they expect.
+    """
+    import yaml
 
-    pool_data = yaml.safe_load(output)
-    pools = [item["metadata"]["name"] for item in pool_data["items"]]
-    pools_to_delete = [pool for pool in pools if pool != "default"]
+    status.maintenance("Configuring Calico IP pool")
 
-    for pool in pools_to_delete:
-        log("Deleting pool: %s" % pool)
+    config = hookenv.config()
+    context = {"cidr": config["cidr"]}
+    pool = yaml.safe_load(render("pool.yaml", None, context))
+    pool_name = pool["metadata"]["name"]
+    calico_datastore = config["calico-datastore"]
+    revision = config_revision([pool])
+    if calico_datastore == datastore.KUBERNETES:
+        revision = config_revision([calico_datastore, pool])
+    if is_leader() and calico_datastore == datastore.KUBERNETES:
+        # the custom resource definitions come with the policy controller
+        if not is_flag_set("calico.npc.deployed"):
+            status.waiting("Waiting for the calico resource definitions")
+            return
         try:
-            calicoctl("delete", "pool", pool, "--skip-not-exists")
+            kubectl(
+                "apply",
+                "--server-side",
+                "--force-conflicts",
+                "--field-manager=canal",
+                "-f",
+                "-",
+                input=json.dumps(datastore.ippool_resource(pool)).encode("utf-8"),
+            )
+            resource = "ippools." + datastore.CRD_GROUP
+            names = kubectl("get", resource, "-o", "jsonpath={.items[*].metadata.name}")
+            stale = [
+                name for name in names.decode("utf-8").split() if name != pool_name
+            ]
+            if stale:
+                kubectl("delete", resource, *stale)
+                log("IPPool deletes: {}".format(", ".join(stale)))
         except CalledProcessError:
-            log("Failed to delete pool: %s" % pool)
             status.waiting("Waiting to retry calico pool configuration")
             return
-
-    # configure the default pool
-    config = hookenv.config()
-    context = {"cidr": config["cidr"]}
-    render("pool.yaml", "/tmp/calico-pool.yaml", context)
-    try:
-        calicoctl("apply", "-f", "/tmp/calico-pool.yaml")
-    except CalledProcessError:
-        status.waiting("Waiting to retry calico pool configuration")
+        leader_set({"calico-pool-revision": revision})
+    elif is_leader():
+        try:
+            changes = ippool.reconcile(etcd_client(), [pool])
+        except EtcdError as e:
+            log("Failed to configure pools: {}".format(e))
+            status.waiting("Waiting to retry calico pool configuration")
+            return
+        for action, names in changes._asdict().items():
+            if names:
+                log("IPPool {}: {}".format(action, ", ".join(names)))
+        leader_set({"calico-pool-revision": revision})
+    elif leader_get("calico-pool-revision") != revision:
+        status.waiting("Waiting for leader to configure calico pool")
         return
     set_state("calico.pool.configured")
 
 
-@when_any("config.changed.ipip", "config.changed.nat-outgoing")
+@when_any("config.changed.cidr", "config.changed.ipip", "config.changed.nat-outgoing")
 def reconfigure_calico_pool():
     """Reconfigure the Calico IP pool"""
     remove_state("calico.pool.configured")
@@ -300,25 +586,117 @@ def reconfigure_calico_pool():
 @when_not("calico.npc.deployed")
 def deploy_network_policy_controller():
     """Deploy the Calico network policy controller."""
+    try:
+        deployment = kube_controllers.deployment_config(hookenv.config())
+    except kube_controllers.InvalidConfig as e:
+        status.blocked("Invalid kube-controllers config: {}".format(e))
+        set_state("calico.npc.invalid-config")
+        return
+    remove_state("calico.npc.invalid-config")
+
     status.maintenance("Deploying network policy controller.")
     etcd = endpoint_from_flag("etcd.available")
+    calico_datastore = hookenv.config("calico-datastore")
+    kdd = calico_datastore == datastore.KUBERNETES
+    typha_replicas = datastore.typha_replicas(canal_units()) if kdd else 0
+    data_changed("calico.typha-replicas", typha_replicas)
     context = {
+        "datastore": calico_datastore,
+        "flannel_subnet_manager": hookenv.config("flannel-subnet-manager"),
+        "crds": datastore.crds() if kdd else [],
+        "typha_replicas": typha_replicas,
+        "calico_typha_image": hookenv.config("calico-typha-image"),
         "connection_string": etcd.get_connection_string(),
         "etcd_key_path": ETCD_KEY_PATH,
         "etcd_cert_path": ETCD_CERT_PATH,
         "etcd_ca_path": ETCD_CA_PATH,
         "calico_policy_image": hookenv.config("calico-policy-image"),
         "etcd_cert_last_modified": os.path.getmtime(ETCD_CERT_PATH),
+        "metrics_port": (
+            KUBE_CONTROLLERS_METRICS_PORT if hookenv.config("enable-metrics") else None
+        ),
+        **deployment,
     }
-    render("policy-controller.yaml", "/tmp/policy-controller.yaml", context)
+    # Every object carries the hash of the manifest it was applied from, so an
+    # unchanged manifest costs one kubectl get rather than a full apply. The
+    # cluster is only asked when this unit last applied the same manifest;
+    # otherwise it almost certainly needs applying anyway.
+    context["manifest_hash"] = ""
+    manifest_hash = config_revision(render("policy-controller.yaml", None, context))
+    context["manifest_hash"] = manifest_hash
+    manifest = render("policy-controller.yaml", None, context)
+    kv = unitdata.kv()
     try:
-        kubectl("apply", "-f", "/tmp/policy-controller.yaml")
+        if (
+            kv.get(NPC_MANIFEST_HASH_KEY) != manifest_hash
+            or applied_manifest_hash() != manifest_hash
+        ):
+            kubectl(
+                "apply",
+                "--server-side",
+                "--force-conflicts",
+                "--field-manager=canal",
+                "-f",
+                "-",
+                input=manifest.encode("utf-8"),
+            )
+            kv.set(NPC_MANIFEST_HASH_KEY, manifest_hash)
+        if not kdd and kv.get(NPC_DATASTORE_KEY) == datastore.KUBERNETES:
+            # apply doesn't prune, so remove what only the kubernetes
+            # datastore needs; the resource definitions keep their data
+            kubectl(
+                "delete",
+                "--namespace=kube-system",
+                "--ignore-not-found",
+                "deployment/calico-typha",
+                "service/calico-typha",
+                "poddisruptionbudget/calico-typha",
+            )
+        kv.set(NPC_DATASTORE_KEY, calico_datastore)
         set_state("calico.npc.deployed")
     except CalledProcessError as e:
         status.waiting("Waiting for kubernetes")
         log(str(e))
 
 
+def canal_units():
+    """Return how many canal units there are, this one included."""
+    return 1 + sum(
+        len(hookenv.related_units(relation_id))
+        for relation_id in hookenv.relation_ids(CANAL_PEER)
+    )
+
+
+@hook("canal-peer-relation-joined", "canal-peer-relation-departed")
+def scale_typha():
+    """Redeploy the policy controller manifest when Typha needs resizing."""
+    if hookenv.config("calico-datastore") != datastore.KUBERNETES:
+        return
+    if data_changed("calico.typha-replicas", datastore.typha_replicas(canal_units())):
+        remove_state("calico.npc.deployed")
+
+
+def applied_manifest_hash():
+    """Return the hash of the policy controller manifest last applied.
+
+    The objects are applied in manifest order, so the last one only carries the
+    hash once the whole manifest has been applied. Returns None if it doesn't
+    exist yet.
+    """
+    try:
+        output = kubectl(
+            "get",
+            "clusterrole",
+            "namespace-reader",
+            "--ignore-not-found",
+            "-o",
+            "jsonpath={.metadata.annotations.cdk-manifest-hash}",
+        )
+    except CalledProcessError:
+        return None
+    return output.decode("utf-8").strip() or None
+
+
 @when("etcd.available")
 @when_any("calico.service.installed", "calico.npc.deployed", "canal.cni.configured")
 def ensure_etcd_connections():
@@ -335,6 +713,14 @@ def ensure_etcd_connections():
     cert_changed = data_changed("calico_etcd_cert", etcd.get_client_credentials())
     if connection_changed or cert_changed:
         etcd.save_client_credentials(ETCD_KEY_PATH, ETCD_CERT_PATH, ETCD_CA_PATH)
+        if (
+            cert_changed
+            and is_flag_set("calico.service.installed")
+            and hookenv.config("calico-datastore") == datastore.ETCD
+        ):
+            # calico-node reads the credentials at start; new endpoints change
+            # its service, so they restart it anyway
+            restarts.restart("calico-node")
         # NB: dont bother guarding clear_flag with is_flag_set; it's safe to
         # clear an unset flag.
         clear_flag("calico.service.installed")
@@ -345,25 +731,18 @@ def ensure_etcd_connections():
         clear_flag("canal.cni.configured")
 
 
-def calicoctl(*args):
-    cmd = ["/opt/calicoctl/calicoctl"] + list(args)
+def etcd_client():
     etcd = endpoint_from_flag("etcd.available")
-    env = os.environ.copy()
-    env["ETCD_ENDPOINTS"] = etcd.get_connection_string()
-    env["ETCD_KEY_FILE"] = ETCD_KEY_PATH
-    env["ETCD_CERT_FILE"] = ETCD_CERT_PATH
-    env["ETCD_CA_CERT_FILE"] = ETCD_CA_PATH
-    try:
-        return check_output(cmd, env=env, stderr=STDOUT)
-    except CalledProcessError as e:
-        log(e.output)
-        raise
+    return etcdv3.client(
+        etcd_connection_string(etcd), ETCD_CERT_PATH, ETCD_KEY_PATH, ETCD_CA_PATH
+    )
 
 
-def kubectl(*args):
+def kubectl(*args, input=None):
+    add_snap_bin_to_path()
     cmd = ["kubectl", "--kubeconfig=/root/.kube/config"] + list(args)
     try:
-        return check_output(cmd)
+        return check_output(cmd, input=input)
     except CalledProcessError as e:
         log(e.output)
         raise
@@ -1,29 +1,53 @@
 import os
+import shutil
+import time
 import traceback
-from ipaddress import ip_network
 from shlex import split
-from subprocess import check_output, STDOUT
+from subprocess import STDOUT
 
 from charms.reactive import set_state, remove_state, when, when_not, hook
-from charms.reactive import when_any
+from charms.reactive import when_any, is_flag_set
 from charms.reactive import endpoint_from_flag
-from charmhelpers.core.templating import render
-from charmhelpers.core import hookenv
+from charmhelpers.core import hookenv, unitdata
 from charmhelpers.core.hookenv import config
 from charmhelpers.core.hookenv import application_version_set
-from charmhelpers.core.host import service_running
-from charmhelpers.contrib.charmsupport import nrpe
-
-from charms.layer import status
 
+from charms.layer import datastore, etcdv3, flannel_backend, flannel_lease
+from charms.layer import flannel_subnets, health, restarts
+from charms.layer import status, timing
+from charms.layer.canal import ETCD_RANKING_KEY, etcd_connection_string
+from charms.layer.canal import cni_kubeconfig_path, render_if_changed
+from charms.layer.flannel_lease import FlannelSubnetNotFound
+from charms.layer.timing import check_output, service_running
+from charms.leadership import leader_get, leader_set
 
 # This needs to match up with CALICOCTL_PATH in calico.py
 CALICOCTL_PATH = "/opt/calicoctl"
 ETCD_KEY_PATH = os.path.join(CALICOCTL_PATH, "etcd-key")
 ETCD_CERT_PATH = os.path.join(CALICOCTL_PATH, "etcd-cert")
 ETCD_CA_PATH = os.path.join(CALICOCTL_PATH, "etcd-ca")
+CNI_CONF_PATH = "/etc/cni/net.d/10-canal.conflist"
+
+MONITORED_SERVICES = health.MONITORED_SERVICES
+NAGIOS_PLUGINS_DIR = "/usr/local/lib/nagios/plugins"
+
+# how often to measure etcd endpoint latency, at most
+ETCD_PROBE_INTERVAL = 60
+
+# peer relation units coordinate restarts over
+RESTART_PEER = "canal-peer"
+# unitdata keys for the services this unit is waiting to restart, and the ids
+# of the last restart it requested and of the last one it finished
+RESTART_WAITING_KEY = "canal.restart.waiting"
+RESTART_REQUEST_KEY = "canal.restart.request"
+RESTART_DONE_KEY = "canal.restart.done"
+# how long a unit waits for its services to be healthy after restarting them
+# before leaving it to a later hook, and how often it checks meanwhile
+RESTART_VERIFY_TIMEOUT = 30
+RESTART_VERIFY_INTERVAL = 2
 
-MONITORED_SERVICES = ["flannel", "calico-node"]
+# time every handler reactive dispatches, once enable-handler-timing is set
+timing.install()
 
 
 @hook("upgrade-charm")
@@ -55,28 +79,137 @@ def configure_cni():
     """Configure Calico CNI."""
     status.maintenance("Configuring Calico CNI")
     try:
-        # Since CNI 1.2.0, the host-local plugin fails if configured with a
-        # subnet that has host bits set. Need to strip host bits here.
-        subnet = get_flannel_subnet(strip_host_bits=True)
+        render_cni_config()
     except FlannelSubnetNotFound:
         hookenv.log(traceback.format_exc())
         status.waiting("Waiting for Flannel")
         return
-    os.makedirs("/etc/cni/net.d", exist_ok=True)
+    except ValueError as e:
+        status.blocked(str(e))
+        return
+    set_state("canal.cni.configured")
+    if restarts.pending("flannel"):
+        # flannel rewrites its lease when it restarts at the end of the hook
+        restarts.after_restarts(refresh_cni_config)
+
+
+def render_cni_config():
+    """Render the CNI config from flannel's lease and publish it.
+
+    Raises: FlannelSubnetNotFound if flannel has no lease; ValueError if the
+        mtu option is larger than flannel carries
+    """
+    lease = flannel_lease.read_lease()
+    mtu = cni_mtu(lease)
     cni = endpoint_from_flag("cni.connected")
     etcd = endpoint_from_flag("etcd.available")
-    cni_config = cni.get_config()
     context = {
-        "connection_string": etcd.get_connection_string(),
+        "datastore": config("calico-datastore"),
+        "connection_string": etcd_connection_string(etcd),
         "etcd_key_path": ETCD_KEY_PATH,
         "etcd_cert_path": ETCD_CERT_PATH,
         "etcd_ca_path": ETCD_CA_PATH,
-        "kubeconfig_path": cni_config.get("kubeconfig_path", "/root/cdk/kubeconfig"),
-        "subnet": subnet,
+        "kubeconfig_path": cni_kubeconfig_path(cni),
+        # Since CNI 1.2.0, the host-local plugin fails if configured with a
+        # subnet that has host bits set. Need to strip host bits here.
+        "subnet": lease.subnet.network.exploded,
+        "mtu": mtu,
     }
-    render("10-canal.conflist", "/etc/cni/net.d/10-canal.conflist", context)
+    render_if_changed("10-canal.conflist", CNI_CONF_PATH, context)
     cni.set_config(cidr=config("cidr"), cni_conf_file="10-canal.conflist")
-    set_state("canal.cni.configured")
+
+
+def refresh_cni_config():
+    """Render the CNI config again from the lease flannel wrote on restart."""
+    try:
+        render_cni_config()
+    except (FlannelSubnetNotFound, ValueError) as e:
+        hookenv.log("Unable to refresh the CNI config: {}".format(e))
+        # configure it on the next hook, with status to match
+        remove_state("canal.cni.configured")
+
+
+@when("etcd.available", "calico.etcd-credentials.installed")
+def rank_etcd_endpoints():
+    """Order the etcd endpoints nearest first, for flannel, calico and CNI.
+
+    Every ETCD_PROBE_INTERVAL the endpoints are probed concurrently, and
+    unhealthy ones are left out until they recover, once enough probes in a
+    row confirm it. The services using them are reconfigured when the ranking
+    changes, which the hysteresis in rank_endpoints keeps rare.
+    """
+    etcd = endpoint_from_flag("etcd.available")
+    connection_string = etcd.get_connection_string()
+    endpoints = etcdv3.split_endpoints(connection_string)
+    if len(endpoints) < 2:
+        return
+    kv = unitdata.kv()
+    ranking = kv.get(ETCD_RANKING_KEY)
+    current = None
+    streaks = {}
+    if ranking and ranking["endpoints"] == connection_string:
+        if time.time() - ranking["probed"] < ETCD_PROBE_INTERVAL:
+            return
+        current = ranking["order"]
+        streaks = ranking.get("streaks", {})
+
+    latencies = etcdv3.endpoint_latencies(
+        endpoints, ETCD_CERT_PATH, ETCD_KEY_PATH, ETCD_CA_PATH
+    )
+    confirmed, streaks = etcdv3.confirm_health(latencies, current, streaks)
+    if any(endpoint in streaks for endpoint in current or []):
+        # a member failed a probe but isn't confirmed unhealthy yet; keep the
+        # ranking rather than reconfigure the services for it
+        order = list(current)
+    else:
+        order = etcdv3.rank_endpoints(confirmed, current)
+    kv.set(
+        ETCD_RANKING_KEY,
+        {
+            "endpoints": connection_string,
+            "order": order,
+            "probed": time.time(),
+            "streaks": streaks,
+        },
+    )
+    if order != (current or endpoints):
+        hookenv.log("etcd endpoints ranked {} by latency {}".format(order, latencies))
+        remove_state("calico.service.installed")
+        remove_state("flannel.service.installed")
+        remove_state("canal.cni.configured")
+
+
+@when("config.changed.mtu")
+def mtu_changed():
+    remove_state("canal.cni.configured")
+
+
+def cni_mtu(lease):
+    """Return the MTU for pod interfaces.
+
+    Flannel sets its lease MTU from the interface it binds to, less the
+    backend's overhead; if the lease lacks one, work it out the same way. The
+    mtu option may lower it, but never raise it past what flannel carries.
+    Raises: ValueError if the mtu option is larger than flannel carries
+    """
+    supported = lease.mtu or detect_mtu()
+    requested = config("mtu")
+    if not requested:
+        return supported
+    if supported and requested > supported:
+        raise ValueError(
+            "mtu {} is larger than the {} flannel carries".format(requested, supported)
+        )
+    return requested
+
+
+def detect_mtu():
+    """Return the pod MTU for flannel's interface, or None if unknown."""
+    iface = unitdata.kv().get(flannel_backend.IFACE_KEY)
+    link_mtu = flannel_backend.link_mtu(iface) if iface else None
+    if link_mtu is None:
+        return None
+    return flannel_backend.pod_mtu(link_mtu, config("flannel-backend"))
 
 
 @when("flannel.binaries.installed", "calico.binaries.installed")
@@ -99,30 +232,195 @@ def set_canal_version():
     set_state("canal.version.set")
 
 
-def get_failing_services():
-    failing_services = []
-    services = ["calico-node", "flannel"]
-    for service in services:
-        if not service_running(service):
-            failing_services.append(service)
-    return failing_services
-
-
 @when("flannel.service.started", "calico.service.installed", "calico.pool.configured")
-@when("canal.cni.configured")
+@when("flannel.network.configured", "canal.cni.configured")
+@when_not("calico.npc.invalid-config")
 def ready():
     """Indicate that canal is active."""
-    failing_services = get_failing_services()
-    if len(failing_services) > 0:
-        msg = "Waiting for service: {}".format(", ".join(failing_services))
+    if restarts.pending():
+        # judge the services once they have restarted, at the end of the hook
+        restarts.after_restarts(ready)
+        return
+    if is_flag_set("canal.restart.waiting"):
+        waiting = unitdata.kv().get(RESTART_WAITING_KEY, [])
+        status.waiting("Waiting for a slot to restart {}".format(", ".join(waiting)))
+        return
+    probe = health.probe(MONITORED_SERVICES, interface=flannel_interface())
+    if probe.failing_services:
+        msg = "Waiting for service: {}".format(", ".join(probe.failing_services))
         status.waiting(msg)
+    elif not probe.felix_ready:
+        status.waiting("Waiting for Felix to be ready")
+    elif not probe.flannel_ready:
+        status.waiting("Waiting for Flannel interface")
     else:
         try:
-            status.active("Flannel subnet " + get_flannel_subnet())
+            status.active("Flannel subnet " + get_flannel_subnet() + capacity())
         except FlannelSubnetNotFound:
             status.waiting("Waiting for Flannel")
 
 
+def capacity():
+    """Describe how many nodes and pods flannel's subnets fit, for the status.
+
+    With kubernetes managing the subnets, its pod CIDR allocation sets that.
+    """
+    if config("flannel-subnet-manager") == datastore.KUBERNETES:
+        return ""
+    try:
+        fits = flannel_subnets.capacity(
+            config("cidr"),
+            config("flannel-subnet-len"),
+            config("flannel-subnet-min"),
+            config("flannel-subnet-max"),
+        )
+    except flannel_subnets.InvalidSubnets:
+        return ""
+    return " (up to {} nodes of {} pods)".format(fits.nodes, fits.pods_per_node)
+
+
+def restart_gate(services):
+    """Let restarts of running services through one batch of units at a time.
+
+    With restart-batch-size set, a unit asks the leader for a restart slot over
+    the peer relation and holds its restarts until it is granted one. It gives
+    the slot back once flannel and Felix are healthy again. Restarts let
+    through without a slot release any wait for one.
+    """
+    batch_size = config("restart-batch-size")
+    if not batch_size or not hookenv.relation_ids(RESTART_PEER):
+        release_restart_slot()
+        return True
+    if not any(service_running(service) for service in services):
+        # nothing to disrupt
+        release_restart_slot()
+        return True
+
+    kv = unitdata.kv()
+    if not is_flag_set("canal.restart.waiting"):
+        request = kv.get(RESTART_REQUEST_KEY, 0) + 1
+        kv.set(RESTART_REQUEST_KEY, request)
+        publish_restart_state()
+    if hookenv.is_leader():
+        schedule_restarts()
+    if hookenv.local_unit() not in restart_grants():
+        waiting = set(kv.get(RESTART_WAITING_KEY, [])) | set(services)
+        kv.set(RESTART_WAITING_KEY, sorted(waiting, key=restarts.ORDER.index))
+        set_state("canal.restart.waiting")
+        return False
+
+    kv.unset(RESTART_WAITING_KEY)
+    remove_state("canal.restart.waiting")
+    set_state("canal.restart.verifying")
+    restarts.after_restarts(verify_restart)
+    return True
+
+
+restarts.set_gate(restart_gate)
+
+
+def restart_grants():
+    """Return the units the leader has granted a restart slot."""
+    return (leader_get("restart-grants") or "").split()
+
+
+def release_restart_slot():
+    """Stop waiting for a restart slot, and give back any this unit holds."""
+    kv = unitdata.kv()
+    kv.unset(RESTART_WAITING_KEY)
+    remove_state("canal.restart.waiting")
+    remove_state("canal.restart.verifying")
+    if kv.get(RESTART_REQUEST_KEY) != kv.get(RESTART_DONE_KEY):
+        kv.set(RESTART_DONE_KEY, kv.get(RESTART_REQUEST_KEY))
+        publish_restart_state()
+
+
+def publish_restart_state():
+    """Tell the leader which restart this unit asked for, and which it finished."""
+    kv = unitdata.kv()
+    for relation_id in hookenv.relation_ids(RESTART_PEER):
+        hookenv.relation_set(
+            relation_id,
+            {
+                "restart-request": kv.get(RESTART_REQUEST_KEY),
+                "restart-done": kv.get(RESTART_DONE_KEY),
+            },
+        )
+
+
+@when("canal.restart.waiting")
+def resume_restart():
+    """Restart the held services once the leader grants this unit a slot."""
+    if config("restart-batch-size") and hookenv.local_unit() not in restart_grants():
+        return
+    waiting = unitdata.kv().get(RESTART_WAITING_KEY, [])
+    for service in waiting:
+        restarts.restart(service)
+    if "flannel" in waiting:
+        # flannel rewrites its lease when it restarts
+        remove_state("canal.cni.configured")
+
+
+@when("canal.restart.verifying")
+def verify_restart():
+    """Give back this unit's restart slot once its services are healthy.
+
+    The services usually settle within seconds of restarting, so wait up to
+    RESTART_VERIFY_TIMEOUT for them rather than hold the slot until the next
+    hook.
+    """
+    if restarts.pending():
+        # verify_restart runs again once they have restarted
+        return
+    interface = flannel_interface()
+    deadline = time.monotonic() + RESTART_VERIFY_TIMEOUT
+    while True:
+        # a cached probe may predate the restart
+        probe = health.probe(MONITORED_SERVICES, ttl=0, interface=interface)
+        if not health.problems(probe, interface):
+            break
+        if time.monotonic() >= deadline:
+            hookenv.log("Waiting for services to be healthy after restarting")
+            return
+        time.sleep(RESTART_VERIFY_INTERVAL)
+    kv = unitdata.kv()
+    kv.set(RESTART_DONE_KEY, kv.get(RESTART_REQUEST_KEY))
+    publish_restart_state()
+    remove_state("canal.restart.verifying")
+    if hookenv.is_leader():
+        schedule_restarts()
+
+
+@hook(
+    "leader-elected",
+    "canal-peer-relation-changed",
+    "canal-peer-relation-departed",
+    "config-changed",
+)
+def coordinate_restarts():
+    if config("restart-batch-size") and hookenv.is_leader():
+        schedule_restarts()
+
+
+def schedule_restarts():
+    """Grant restart slots to the units waiting for one, as leader."""
+    kv = unitdata.kv()
+    waiting = []
+    if kv.get(RESTART_REQUEST_KEY) != kv.get(RESTART_DONE_KEY):
+        waiting.append(hookenv.local_unit())
+    for relation_id in hookenv.relation_ids(RESTART_PEER):
+        for unit in hookenv.related_units(relation_id):
+            data = hookenv.relation_get(unit=unit, rid=relation_id) or {}
+            if data.get("restart-request") != data.get("restart-done"):
+                waiting.append(unit)
+
+    granted = restart_grants()
+    grants = restarts.next_grants(waiting, granted, config("restart-batch-size"))
+    if grants != granted:
+        hookenv.log("Restart slots granted to {}".format(", ".join(grants) or "none"))
+        leader_set({"restart-grants": " ".join(grants) or None})
+
+
 @hook("stop")
 def stop():
     set_state("canal.stopping")
@@ -135,6 +433,8 @@ def stop():
 )
 @when_not("nrpe-external-master.initial-config")  # wokeignore:rule=master
 def configure_nrpe(unused=None):
+    from charmhelpers.contrib.charmsupport import nrpe
+
     hookenv.log(
         "Configuring nrpe checks for services: " "{}".format(MONITORED_SERVICES)
     )
@@ -144,6 +444,17 @@ def configure_nrpe(unused=None):
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname, primary=False)
     nrpe.add_init_service_checks(nrpe_setup, MONITORED_SERVICES, current_unit)
+
+    # the health lib doubles as a plugin checking the dataplane end to end
+    os.makedirs(NAGIOS_PLUGINS_DIR, exist_ok=True)
+    plugin = os.path.join(NAGIOS_PLUGINS_DIR, "check_canal_health")
+    shutil.copy(health.__file__, plugin)
+    os.chmod(plugin, 0o755)
+    nrpe_setup.add_check(
+        shortname="canal_health",
+        description="Canal dataplane health {}".format(current_unit),
+        check_cmd="check_canal_health {}".format(flannel_interface() or "none"),
+    )
     nrpe_setup.write()
 
     set_state("nrpe-external-master.initial-config")  # wokeignore:rule=master
@@ -158,29 +469,24 @@ def update_nagios():
 @when_not("nrpe-external-master.available")  # wokeignore:rule=master
 @when("nrpe-external-master.initial-config")  # wokeignore:rule=master
 def remove_nrpe_config():
+    from charmhelpers.contrib.charmsupport import nrpe
+
     hookenv.log("Removing nrpe checks for services: " "{}".format(MONITORED_SERVICES))
     hostname = nrpe.get_nagios_hostname()
     nrpe_setup = nrpe.NRPE(hostname=hostname, primary=False)
 
-    for check in MONITORED_SERVICES:
+    for check in MONITORED_SERVICES + ["canal_health"]:
         nrpe_setup.remove_check(shortname=check)
     nrpe_setup.write()
 
     remove_state("nrpe-external-master.initial-config")  # wokeignore:rule=master
 
 
-def get_flannel_subnet(strip_host_bits=False):
-    """Returns the flannel subnet reserved for this unit"""
-    try:
-        with open("/run/flannel/subnet.env") as f:
-            raw_data = dict(line.strip().split("=") for line in f)
-        subnet = raw_data["FLANNEL_SUBNET"]
-        if strip_host_bits:
-            subnet = ip_network(subnet, strict=False).exploded
-        return subnet
-    except FileNotFoundError as e:
-        raise FlannelSubnetNotFound() from e
+def flannel_interface():
+    """Return the interface of the running flannel backend, if it has one."""
+    return unitdata.kv().get(flannel_backend.INTERFACE_KEY, health.FLANNEL_INTERFACE)
 
 
-class FlannelSubnetNotFound(Exception):
-    pass
+def get_flannel_subnet():
+    """Returns the flannel subnet reserved for this unit"""
+    return str(flannel_lease.read_lease().subnet)
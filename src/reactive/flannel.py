@@ -1,79 +1,100 @@
 import os
 import json
-import shutil
-from shlex import split
-from subprocess import check_output, check_call, CalledProcessError
+from functools import partial
+from ipaddress import ip_network
+from socket import gethostname
+from subprocess import CalledProcessError, STDOUT
 
-from charms.layer.canal import arch, retry
+from charms.layer.canal import arch, retry, fetch_binaries, ResourceError
+from charms.layer.canal import add_snap_bin_to_path, cni_kubeconfig_path
+from charms.layer.canal import config_revision, etcd_connection_string
+from charms.layer.canal import render_if_changed, write_if_changed
+from charms.leadership import leader_get, leader_set
 
 from charms.reactive import set_state, remove_state, when, when_not, hook
+from charms.reactive import when_any
 from charms.reactive import endpoint_from_flag
 from charms.reactive.flags import clear_flag
 from charms.reactive.helpers import data_changed
-from charmhelpers.core.templating import render
-from charmhelpers.core.host import service_start, service_stop, service_restart
-from charmhelpers.core.host import service_running, service
-from charmhelpers.core.hookenv import log, resource_get, config
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import log, config, is_leader
 from charmhelpers.core.hookenv import network_get
 
-from charms.layer import status
-
+from charms.layer import datastore, etcdv3, flannel_backend, flannel_lease
+from charms.layer import flannel_subnets, pipeline, restarts, status
+from charms.layer.etcdv3 import EtcdError
+from charms.layer.timing import check_output, check_call
+from charms.layer.timing import service_stop, service
 
 ETCD_PATH = "/etc/ssl/flannel"
 ETCD_KEY_PATH = os.path.join(ETCD_PATH, "client-key.pem")
 ETCD_CERT_PATH = os.path.join(ETCD_PATH, "client-cert.pem")
 ETCD_CA_PATH = os.path.join(ETCD_PATH, "client-ca.pem")
+FLANNEL_SERVICE_PATH = "/lib/systemd/system/flannel.service"
+# the network config flanneld reads when kubernetes manages its subnets
+FLANNEL_NET_CONF_PATH = "/etc/kube-flannel/net-conf.json"
+# where flannel's etcd subnet manager keeps its config and leases
+FLANNEL_NETWORK_KEY = "/coreos.com/network/config"
+FLANNEL_SUBNETS_PREFIX = "/coreos.com/network/subnets/"
+
+# archive member name to install path
+FLANNEL_BINARIES = {
+    "flanneld": "/usr/local/bin/flanneld",
+    "etcdctl": "/usr/local/bin/etcdctl",
+    "cni-plugin/flannel": "/opt/cni/bin/flannel",
+}
+FLANNEL_VERSION_KEY = "canal.flannel.version"
+# unitdata key for the digests of the installed flannel binaries
+FLANNEL_BINARIES_KEY = "canal.flannel.binaries"
+# unitdata keys for the subnet manager flannel last started with, and for the
+# etcd lease it held before kubernetes took over its subnet
+FLANNEL_SUBNET_MANAGER_KEY = "canal.flannel.subnet-manager"
+FLANNEL_ETCD_LEASE_KEY = "canal.flannel.etcd-lease"
 
 
 @when_not("flannel.binaries.installed")
 def install_flannel_binaries():
-    """Unpack the Flannel binaries."""
+    """Unpack the Flannel binaries, alongside the other pending install steps."""
+    pipeline.run()
+
+
+def prepare_flannel_binaries():
     # on intel, the resource is called 'flannel'; other arches have a suffix
     architecture = arch()
     if architecture == "amd64":
         resource_name = "flannel"
     else:
         resource_name = "flannel-{}".format(architecture)
+    cached = unitdata.kv().get(FLANNEL_BINARIES_KEY)
+    return partial(fetch_binaries, resource_name, "flannel", FLANNEL_BINARIES, cached)
 
+
+def finish_flannel_binaries(fetched):
     try:
-        archive = resource_get(resource_name)
-    except Exception:
-        message = "Error fetching the flannel resource."
-        log(message)
-        status.blocked(message)
-        return
-    if not archive:
-        message = "Missing flannel resource."
-        log(message)
-        status.blocked(message)
+        cached = fetched()
+    except ResourceError as e:
+        log("{}: {}".format(e, e.__cause__) if e.__cause__ else str(e))
+        status.blocked(str(e))
         return
-    filesize = os.stat(archive).st_size
-    if filesize < 1000000:
-        message = "Incomplete flannel resource"
-        log(message)
-        status.blocked(message)
-        return
-    status.maintenance("Unpacking flannel resource.")
-    charm_dir = os.getenv("CHARM_DIR")
-    unpack_path = os.path.join(charm_dir, "files", "flannel")
-    os.makedirs(unpack_path, exist_ok=True)
-    cmd = ["tar", "xfz", archive, "-C", unpack_path]
-    log(cmd)
-    check_call(cmd)
-    apps = [
-        {"name": "flanneld", "path": "/usr/local/bin"},
-        {"name": "etcdctl", "path": "/usr/local/bin"},
-    ]
-    for app in apps:
-        unpacked = os.path.join(unpack_path, app["name"])
-        app_path = os.path.join(app["path"], app["name"])
-        install = ["install", "-v", "-D", unpacked, app_path]
-        check_call(install)
-    os.makedirs("/opt/cni/bin", exist_ok=True)
-    shutil.copy(unpack_path + "/cni-plugin/flannel", "/opt/cni/bin")
+    if cached is None:
+        log("flannel resource unchanged, binaries already installed")
+    else:
+        kv = unitdata.kv()
+        kv.set(FLANNEL_BINARIES_KEY, cached)
+        # a new flanneld may support different backends
+        kv.unset(FLANNEL_VERSION_KEY)
+        remove_state("flannel.service.started")
     set_state("flannel.binaries.installed")
 
 
+pipeline.add_step(
+    "flannel binaries",
+    "flannel.binaries.installed",
+    prepare_flannel_binaries,
+    finish_flannel_binaries,
+)
+
+
 @when("etcd.tls.available")
 @when_not("flannel.etcd.credentials.installed")
 def install_etcd_credentials(etcd):
@@ -125,8 +146,21 @@ def get_bind_address_interface():
 )
 @when_not("flannel.service.installed")
 def install_flannel_service():
-    """Install the flannel service."""
+    """Install the flannel service.
+
+    When kubernetes manages flannel's subnets, the service only switches over
+    once kubernetes has allocated this node a pod CIDR; until then flannel
+    keeps the subnet manager it runs with.
+    """
     status.maintenance("Installing flannel service.")
+    subnet_manager = config("flannel-subnet-manager")
+    if subnet_manager not in datastore.DATASTORES:
+        status.blocked(
+            "flannel-subnet-manager must be one of {}".format(
+                ", ".join(datastore.DATASTORES)
+            )
+        )
+        return
 
     # keep track of our etcd connections so we can detect when it changes later
     etcd = endpoint_from_flag("etcd.tls.available")
@@ -135,15 +169,46 @@ def install_flannel_service():
     data_changed("flannel_etcd_cert", etcd.get_client_credentials())
 
     iface = config("iface") or get_bind_address_interface()
+    unitdata.kv().set(flannel_backend.IFACE_KEY, iface)
     context = {
         "iface": iface,
-        "connection_string": etcd_connections,
+        "subnet_manager": subnet_manager,
+        "connection_string": etcd_connection_string(etcd),
         "cert_path": ETCD_PATH,
     }
-    render("flannel.service", "/lib/systemd/system/flannel.service", context)
-    service("enable", "flannel")
+    if subnet_manager == datastore.KUBERNETES:
+        cni = endpoint_from_flag("cni.connected")
+        if not cni:
+            status.waiting("Waiting for the cni relation to reach kubernetes")
+            return
+        kubeconfig_path = cni_kubeconfig_path(cni)
+        try:
+            pod_cidr = node_pod_cidr(kubeconfig_path)
+        except CalledProcessError:
+            status.waiting("Waiting for kubernetes to register this node")
+            return
+        if not pod_cidr:
+            status.waiting("Waiting for kubernetes to allocate a pod CIDR")
+            return
+        try:
+            inside = ip_network(pod_cidr).subnet_of(ip_network(config("cidr")))
+        except (TypeError, ValueError):
+            inside = False
+        if not inside:
+            status.blocked("Node pod CIDR {} is outside cidr".format(pod_cidr))
+            return
+        context.update(
+            kubeconfig_path=kubeconfig_path,
+            node_name=gethostname(),
+            net_config_path=FLANNEL_NET_CONF_PATH,
+        )
+    if render_if_changed("flannel.service", FLANNEL_SERVICE_PATH, context):
+        restarts.daemon_reload()
+        service("enable", "flannel")
+        remove_state("flannel.service.started")
+    else:
+        log("flannel service unchanged, not restarting")
     set_state("flannel.service.installed")
-    remove_state("flannel.service.started")
 
 
 @when("config.changed.iface")
@@ -152,50 +217,147 @@ def reconfigure_flannel_service():
     remove_state("flannel.service.installed")
 
 
+@when("config.changed.flannel-subnet-manager")
+def subnet_manager_changed():
+    """Move flannel between subnet managers.
+
+    The leases don't move: pods keep the addresses they have until they are
+    recreated in the subnet the new manager gives the node.
+    """
+    remove_state("flannel.service.installed")
+    remove_state("flannel.network.configured")
+    # the policy controller manifest grants flannel access to the nodes
+    remove_state("calico.npc.deployed")
+
+
+def node_pod_cidr(kubeconfig_path):
+    """Return the pod CIDR kubernetes allocated this node, or None if none yet.
+
+    Raises: CalledProcessError if the node can't be read
+    """
+    add_snap_bin_to_path()
+    output = check_output(
+        [
+            "kubectl",
+            "--kubeconfig={}".format(kubeconfig_path),
+            "get",
+            "node",
+            gethostname(),
+            "-o",
+            "jsonpath={.spec.podCIDR}",
+        ]
+    )
+    return output.decode("utf-8").strip() or None
+
+
 @when(
     "flannel.binaries.installed", "flannel.etcd.credentials.installed", "etcd.available"
 )
 @when_not("flannel.network.configured")
 def invoke_configure_network(etcd):
-    """invoke network configuration and adjust states"""
+    """invoke network configuration and adjust states
+
+    Only the leader writes the network config to etcd. It then publishes the
+    revision it wrote, and the other units wait until the leader has written
+    the revision they expect. When kubernetes manages flannel's subnets, each
+    unit writes the network config for its own flanneld instead.
+    """
     status.maintenance("Negotiating flannel network subnet.")
-    if configure_network(etcd):
-        set_state("flannel.network.configured")
+    try:
+        revision = config_revision(network_config())
+    except flannel_backend.InvalidBackend as e:
+        status.blocked("Invalid flannel backend: {}".format(e))
+        return
+    except flannel_subnets.InvalidSubnets as e:
+        status.blocked("Invalid flannel subnets: {}".format(e))
+        return
+    if config("flannel-subnet-manager") == datastore.KUBERNETES:
+        data = json.dumps(network_config(), indent=2, sort_keys=True) + "\n"
+        write_if_changed(FLANNEL_NET_CONF_PATH, data.encode("utf-8"), 0o644)
+    elif is_leader():
+        if not configure_network(etcd):
+            status.waiting("Waiting on etcd.")
+            return
+        leader_set({"flannel-network-revision": revision})
+    elif leader_get("flannel-network-revision") != revision:
+        status.waiting("Waiting for leader to configure flannel network.")
+        return
+    set_state("flannel.network.configured")
+    # flannel only reads the network config on start
+    if data_changed("flannel-network-revision", revision):
         remove_state("flannel.service.started")
-    else:
-        status.waiting("Waiting on etcd.")
 
 
-@retry(times=3, delay_secs=20)
+def network_config():
+    """Return the flannel network config for this deployment.
+
+    Raises: InvalidBackend if the flannel-backend options are invalid;
+        InvalidSubnets if the flannel-subnet options don't fit cidr
+    """
+    subnets = flannel_subnets.subnet_config(
+        config("cidr"),
+        config("flannel-subnet-len"),
+        config("flannel-subnet-min"),
+        config("flannel-subnet-max"),
+    )
+    backend = flannel_backend.backend_config(
+        config("flannel-backend"), config("flannel-backend-options"), flannel_version()
+    )
+    return {"Network": config("cidr"), **subnets, "Backend": backend}
+
+
+def flannel_version():
+    """Return the installed flanneld version as a tuple, or None if unknown."""
+    kv = unitdata.kv()
+    version = kv.get(FLANNEL_VERSION_KEY)
+    if version is None:
+        try:
+            output = check_output(["flanneld", "-version"], stderr=STDOUT)
+        except (CalledProcessError, OSError) as e:
+            log("Unable to get the flannel version: {}".format(e))
+            return None
+        version = flannel_backend.parse_version(output.decode("utf-8"))
+        kv.set(FLANNEL_VERSION_KEY, version)
+    return tuple(version) if version else None
+
+
+@retry(attempts=5, base_delay=10, max_delay=60, deadline=600)
 def configure_network(etcd):
     """Store initial flannel data in etcd.
 
     Returns True if the operation completed successfully.
 
     """
-    data = json.dumps({"Network": config("cidr"), "Backend": {"Type": "vxlan"}})
-    cmd = "etcdctl "
-    cmd += "--endpoints '{0}' ".format(etcd.get_connection_string())
-    cmd += "--cert {0} ".format(ETCD_CERT_PATH)
-    cmd += "--key {0} ".format(ETCD_KEY_PATH)
-    cmd += "--cacert {0} ".format(ETCD_CA_PATH)
-    cmd += "put /coreos.com/network/config '{0}'".format(data)
-    env = dict(os.environ, ETCDCTL_API="3")
+    data = json.dumps(network_config())
+    client = etcdv3.client(
+        etcd_connection_string(etcd), ETCD_CERT_PATH, ETCD_KEY_PATH, ETCD_CA_PATH
+    )
     try:
-        check_call(split(cmd), env=env)
+        client.put(FLANNEL_NETWORK_KEY, data)
         return True
 
-    except CalledProcessError:
+    except EtcdError as e:
         log(
-            "Unexpected error configuring network. Assuming etcd not"
-            " ready. Will retry in 20s"
+            "Unexpected error configuring network: {}. Assuming etcd not"
+            " ready.".format(e)
         )
         return False
 
 
-@when("config.changed.cidr")
+@when_any(
+    "config.changed.cidr",
+    "config.changed.flannel-backend",
+    "config.changed.flannel-backend-options",
+    "config.changed.flannel-subnet-len",
+    "config.changed.flannel-subnet-min",
+    "config.changed.flannel-subnet-max",
+)
 def reconfigure_network():
-    """Trigger the network configuration method."""
+    """Trigger the network configuration method.
+
+    The leader rewrites the network config, then each unit restarts flannel
+    once it sees the new revision.
+    """
     remove_state("flannel.network.configured")
 
 
@@ -208,13 +370,86 @@ def reconfigure_network():
 def start_flannel_service():
     """Start the flannel service."""
     status.maintenance("Starting flannel service.")
-    if service_running("flannel"):
-        service_restart("flannel")
-    else:
-        service_start("flannel")
+    kv = unitdata.kv()
+    try:
+        interface = flannel_backend.interface(network_config()["Backend"])
+    except flannel_backend.InvalidBackend as e:
+        status.blocked("Invalid flannel backend: {}".format(e))
+        return
+    except flannel_subnets.InvalidSubnets as e:
+        status.blocked("Invalid flannel subnets: {}".format(e))
+        return
+    # charms that predate backend selection always ran vxlan on flannel.1
+    previous = kv.get(flannel_backend.INTERFACE_KEY, "flannel.1")
+    if previous != interface:
+        log("flannel interface changed from {} to {}".format(previous, interface))
+        # the old backend's interface would keep routes to the other nodes
+        service_stop("flannel")
+        if previous:
+            remove_interface(previous)
+        # the health check follows the backend
+        clear_flag("nrpe-external-master.initial-config")  # wokeignore:rule=master
+    subnet_manager = config("flannel-subnet-manager")
+    previous_manager = kv.get(FLANNEL_SUBNET_MANAGER_KEY, datastore.ETCD)
+    if previous_manager == datastore.ETCD and subnet_manager == datastore.KUBERNETES:
+        # give the etcd lease back once flanneld runs from the node's pod CIDR
+        try:
+            subnet = flannel_lease.read_lease().subnet.network
+        except flannel_lease.FlannelSubnetNotFound:
+            subnet = None
+        if subnet:
+            kv.set(FLANNEL_ETCD_LEASE_KEY, subnet.with_prefixlen.replace("/", "-"))
+    elif subnet_manager == datastore.ETCD:
+        kv.unset(FLANNEL_ETCD_LEASE_KEY)
+    # flannel rewrites its lease on start, and the CNI MTU comes from it
+    clear_flag("canal.cni.configured")
+    restarts.restart("flannel")
+    kv.set(flannel_backend.INTERFACE_KEY, interface)
+    kv.set(FLANNEL_SUBNET_MANAGER_KEY, subnet_manager)
     set_state("flannel.service.started")
 
 
+@when("flannel.service.started", "etcd.available")
+def release_etcd_lease_after_restart():
+    """Release the etcd lease flannel held, once it restarts without it.
+
+    The restart may be held for a restart slot, so this waits for whichever
+    hook flannel actually restarts in.
+    """
+    if unitdata.kv().get(FLANNEL_ETCD_LEASE_KEY):
+        restarts.after_restarts(release_etcd_lease)
+
+
+def release_etcd_lease():
+    if not restarts.restarted("flannel"):
+        return
+    kv = unitdata.kv()
+    key = FLANNEL_SUBNETS_PREFIX + kv.get(FLANNEL_ETCD_LEASE_KEY)
+    etcd = endpoint_from_flag("etcd.available")
+    client = etcdv3.client(
+        etcd_connection_string(etcd), ETCD_CERT_PATH, ETCD_KEY_PATH, ETCD_CA_PATH
+    )
+    try:
+        client.delete(key)
+    except EtcdError as e:
+        # it expires on its own soon enough
+        log("Unable to release flannel lease {}: {}".format(key, e))
+    else:
+        log("Released flannel lease {}".format(key))
+    kv.unset(FLANNEL_ETCD_LEASE_KEY)
+
+
+def remove_interface(name):
+    """Take down and delete a network interface, returning True on success."""
+    try:
+        check_call(["ip", "link", "set", name, "down"])
+        check_call(["ip", "link", "delete", name])
+    except CalledProcessError:
+        log("Unable to remove iface {}".format(name))
+        return False
+    return True
+
+
 @when_not("etcd.connected")
 def halt_execution():
     """send a clear message to the user that we are waiting on etcd"""
@@ -247,7 +482,6 @@ def ensure_etcd_connections():
 def reset_states_and_redeploy():
     """Remove state and redeploy"""
     remove_state("flannel.binaries.installed")
-    remove_state("flannel.service.started")
     remove_state("flannel.network.configured")
     remove_state("flannel.service.installed")
 
@@ -256,18 +490,14 @@ def reset_states_and_redeploy():
 def cleanup_deployment():
     """Terminate services, and remove the deployed bins"""
     service_stop("flannel")
-    down = "ip link set flannel.1 down"
-    delete = "ip link delete flannel.1"
-    try:
-        check_call(split(down))
-        check_call(split(delete))
-    except CalledProcessError:
-        log("Unable to remove iface flannel.1")
+    interface = unitdata.kv().get(flannel_backend.INTERFACE_KEY, "flannel.1")
+    if interface and not remove_interface(interface):
         log("Potential indication that cleanup is not possible")
     files = [
         "/usr/local/bin/flanneld",
         "/lib/systemd/system/flannel",
-        "/lib/systemd/system/flannel.service",
+        FLANNEL_SERVICE_PATH,
+        FLANNEL_NET_CONF_PATH,
         "/run/flannel/subnet.env",
         "/usr/local/bin/flanneld",
         "/usr/local/bin/etcdctl",
@@ -0,0 +1,755 @@
+"""A simulated unit for benchmarking the canal handler graph.
+
+The handlers in src/reactive run for real, dispatched by a small stand-in for
+charms.reactive. Everything they reach outside of the charm is replaced:
+Juju hook tools, systemd, subprocesses, the container runtime and etcd are
+in-process fakes that record each call, and absolute paths are rerooted under
+a temporary directory. That makes the wall time of a dispatch and the number
+of external commands it runs cheap to measure and deterministic.
+
+Run with `tox -e benchmark`. This suite replaces modules the unit tests mock,
+so it must not share a pytest process with tests/unit.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import time
+import types
+from collections import Counter, namedtuple
+from pathlib import Path
+from unittest import mock
+
+import jinja2
+import pytest
+import yaml
+
+SRC = Path(__file__).parents[2] / "src"
+
+# the unit being dispatched; the fake modules delegate to it
+_unit = None
+
+# every scenario measured this session, for the report
+_results = []
+
+Measurement = namedtuple(
+    "Measurement", ["scenario", "wall_time", "commands", "etcd_requests", "hook_tools"]
+)
+
+
+def _current():
+    if _unit is None:
+        raise RuntimeError("no unit is being dispatched")
+    return _unit
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+# charms.reactive
+
+
+class Handler:
+    def __init__(self, func):
+        self.func = func
+        self.hooks = []
+        self.predicates = []
+        self.args = []
+        self.watched = set()
+        self.invoked_at = None
+
+    @property
+    def _action(self):
+        return self.func
+
+    def test(self, flags):
+        return all(predicate(flags) for predicate in self.predicates)
+
+    def invoke(self):
+        unit = _current()
+        args = [
+            unit.endpoints[flag.split(".")[0]]
+            for flag in self.args
+            if flag.split(".")[0] in unit.endpoints
+        ]
+        # like reactive, handlers that take no args aren't passed any
+        self.func(*args if self.func.__code__.co_argcount else [])
+
+
+_handlers = {}
+
+
+def _handler(func):
+    if func not in _handlers:
+        _handlers[func] = Handler(func)
+    return _handlers[func]
+
+
+def _flag_decorator(test, pass_args=False):
+    def decorator(*flags):
+        def register(func):
+            handler = _handler(func)
+            handler.predicates.append(lambda current: test(f in current for f in flags))
+            handler.watched.update(flags)
+            if pass_args:
+                handler.args.extend(flags)
+            return func
+
+        return register
+
+    return decorator
+
+
+def hook(*names):
+    def register(func):
+        _handler(func).hooks.extend(names)
+        return func
+
+    return register
+
+
+def set_flag(flag):
+    _current().set_flag(flag)
+
+
+def clear_flag(flag):
+    _current().clear_flag(flag)
+
+
+def toggle_flag(flag, value):
+    set_flag(flag) if value else clear_flag(flag)
+
+
+def is_flag_set(flag):
+    return flag in _current().flags
+
+
+def endpoint_from_flag(flag):
+    unit = _current()
+    if flag not in unit.flags:
+        return None
+    return unit.endpoints.get(flag.split(".")[0])
+
+
+def data_changed(key, data):
+    kv = _current().kv
+    digest = hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest()
+    changed = kv.get("reactive.data_changed." + key) != digest
+    kv["reactive.data_changed." + key] = digest
+    return changed
+
+
+_reactive = {
+    "when": _flag_decorator(all, pass_args=True),
+    "when_all": _flag_decorator(all, pass_args=True),
+    "when_any": _flag_decorator(any),
+    "when_not": _flag_decorator(lambda found: not any(found)),
+    "when_none": _flag_decorator(lambda found: not any(found)),
+    "when_not_all": _flag_decorator(lambda found: not all(found)),
+    "hook": hook,
+    "set_flag": set_flag,
+    "set_state": set_flag,
+    "clear_flag": clear_flag,
+    "remove_state": clear_flag,
+    "toggle_flag": toggle_flag,
+    "is_flag_set": is_flag_set,
+    "is_state": is_flag_set,
+    "endpoint_from_flag": endpoint_from_flag,
+    "data_changed": data_changed,
+}
+
+
+# Juju and the host
+
+
+class FakeEtcd:
+    """An in-process etcd keyspace, speaking the etcdv3.Client API."""
+
+    def __init__(self):
+        self.data = {}
+        self.revision = 1
+        self.requests = 0
+
+    def get(self, key):
+        self.requests += 1
+        return self.data.get(key, (None,))[0]
+
+    def get_prefix(self, prefix):
+        from charms.layer.etcdv3 import KeyValue
+
+        self.requests += 1
+        return [
+            KeyValue(key, value, revision)
+            for key, (value, revision) in sorted(self.data.items())
+            if key.startswith(prefix)
+        ]
+
+    def _put(self, key, value):
+        self.revision += 1
+        self.data[key] = (value, self.revision)
+
+    def put(self, key, value):
+        self.requests += 1
+        self._put(key, value)
+
+    def delete(self, key):
+        self.requests += 1
+        self.data.pop(key, None)
+
+    def txn(self, compare, success, failure=()):
+        self.requests += 1
+
+        def decode(value):
+            return base64.b64decode(value).decode()
+
+        succeeded = all(
+            self.data.get(decode(c["key"]), (None, 0))[1] == int(c["mod_revision"])
+            for c in compare
+        )
+        for op in success if succeeded else failure:
+            if "request_put" in op:
+                put = op["request_put"]
+                self._put(decode(put["key"]), decode(put["value"]))
+            else:
+                self.data.pop(decode(op["request_delete_range"]["key"]), None)
+        return succeeded
+
+
+class EtcdEndpoint:
+    def __init__(self):
+        self.connection_string = "https://10.0.0.2:2379"
+        self.credentials = {
+            "client_cert": "cert",
+            "client_key": "key",
+            "client_ca": "ca",
+        }
+
+    def get_connection_string(self):
+        return self.connection_string
+
+    def get_client_credentials(self):
+        return dict(self.credentials)
+
+    def save_client_credentials(self, key, cert, ca):
+        for path, name in [
+            (key, "client_key"),
+            (cert, "client_cert"),
+            (ca, "client_ca"),
+        ]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(self.credentials[name])
+
+
+class CniEndpoint:
+    def __init__(self):
+        self.config = {}
+
+    def get_config(self):
+        return {"kubeconfig_path": "/root/cdk/kubeconfig"}
+
+    def set_config(self, **config):
+        self.config = config
+
+
+class ContainerRuntime:
+    def pull(self, image):
+        _current().record_command(["ctr", "image", "pull", image])
+
+    def load(self, path):
+        _current().record_command(["ctr", "image", "import", path])
+
+
+def _hook_tool(name, result=None):
+    def tool(*args, **kwargs):
+        _current().hook_tools[name] += 1
+        return result(*args, **kwargs) if result else None
+
+    return tool
+
+
+def _config(key=None):
+    config = _current().config
+    return config if key is None else config.get(key)
+
+
+def _leader_get(key=None):
+    settings = _current().leader_settings
+    return dict(settings) if key is None else settings.get(key)
+
+
+def _leader_set(settings=None, **kwargs):
+    unit = _current()
+    for key, value in dict(settings or {}, **kwargs).items():
+        if value is None:
+            unit.leader_settings.pop(key, None)
+            unit.clear_flag("leadership.set." + key)
+        else:
+            unit.leader_settings[key] = value
+            unit.set_flag("leadership.set." + key)
+
+
+def _network_get(binding):
+    return {
+        "bind-addresses": [
+            {"interfacename": "ens3", "addresses": [{"address": "10.0.0.10"}]}
+        ]
+    }
+
+
+def _render(source, target, context, **kwargs):
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(SRC / "templates")))
+    content = env.get_template(source).render(context)
+    if target is not None:
+        path = _current().path(target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    return content
+
+
+def _service(action, name, **kwargs):
+    unit = _current()
+    unit.record_command(["systemctl", action, name])
+    if action in ("start", "restart"):
+        unit.start_service(name)
+    elif action == "stop":
+        unit.services[name] = "inactive"
+    return True
+
+
+def _service_running(name, **kwargs):
+    _current().record_command(["systemctl", "is-active", name])
+    return _current().services.get(name) == "active"
+
+
+def _run(args, **kwargs):
+    output = _current().record_command(args)
+    if kwargs.get("universal_newlines") or kwargs.get("text"):
+        output = output.decode()
+    return subprocess.CompletedProcess(args, 0, stdout=output, stderr="")
+
+
+def _check_call(args, **kwargs):
+    _current().record_command(args)
+    return 0
+
+
+def _check_output(args, **kwargs):
+    return _current().record_command(args, kwargs.get("input"))
+
+
+def install_fakes():
+    """Put the fake framework, Juju and host modules in place."""
+    _module("charms.reactive", **_reactive)
+    _module("charms.reactive.flags", **_reactive)
+    _module("charms.reactive.helpers", **_reactive)
+    _module("charms.reactive.bus", Handler=Handler)
+    _module("charms.leadership", leader_get=_leader_get, leader_set=_leader_set)
+    _module(
+        "charms.layer.status",
+        **{
+            state: _hook_tool(
+                "status-set", lambda msg, state=state: _current().set_status(state, msg)
+            )
+            for state in ("maintenance", "waiting", "blocked", "active")
+        },
+    )
+    _module("conctl", getContainerRuntimeCtl=ContainerRuntime)
+
+    _module("charmhelpers")
+    _module("charmhelpers.core")
+    _module(
+        "charmhelpers.core.hookenv",
+        config=_config,
+        log=lambda *args, **kwargs: None,
+        hook_name=lambda: _current().hook,
+        charm_dir=lambda: str(SRC),
+        local_unit=lambda: "canal/0",
+        atexit=lambda callback, *args: _current().atexit.append((callback, args)),
+        is_leader=_hook_tool("is-leader", lambda: _current().leader),
+        resource_get=_hook_tool("resource-get", lambda n: _current().resources.get(n)),
+        network_get=_hook_tool("network-get", _network_get),
+        unit_private_ip=_hook_tool("unit-get", lambda: "10.0.0.10"),
+        application_version_set=_hook_tool("application-version-set"),
+        env_proxy_settings=lambda *args: {},
+        relation_ids=_hook_tool("relation-ids", lambda name: []),
+        relation_set=_hook_tool("relation-set"),
+    )
+    _module("charmhelpers.core.unitdata", kv=lambda: _current().kv)
+    _module(
+        "charmhelpers.core.host",
+        service=_service,
+        service_start=lambda name, **kw: _service("start", name),
+        service_stop=lambda name, **kw: _service("stop", name),
+        service_restart=lambda name, **kw: _service("restart", name),
+        service_running=_service_running,
+    )
+    _module("charmhelpers.core.templating", render=_render)
+
+
+def load_handlers():
+    """Import the reactive modules, registering their handlers in order."""
+    for name in [
+        n for n in sys.modules if n.startswith(("reactive.", "charms.layer."))
+    ]:
+        if name != "charms.layer.status":
+            del sys.modules[name]
+    _handlers.clear()
+    # the timing wrappers capture these at import
+    with mock.patch.object(subprocess, "check_call", _check_call), mock.patch.object(
+        subprocess, "check_output", _check_output
+    ), mock.patch.object(subprocess, "run", _run):
+        import reactive.calico  # noqa: F401
+        import reactive.canal  # noqa: F401
+        import reactive.flannel  # noqa: F401
+
+    return (
+        sys.modules["reactive.calico"],
+        sys.modules["reactive.canal"],
+        sys.modules["reactive.flannel"],
+    )
+
+
+class KV(dict):
+    def set(self, key, value):
+        self[key] = value
+
+    def unset(self, key):
+        self.pop(key, None)
+
+    def flush(self):
+        pass
+
+
+class Unit:
+    """A simulated machine running the canal subordinate."""
+
+    def __init__(self, root, leader=True):
+        self.root = Path(root)
+        self.leader = leader
+        self.flags = set()
+        self.flag_changes = Counter()
+        self.kv = KV()
+        self.config = {
+            key: option.get("default")
+            for key, option in yaml.safe_load((SRC / "config.yaml").read_text())[
+                "options"
+            ].items()
+        }
+        self._applied_config = {}
+        self.leader_settings = {}
+        self.services = {}
+        self.endpoints = {"etcd": EtcdEndpoint(), "cni": CniEndpoint()}
+        self.etcd = FakeEtcd()
+        self.resources = {
+            "flannel": self._archive(
+                "flannel", ["flanneld", "etcdctl", "cni-plugin/flannel"]
+            ),
+            "calico": self._archive("calico", ["calico", "calico-ipam", "calicoctl"]),
+            "calico-node-image": "",
+        }
+        self.hook = None
+        self.atexit = []
+        self.status = None
+        self.commands = []
+        self.hook_tools = Counter()
+        self.manifest_hash = ""
+
+    def path(self, path):
+        """Return where an absolute path on the real machine lives here."""
+        path = str(path)
+        if path.startswith(str(self.root)) or not os.path.isabs(path):
+            return path
+        return str(self.root) + path
+
+    def _archive(self, name, members):
+        path = self.root / "resources" / (name + ".tar.gz")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tarfile.open(path, "w:gz") as tar:
+            for member in members:
+                data = "{} binary".format(member).encode()
+                info = tarfile.TarInfo("./" + member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return str(path)
+
+    def set_flag(self, flag):
+        if flag not in self.flags:
+            self.flags.add(flag)
+            self.flag_changes[flag] += 1
+
+    def clear_flag(self, flag):
+        if flag in self.flags:
+            self.flags.discard(flag)
+            self.flag_changes[flag] += 1
+
+    def set_status(self, state, message):
+        self.status = (state, message)
+
+    def record_command(self, args, input=None):
+        """Record an external command, returning what it prints."""
+        if isinstance(args, str):
+            args = args.split()
+        args = list(args)
+        self.commands.append(args)
+        if args[:1] == ["kubectl"]:
+            return self.kubectl(args[2:], input)
+        if args[:2] == ["systemctl", "is-active"]:
+            return "\n".join(
+                self.services.get(s, "inactive") for s in args[2:]
+            ).encode()
+        if args[:1] == ["dpkg"]:
+            return b"amd64\n"
+        if args[:1] == ["flanneld"]:
+            return b"Flannel v0.22.0\n"
+        if args[:1] == ["route"]:
+            return b"default         10.0.0.1        0.0.0.0         UG    0 0 0 ens3\n"
+        return b""
+
+    def kubectl(self, args, input):
+        # the cluster only needs to remember which manifest was applied
+        if args[0] == "apply":
+            match = re.search(r'cdk-manifest-hash: "(\w*)"', input.decode())
+            self.manifest_hash = match.group(1)
+        elif args[0] == "get":
+            return self.manifest_hash.encode()
+        return b""
+
+    def start_service(self, name):
+        self.services[name] = "active"
+        if name == "flannel":
+            # flanneld writes its lease once it has one
+            lease = self.path("/run/flannel/subnet.env")
+            os.makedirs(os.path.dirname(lease), exist_ok=True)
+            with open(lease, "w") as f:
+                f.write(
+                    "FLANNEL_NETWORK={}\nFLANNEL_SUBNET=10.1.5.1/24\n"
+                    "FLANNEL_MTU=1450\nFLANNEL_IPMASQ=false\n".format(
+                        self.config["cidr"]
+                    )
+                )
+
+    def relate(self, endpoint):
+        """Join a relation, as if the remote side has published its data."""
+        if endpoint == "etcd":
+            for flag in ("etcd.connected", "etcd.available", "etcd.tls.available"):
+                self.set_flag(flag)
+        else:
+            self.set_flag(endpoint + ".connected")
+
+    def _invoke(self, handler):
+        handler.invoked_at = dict(self.flag_changes)
+        handler.invoke()
+
+    def _runnable(self, handler):
+        if handler.hooks or not handler.test(self.flags):
+            return False
+        if handler.invoked_at is None:
+            return True
+        return any(
+            self.flag_changes[flag] != handler.invoked_at.get(flag, 0)
+            for flag in handler.watched
+        )
+
+    def dispatch(self, hook_name, max_passes=100):
+        """Run one hook the way reactive does, returning its wall time.
+
+        Hook handlers run first. Flag handlers then run in passes until none
+        is runnable; a handler that has already run only runs again if one of
+        the flags it watches changed since.
+        """
+        global _unit
+        _unit = self
+        self.hook = hook_name
+        # each hook is a new process, so nothing is cached from the last one
+        from charms.layer import etcdv3, flannel_lease, health, pipeline, restarts
+
+        etcdv3._clients.clear()
+        pipeline._attempted.clear()
+        restarts._pending.update(
+            {"daemon-reload": False, "services": set(), "requests": 0}
+        )
+        del restarts._callbacks[:]
+        restarts._restarted.clear()
+        flannel_lease._cache.clear()
+        health._cache.clear()
+        calico.container_runtime.cache_clear()
+        for handler in _handlers.values():
+            handler.invoked_at = None
+        changed = [
+            k for k, v in self.config.items() if self._applied_config.get(k) != v
+        ]
+        for key in changed:
+            self.set_flag("config.changed." + key)
+        if self.leader:
+            self.set_flag("leadership.is_leader")
+        else:
+            self.clear_flag("leadership.is_leader")
+
+        start = time.perf_counter()
+        for handler in list(_handlers.values()):
+            if hook_name in handler.hooks:
+                handler.invoke()
+        for _ in range(max_passes):
+            runnable = [h for h in _handlers.values() if self._runnable(h)]
+            if not runnable:
+                break
+            for handler in runnable:
+                # an earlier handler in this pass may have changed its flags
+                if self._runnable(handler):
+                    self._invoke(handler)
+        else:
+            raise RuntimeError(
+                "handlers did not settle in {} passes".format(max_passes)
+            )
+        # like charmhelpers, run atexit callbacks last registered first
+        while self.atexit:
+            callback, args = self.atexit.pop()
+            callback(*args)
+        elapsed = time.perf_counter() - start
+
+        for key in changed:
+            self.clear_flag("config.changed." + key)
+        self._applied_config = dict(self.config)
+        return elapsed
+
+
+install_fakes()
+calico, canal, flannel = load_handlers()
+
+
+@pytest.fixture
+def unit(tmp_path, monkeypatch):
+    """A fresh unit, with the charm's paths rerooted under tmp_path."""
+    from charms.layer import etcdv3, flannel_lease, health, timing
+
+    unit = Unit(tmp_path)
+    for module in (calico, canal, flannel):
+        for name in ("ETCD_PATH", "ETCD_KEY_PATH", "ETCD_CERT_PATH", "ETCD_CA_PATH"):
+            if hasattr(module, name):
+                monkeypatch.setattr(module, name, unit.path(getattr(module, name)))
+    monkeypatch.setattr(
+        calico,
+        "CALICO_BINARIES",
+        {k: unit.path(v) for k, v in calico.CALICO_BINARIES.items()},
+    )
+    monkeypatch.setattr(
+        flannel,
+        "FLANNEL_BINARIES",
+        {k: unit.path(v) for k, v in flannel.FLANNEL_BINARIES.items()},
+    )
+    for module, name in [
+        (calico, "CALICO_NODE_SERVICE_PATH"),
+        (canal, "CNI_CONF_PATH"),
+        (canal, "NAGIOS_PLUGINS_DIR"),
+        (flannel, "FLANNEL_SERVICE_PATH"),
+        (flannel, "FLANNEL_NET_CONF_PATH"),
+    ]:
+        monkeypatch.setattr(module, name, unit.path(getattr(module, name)))
+    monkeypatch.setattr(
+        flannel_lease, "SUBNET_ENV", unit.path(flannel_lease.SUBNET_ENV)
+    )
+    monkeypatch.setattr(timing, "LOG_PATH", unit.path(timing.LOG_PATH))
+    monkeypatch.setattr(etcdv3, "client", lambda *args, **kwargs: unit.etcd)
+    monkeypatch.setattr(
+        health, "felix_ready", lambda: unit.services.get("calico-node") == "active"
+    )
+    monkeypatch.setattr(
+        health,
+        "flannel_ready",
+        lambda interface=None: unit.services.get("flannel") == "active",
+    )
+    monkeypatch.setattr(subprocess, "run", _run)
+    for name in ("makedirs", "remove"):
+        monkeypatch.setattr(
+            os,
+            name,
+            lambda path, *a, _f=getattr(os, name), **kw: _f(unit.path(path), *a, **kw),
+        )
+    return unit
+
+
+@pytest.fixture
+def converged(unit):
+    """A unit that has been deployed, related and gone active."""
+    for hook_name in ("install", "leader-elected", "config-changed", "start"):
+        unit.dispatch(hook_name)
+    unit.relate("etcd")
+    unit.dispatch("etcd-relation-changed")
+    unit.relate("cni")
+    unit.dispatch("cni-relation-changed")
+    assert unit.status[0] == "active", unit.status
+    return unit
+
+
+@pytest.fixture
+def measure():
+    """Return a function dispatching hooks on a unit and recording the cost."""
+
+    def _measure(scenario, unit, hooks):
+        unit.commands.clear()
+        unit.hook_tools.clear()
+        unit.etcd.requests = 0
+        wall_time = 0.0
+        for hook_name in hooks:
+            if callable(hook_name):
+                hook_name()
+            else:
+                wall_time += unit.dispatch(hook_name)
+        result = Measurement(
+            scenario,
+            wall_time,
+            len(unit.commands),
+            unit.etcd.requests,
+            sum(unit.hook_tools.values()),
+        )
+        _results.append(result)
+        return result
+
+    return _measure
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark-json",
+        metavar="PATH",
+        help="Also write the benchmark results to PATH as JSON",
+    )
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not _results:
+        return
+    terminalreporter.section("hook latency")
+    header = "{:<24} {:>10} {:>9} {:>6} {:>11}".format(
+        "scenario", "wall (ms)", "commands", "etcd", "hook tools"
+    )
+    terminalreporter.write_line(header)
+    for result in _results:
+        terminalreporter.write_line(
+            "{:<24} {:>10.1f} {:>9} {:>6} {:>11}".format(
+                result.scenario,
+                result.wall_time * 1000,
+                result.commands,
+                result.etcd_requests,
+                result.hook_tools,
+            )
+        )
+    path = config.getoption("--benchmark-json")
+    if path:
+        with open(path, "w") as f:
+            json.dump([r._asdict() for r in _results], f, indent=2)
@@ -0,0 +1,101 @@
+import pytest
+
+# External commands each scenario may run before it counts as a regression.
+# Lower these when an optimization lands so it stays landed.
+COMMAND_BUDGETS = {
+    "fresh-install": 12,
+    "upgrade-charm": 6,
+    "etcd-cert-rotation": 4,
+    "cidr-change": 2,
+    "backend-change": 6,
+    "felix-options-noop": 1,
+    "update-status": 1,
+    "update-status-follower": 1,
+}
+# seconds of charm code per scenario; loose, as CI machines vary
+WALL_TIME_BUDGET = 2.0
+
+
+def check(result):
+    assert result.commands <= COMMAND_BUDGETS[result.scenario]
+    assert result.wall_time < WALL_TIME_BUDGET
+
+
+def test_fresh_install(unit, measure):
+    result = measure(
+        "fresh-install",
+        unit,
+        [
+            "install",
+            "leader-elected",
+            "config-changed",
+            "start",
+            lambda: unit.relate("etcd"),
+            "etcd-relation-changed",
+            lambda: unit.relate("cni"),
+            "cni-relation-changed",
+        ],
+    )
+    assert unit.status == (
+        "active",
+        "Flannel subnet 10.1.5.1/24 (up to 255 nodes of 253 pods)",
+    )
+    check(result)
+
+
+def test_upgrade_charm(converged, measure):
+    result = measure("upgrade-charm", converged, ["upgrade-charm"])
+    assert converged.status[0] == "active"
+    # the policy controller manifest hasn't changed, so it isn't reapplied
+    assert not any("apply" in args for args in converged.commands)
+    # and neither has the calico-node service, so it isn't restarted
+    assert ["systemctl", "restart", "calico-node"] not in converged.commands
+    # nor has flannel's network config
+    assert ["systemctl", "restart", "flannel"] not in converged.commands
+    check(result)
+
+
+def test_etcd_cert_rotation(converged, measure):
+    converged.endpoints["etcd"].credentials["client_cert"] = "rotated"
+    result = measure("etcd-cert-rotation", converged, ["etcd-relation-changed"])
+    assert converged.status[0] == "active"
+    # services reading the certs restart once each, flannel first
+    restarts = [args[2] for args in converged.commands if args[1] == "restart"]
+    assert restarts == ["flannel", "calico-node"]
+    check(result)
+
+
+def test_cidr_change(converged, measure):
+    converged.config["cidr"] = "10.2.0.0/16"
+    result = measure("cidr-change", converged, ["config-changed"])
+    assert "10.2.0.0/16" in converged.etcd.get("/coreos.com/network/config")
+    assert converged.status[0] == "active"
+    check(result)
+
+
+def test_backend_change(converged, measure):
+    converged.config["flannel-backend"] = "host-gw"
+    result = measure("backend-change", converged, ["config-changed"])
+    assert '"host-gw"' in converged.etcd.get("/coreos.com/network/config")
+    assert converged.status[0] == "active"
+    check(result)
+
+
+def test_felix_options_noop(converged, measure):
+    converged.config["felix-options"] = "RouteRefreshInterval: 30\nMaxIpsetSize: 1"
+    converged.dispatch("config-changed")
+    # same settings, different order
+    converged.config["felix-options"] = "MaxIpsetSize: 1\nRouteRefreshInterval: 30"
+    result = measure("felix-options-noop", converged, ["config-changed"])
+    assert converged.status[0] == "active"
+    check(result)
+
+
+@pytest.mark.parametrize(
+    "leader, scenario", [(True, "update-status"), (False, "update-status-follower")]
+)
+def test_update_status(converged, measure, leader, scenario):
+    converged.leader = leader
+    result = measure(scenario, converged, ["update-status"])
+    assert converged.status[0] == "active"
+    check(result)
@@ -1,4 +1,13 @@
 import charms.unit_test
+import pytest
 
 
 charms.unit_test.patch_reactive()
+charms.unit_test.patch_module("charms.leadership")
+
+
+@pytest.fixture(autouse=True)
+def no_handler_timing(monkeypatch):
+    from charms.layer import timing
+
+    monkeypatch.setattr(timing, "enabled", lambda: False)
@@ -0,0 +1,320 @@
+import gzip
+import json
+import os
+import stat
+
+import pytest
+
+from reactive import calico
+
+IMAGE = "rocks.canonical.com:443/cdk/calico/node:v3.10.1"
+
+
+class Containerd:
+    """A container runtime that reads whatever it is asked to load."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.loaded = []
+
+    def load(self, path):
+        if self.error:
+            raise self.error
+        assert stat.S_ISFIFO(os.stat(path).st_mode)
+        with open(path, "rb") as f:
+            self.loaded.append(f.read())
+
+
+@pytest.fixture
+def image_archive(tmp_path):
+    # bigger than a chunk and a pipe buffer, so it streams in pieces
+    data = os.urandom(calico.CHUNK_SIZE) * 3
+    archive = tmp_path / "calico-node-image.tar.gz"
+    with gzip.open(archive, "wb") as f:
+        f.write(data)
+    return str(archive), data
+
+
+def test_felix_env_with_metrics(mocker):
+    config = {"felix-options": "RouteRefreshInterval: 30", "enable-metrics": True}
+    config["felix-metrics-port"] = 9091
+    mocker.patch.object(calico.hookenv, "config", side_effect=config.get)
+
+    assert calico.calico_felix_env() == {
+        "FELIX_ROUTEREFRESHINTERVAL": "30",
+        "FELIX_PROMETHEUSMETRICSENABLED": "true",
+        "FELIX_PROMETHEUSMETRICSPORT": "9091",
+    }
+
+
+def test_publish_metrics_targets(mocker):
+    config = {"enable-metrics": True, "felix-metrics-port": 9091}
+    mocker.patch.object(calico.hookenv, "config", side_effect=config.get)
+    mocker.patch.object(calico.hookenv, "relation_ids", return_value=["metrics:1"])
+    relation_set = mocker.patch.object(calico.hookenv, "relation_set")
+    mocker.patch.object(calico, "get_bind_address", return_value="10.0.0.10")
+
+    calico.publish_metrics_targets()
+    relation_set.assert_called_once_with(
+        "metrics:1", {"hostname": "10.0.0.10", "port": 9091, "metrics_path": "/metrics"}
+    )
+
+    config["enable-metrics"] = False
+    relation_set.reset_mock()
+    calico.publish_metrics_targets()
+    relation_set.assert_called_once_with(
+        "metrics:1", {"hostname": None, "port": None, "metrics_path": None}
+    )
+
+
+def test_deploy_network_policy_controller(mocker):
+    config = {"calico-policy-image": "calico/kube-controllers:v3.10.1"}
+    mocker.patch.object(
+        calico.hookenv, "config", side_effect=lambda key=None: config.get(key)
+    )
+    mocker.patch.object(calico.kube_controllers, "deployment_config", return_value={})
+    mocker.patch.object(calico.os.path, "getmtime", return_value=1600000000.0)
+    mocker.patch.object(calico, "render", return_value="manifest")
+    mocker.patch.dict(calico.unitdata.kv(), clear=True)
+    kubectl = mocker.patch.object(calico, "kubectl")
+    applied = mocker.patch.object(calico, "applied_manifest_hash")
+    set_state = mocker.patch.object(calico, "set_state")
+    manifest_hash = calico.config_revision("manifest")
+
+    # never applied from this unit: apply without asking the cluster
+    calico.deploy_network_policy_controller()
+    applied.assert_not_called()
+    assert kubectl.call_args[0][:2] == ("apply", "--server-side")
+    assert kubectl.call_args[1] == {"input": b"manifest"}
+    set_state.assert_called_with("calico.npc.deployed")
+
+    # applied before and the cluster agrees: skip the apply
+    kubectl.reset_mock()
+    applied.return_value = manifest_hash
+    calico.deploy_network_policy_controller()
+    kubectl.assert_not_called()
+
+    # applied before but changed in the cluster since: apply again
+    applied.return_value = None
+    calico.deploy_network_policy_controller()
+    kubectl.assert_called_once()
+
+
+def test_deploy_network_policy_controller_invalid_config(mocker):
+    mocker.patch.object(
+        calico.kube_controllers,
+        "deployment_config",
+        side_effect=calico.kube_controllers.InvalidConfig("bad"),
+    )
+    blocked = mocker.patch.object(calico.status, "blocked")
+    set_state = mocker.patch.object(calico, "set_state")
+    kubectl = mocker.patch.object(calico, "kubectl")
+
+    calico.deploy_network_policy_controller()
+    blocked.assert_called_once_with("Invalid kube-controllers config: bad")
+    set_state.assert_called_once_with("calico.npc.invalid-config")
+    kubectl.assert_not_called()
+
+
+def test_configure_calico_pool_kubernetes_datastore(mocker):
+    config = {"cidr": "10.1.0.0/16", "calico-datastore": "kubernetes"}
+    mocker.patch.object(calico.hookenv, "config", return_value=config)
+    pool_yaml = "kind: IPPool\nmetadata: {name: default}\nspec: {cidr: 10.1.0.0/16}"
+    mocker.patch.object(calico, "render", return_value=pool_yaml)
+    mocker.patch.object(calico, "is_leader", return_value=True)
+    is_flag_set = mocker.patch.object(calico, "is_flag_set", return_value=False)
+    kubectl = mocker.patch.object(calico, "kubectl")
+    leader_set = mocker.patch.object(calico, "leader_set")
+    reconcile = mocker.patch.object(calico.ippool, "reconcile")
+    set_state = mocker.patch.object(calico, "set_state")
+
+    # the IPPool resource definition isn't there yet
+    calico.configure_calico_pool(None)
+    kubectl.assert_not_called()
+    set_state.assert_not_called()
+
+    is_flag_set.return_value = True
+    kubectl.return_value = b"default old-pool"
+    calico.configure_calico_pool(None)
+    apply, get, delete = kubectl.call_args_list
+    assert apply[0][0] == "apply"
+    pool = json.loads(apply[1]["input"])
+    assert pool["apiVersion"] == "crd.projectcalico.org/v1"
+    assert pool["spec"]["cidr"] == "10.1.0.0/16"
+    # pools other than the configured one are removed, as with etcd
+    assert get[0][:2] == ("get", "ippools.crd.projectcalico.org")
+    assert delete == mocker.call("delete", "ippools.crd.projectcalico.org", "old-pool")
+    leader_set.assert_called_once()
+    reconcile.assert_not_called()
+    set_state.assert_called_once_with("calico.pool.configured")
+
+
+def test_scale_typha(mocker):
+    config = {"calico-datastore": "kubernetes"}
+    mocker.patch.object(calico.hookenv, "config", side_effect=config.get)
+    mocker.patch.object(calico.hookenv, "relation_ids", return_value=["canal-peer:0"])
+    units = ["canal/{}".format(n) for n in range(1, 300)]
+    mocker.patch.object(calico.hookenv, "related_units", return_value=units)
+    data_changed = mocker.patch.object(calico, "data_changed", return_value=True)
+    remove_state = mocker.patch.object(calico, "remove_state")
+
+    calico.scale_typha()
+    data_changed.assert_called_once_with("calico.typha-replicas", 3)
+    remove_state.assert_called_once_with("calico.npc.deployed")
+
+    remove_state.reset_mock()
+    data_changed.return_value = False
+    calico.scale_typha()
+    remove_state.assert_not_called()
+
+    # etcd has no Typha to scale
+    data_changed.reset_mock()
+    config["calico-datastore"] = "etcd"
+    calico.scale_typha()
+    data_changed.assert_not_called()
+
+
+def test_load_calico_node_image(mocker, image_archive):
+    archive, data = image_archive
+    runtime = Containerd()
+    mocker.patch.object(calico, "container_runtime", return_value=runtime)
+    calico.load_calico_node_image(archive)
+    assert runtime.loaded == [data]
+
+
+def test_load_calico_node_image_bad_archive(mocker, tmp_path):
+    runtime = Containerd()
+    mocker.patch.object(calico, "container_runtime", return_value=runtime)
+    archive = tmp_path / "calico-node-image.tar.gz"
+    archive.write_bytes(b"not gzip")
+    # the writer's error is raised once the runtime has seen the fifo close
+    with pytest.raises(gzip.BadGzipFile):
+        calico.load_calico_node_image(str(archive))
+    assert runtime.loaded == [b""]
+
+
+def test_load_calico_node_image_runtime_gives_up(mocker, image_archive):
+    archive, _ = image_archive
+    runtime = Containerd(RuntimeError("no space left"))
+    mocker.patch.object(calico, "container_runtime", return_value=runtime)
+    # the writer isn't left blocked on a fifo nobody reads
+    with pytest.raises(RuntimeError, match="no space left"):
+        calico.load_calico_node_image(archive)
+
+
+def test_fetch_calico_node_image_skips_loaded(mocker, image_archive):
+    archive, _ = image_archive
+    mocker.patch.object(calico, "resource_get", return_value=archive)
+    load = mocker.patch.object(calico, "load_calico_node_image")
+    images = mocker.patch.object(calico, "check_output", return_value=b"")
+    runtime = Containerd()
+    loaded = {"digest": calico.file_digest(archive), "runtime": "Containerd"}
+
+    # loaded before, but the runtime lost it since
+    assert calico.fetch_calico_node_image(runtime, IMAGE, loaded) == (loaded, True)
+    load.assert_called_once_with(archive)
+
+    load.reset_mock()
+    images.return_value = IMAGE.encode() + b"\n"
+    assert calico.fetch_calico_node_image(runtime, IMAGE, loaded) == (loaded, False)
+    images.assert_called_with(["ctr", "image", "ls", "-q"])
+    load.assert_not_called()
+
+    # loaded into another runtime
+    docker = dict(loaded, runtime="Docker")
+    assert calico.fetch_calico_node_image(runtime, IMAGE, docker) == (loaded, True)
+    load.assert_called_once_with(archive)
+
+
+def test_prepare_calico_node_image_runtime_gone(mocker):
+    mocker.patch.object(calico, "is_flag_set", return_value=True)
+    clear_flag = mocker.patch.object(calico, "clear_flag")
+    mocker.patch.object(
+        calico, "container_runtime", side_effect=RuntimeError("no runtime")
+    )
+
+    # the step waits until the runtime is detected again
+    assert calico.prepare_calico_node_image() is None
+    clear_flag.assert_called_once_with("calico.ctl.ready")
+
+
+@pytest.mark.parametrize(
+    "datastore, restarted", [("etcd", True), ("kubernetes", False)]
+)
+def test_etcd_cert_rotation_restarts(mocker, datastore, restarted):
+    config = {"calico-datastore": datastore}
+    mocker.patch.object(calico.hookenv, "config", side_effect=config.get)
+    etcd = mocker.patch.object(calico, "endpoint_from_flag").return_value
+    # the endpoints are unchanged, the credentials rotated
+    mocker.patch.object(calico, "data_changed", side_effect=[False, True])
+    restart = mocker.patch.object(calico.restarts, "restart")
+    mocker.patch.object(calico, "is_flag_set", return_value=True)
+    clear_flag = mocker.patch.object(calico, "clear_flag")
+
+    calico.ensure_etcd_connections()
+    etcd.save_client_credentials.assert_called_once()
+    assert restart.called == restarted
+    clear_flag.assert_any_call("calico.service.installed")
+
+
+def test_finish_calico_node_image_restarts(mocker, tmp_path):
+    service_path = tmp_path / "calico-node.service"
+    mocker.patch.object(calico, "CALICO_NODE_SERVICE_PATH", str(service_path))
+    restart = mocker.patch.object(calico.restarts, "restart")
+    mocker.patch.dict(calico.unitdata.kv(), clear=True)
+    record = {"digest": "abc", "runtime": "Containerd"}
+
+    # nothing to restart before the service is installed
+    calico.finish_calico_node_image(lambda: (record, True))
+    restart.assert_not_called()
+
+    service_path.write_text("")
+    calico.finish_calico_node_image(lambda: (record, False))
+    restart.assert_not_called()
+    calico.finish_calico_node_image(lambda: (record, True))
+    restart.assert_called_once_with("calico-node")
+    assert calico.unitdata.kv()[calico.CALICO_NODE_IMAGE_KEY] == record
+
+
+@pytest.fixture
+def pool(mocker):
+    config = {"cidr": "10.1.0.0/16", "calico-datastore": "etcd"}
+    mocker.patch.object(calico.hookenv, "config", return_value=config)
+    pool_yaml = "kind: IPPool\nmetadata: {name: default}\nspec: {cidr: 10.1.0.0/16}"
+    mocker.patch.object(calico, "render", return_value=pool_yaml)
+    mocker.patch.object(calico, "set_state")
+    mocker.patch.object(calico.status, "waiting")
+    pool = {"kind": "IPPool", "metadata": {"name": "default"}}
+    pool["spec"] = {"cidr": "10.1.0.0/16"}
+    return calico.config_revision([pool])
+
+
+def test_configure_calico_pool_leader(mocker, pool):
+    mocker.patch.object(calico, "is_leader", return_value=True)
+    mocker.patch.object(calico, "etcd_client")
+    reconcile = mocker.patch.object(calico.ippool, "reconcile")
+    reconcile.return_value._asdict.return_value = {"created": ["default"]}
+    leader_set = mocker.patch.object(calico, "leader_set")
+
+    calico.configure_calico_pool(None)
+    reconcile.assert_called_once()
+    leader_set.assert_called_once_with({"calico-pool-revision": pool})
+    calico.set_state.assert_called_once_with("calico.pool.configured")
+
+
+@pytest.mark.parametrize("published, configured", [("stale", False), (None, True)])
+def test_configure_calico_pool_follower(mocker, pool, published, configured):
+    mocker.patch.object(calico, "is_leader", return_value=False)
+    reconcile = mocker.patch.object(calico.ippool, "reconcile")
+    leader_set = mocker.patch.object(calico, "leader_set")
+    mocker.patch.object(calico, "leader_get", return_value=published or pool)
+
+    # followers never touch the pools; they wait for the leader's revision
+    calico.configure_calico_pool(None)
+    reconcile.assert_not_called()
+    leader_set.assert_not_called()
+    assert calico.set_state.called == configured
+    if not configured:
+        calico.status.waiting.assert_called_once_with(
+            "Waiting for leader to configure calico pool"
+        )
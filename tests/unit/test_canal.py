@@ -1,5 +1,7 @@
-from unittest.mock import MagicMock, call, mock_open, patch
+from unittest.mock import MagicMock, call, patch
+import pytest
 from charmhelpers.contrib.charmsupport import nrpe
+from charms.layer import health
 from reactive import canal
 
 
@@ -19,17 +21,39 @@ def test_set_canal_version():
             mock_avs.assert_called_once_with(f"{flannel_ver}/3.10.1")
 
 
-def test_get_flannel_subnet():
-    subnet = "zippitydoda"
-    with patch("builtins.open", mock_open(read_data=f"FLANNEL_SUBNET={subnet}")):
-        assert canal.get_flannel_subnet() == subnet
+def test_get_flannel_subnet(tmp_path, monkeypatch):
+    subnet_env = tmp_path / "subnet.env"
+    subnet_env.write_text("FLANNEL_SUBNET=10.1.5.1/24\n")
+    monkeypatch.setattr(canal.flannel_lease, "SUBNET_ENV", str(subnet_env))
+    assert canal.get_flannel_subnet() == "10.1.5.1/24"
 
 
-def test_add_nrpe_service_checks(mocker):
+@pytest.mark.parametrize(
+    "probe, message",
+    [
+        (
+            health.Health(["calico-node"], False, True),
+            "Waiting for service: calico-node",
+        ),
+        (health.Health([], False, True), "Waiting for Felix to be ready"),
+        (health.Health([], True, False), "Waiting for Flannel interface"),
+    ],
+)
+def test_ready_waits_for_dataplane(mocker, probe, message):
+    mocker.patch.object(canal.health, "probe", return_value=probe)
+    canal.status.waiting.reset_mock()
+
+    canal.ready()
+
+    canal.status.waiting.assert_called_once_with(message)
+
+
+def test_add_nrpe_service_checks(mocker, tmp_path):
     """Test proper procedure when adding nrpe checks."""
     hostname = "nagios.0"
     unit_name = "nagios/0"
     nrpe_mock = MagicMock()
+    mocker.patch.object(canal, "NAGIOS_PLUGINS_DIR", str(tmp_path))
 
     mocker.patch.object(nrpe, "get_nagios_hostname").return_value = hostname
     mocker.patch.object(nrpe, "get_nagios_unit_name").return_value = unit_name
@@ -39,6 +63,12 @@ def test_add_nrpe_service_checks(mocker):
     canal.configure_nrpe()
 
     add_check_mock.assert_called_with(nrpe_mock, canal.MONITORED_SERVICES, unit_name)
+    nrpe_mock.add_check.assert_called_once_with(
+        shortname="canal_health",
+        description="Canal dataplane health nagios/0",
+        check_cmd="check_canal_health flannel.1",
+    )
+    assert (tmp_path / "check_canal_health").stat().st_mode & 0o111
     nrpe_mock.write.assert_called_once()
     # wokeignore:rule=master
     canal.set_state.assert_called_with("nrpe-external-master.initial-config")
@@ -68,3 +98,175 @@ def test_nagios_context_update(mocker):
     canal.update_nagios()
 
     canal.configure_nrpe.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "lease_mtu, option, expected",
+    [(8950, 0, 8950), (8950, 1500, 1500), (None, 0, 8950), (None, 1400, 1400)],
+)
+def test_cni_mtu(mocker, lease_mtu, option, expected):
+    config = {"mtu": option, "flannel-backend": "vxlan"}
+    mocker.patch.object(canal, "config", side_effect=config.get)
+    mocker.patch.dict(canal.unitdata.kv(), {canal.flannel_backend.IFACE_KEY: "ens3"})
+    mocker.patch.object(canal.flannel_backend, "link_mtu", return_value=9000)
+    lease = canal.flannel_lease.FlannelLease(None, None, lease_mtu, False)
+    assert canal.cni_mtu(lease) == expected
+
+
+def test_cni_mtu_too_large(mocker):
+    mocker.patch.object(canal, "config", side_effect={"mtu": 9000}.get)
+    lease = canal.flannel_lease.FlannelLease(None, None, 1450, False)
+    with pytest.raises(ValueError):
+        canal.cni_mtu(lease)
+
+
+def test_restart_gate(mocker):
+    config = {"restart-batch-size": 1}
+    mocker.patch.object(canal, "config", side_effect=config.get)
+    mocker.patch.object(canal.hookenv, "relation_ids", return_value=["canal-peer:3"])
+    mocker.patch.object(canal.hookenv, "local_unit", return_value="canal/1")
+    mocker.patch.object(canal.hookenv, "is_leader", return_value=False)
+    relation_set = mocker.patch.object(canal.hookenv, "relation_set")
+    mocker.patch.object(canal, "service_running", return_value=True)
+    leader_settings = {"restart-grants": "canal/0"}
+    mocker.patch.object(canal, "leader_get", side_effect=leader_settings.get)
+    kv = canal.unitdata.kv()
+    mocker.patch.dict(kv, clear=True)
+    canal.remove_state("canal.restart.waiting")
+
+    # another unit holds the only slot, so ask for one and wait
+    assert not canal.restart_gate(["calico-node"])
+    assert not canal.restart_gate(["flannel"])
+    relation_set.assert_called_once_with(
+        "canal-peer:3", {"restart-request": 1, "restart-done": None}
+    )
+    assert kv.get(canal.RESTART_WAITING_KEY) == ["flannel", "calico-node"]
+    assert canal.is_flag_set("canal.restart.waiting")
+
+    leader_settings["restart-grants"] = "canal/1"
+    assert canal.restart_gate(["flannel", "calico-node"])
+    assert not canal.is_flag_set("canal.restart.waiting")
+    assert canal.is_flag_set("canal.restart.verifying")
+
+    # nothing running, nothing to disrupt
+    canal.service_running.return_value = False
+    leader_settings["restart-grants"] = "canal/0"
+    assert canal.restart_gate(["flannel"])
+    assert not canal.is_flag_set("canal.restart.verifying")
+
+
+@pytest.mark.parametrize("healthy_after, released", [(3, True), (None, False)])
+def test_verify_restart(mocker, healthy_after, released):
+    mocker.patch.object(canal.restarts, "pending", return_value=False)
+    mocker.patch.object(canal, "flannel_interface", return_value="flannel.1")
+    mocker.patch.object(canal.hookenv, "is_leader", return_value=False)
+    publish = mocker.patch.object(canal, "publish_restart_state")
+    unhealthy = health.Health([], False, True)
+    probes = [unhealthy] * (healthy_after or 100) + [health.Health([], True, True)]
+    probe = mocker.patch.object(canal.health, "probe", side_effect=probes)
+    clock = mocker.patch.object(canal.time, "monotonic", return_value=0)
+    sleep = mocker.patch.object(canal.time, "sleep")
+    sleep.side_effect = lambda seconds: setattr(
+        clock, "return_value", clock.return_value + seconds
+    )
+    kv = canal.unitdata.kv()
+    mocker.patch.dict(kv, {canal.RESTART_REQUEST_KEY: 2}, clear=True)
+    canal.set_state("canal.restart.verifying")
+
+    # polls past the health cache until healthy, for a bounded time
+    canal.verify_restart()
+    probe.assert_called_with(canal.MONITORED_SERVICES, ttl=0, interface="flannel.1")
+    assert canal.is_flag_set("canal.restart.verifying") != released
+    assert publish.called == released
+    assert kv.get(canal.RESTART_DONE_KEY) == (2 if released else None)
+    assert clock.return_value <= canal.RESTART_VERIFY_TIMEOUT
+    canal.remove_state("canal.restart.verifying")
+
+
+def test_restart_gate_batching_turned_off(mocker):
+    config = {"restart-batch-size": 1}
+    mocker.patch.object(canal, "config", side_effect=config.get)
+    mocker.patch.object(canal.hookenv, "relation_ids", return_value=["canal-peer:3"])
+    mocker.patch.object(canal.hookenv, "local_unit", return_value="canal/1")
+    mocker.patch.object(canal.hookenv, "is_leader", return_value=False)
+    relation_set = mocker.patch.object(canal.hookenv, "relation_set")
+    mocker.patch.object(canal, "service_running", return_value=True)
+    mocker.patch.object(canal, "leader_get", return_value="canal/0")
+    restart = mocker.patch.object(canal.restarts, "restart")
+    kv = canal.unitdata.kv()
+    mocker.patch.dict(kv, clear=True)
+    canal.remove_state("canal.restart.waiting")
+    canal.remove_state("canal.restart.verifying")
+
+    assert not canal.restart_gate(["calico-node"])
+    assert canal.is_flag_set("canal.restart.waiting")
+
+    # with coordination off, the held restart runs once and the wait is over
+    config["restart-batch-size"] = 0
+    canal.resume_restart()
+    restart.assert_called_once_with("calico-node")
+    assert canal.restart_gate(["calico-node"])
+    assert not canal.is_flag_set("canal.restart.waiting")
+    assert canal.RESTART_WAITING_KEY not in kv
+    assert kv[canal.RESTART_DONE_KEY] == kv[canal.RESTART_REQUEST_KEY]
+    relation_set.assert_called_with(
+        "canal-peer:3", {"restart-request": 1, "restart-done": 1}
+    )
+
+
+def test_rank_etcd_endpoints(mocker):
+    etcd = mocker.patch.object(canal, "endpoint_from_flag").return_value
+    etcd.get_connection_string.return_value = "https://a:2379,https://b:2379"
+    latencies = {"https://a:2379": 0.030, "https://b:2379": 0.002}
+    probe = mocker.patch.object(
+        canal.etcdv3, "endpoint_latencies", return_value=latencies
+    )
+    mocker.patch.dict(canal.unitdata.kv(), clear=True)
+    canal.set_state("calico.service.installed")
+
+    # the services are configured again with the nearest endpoint first
+    canal.rank_etcd_endpoints()
+    assert canal.etcd_connection_string(etcd) == "https://b:2379,https://a:2379"
+    assert not canal.is_flag_set("calico.service.installed")
+
+    # not probed again until the interval has passed
+    canal.set_state("calico.service.installed")
+    canal.rank_etcd_endpoints()
+    probe.assert_called_once()
+    assert canal.is_flag_set("calico.service.installed")
+
+
+def test_rank_etcd_endpoints_probe_fails_once(mocker):
+    etcd = mocker.patch.object(canal, "endpoint_from_flag").return_value
+    connection_string = "https://a:2379,https://b:2379"
+    etcd.get_connection_string.return_value = connection_string
+    mocker.patch.object(
+        canal.etcdv3,
+        "endpoint_latencies",
+        side_effect=[
+            {"https://a:2379": None, "https://b:2379": 0.002},
+            {"https://a:2379": 0.002, "https://b:2379": 0.002},
+        ],
+    )
+    kv = canal.unitdata.kv()
+    ranking = {
+        "endpoints": connection_string,
+        "order": ["https://a:2379", "https://b:2379"],
+        "probed": 0,
+    }
+    mocker.patch.dict(kv, {canal.ETCD_RANKING_KEY: ranking}, clear=True)
+    for flag in ("calico.service.installed", "flannel.service.installed"):
+        canal.set_state(flag)
+
+    # one failed probe doesn't change the ranking
+    canal.rank_etcd_endpoints()
+    assert canal.etcd_connection_string(etcd) == connection_string
+    assert kv[canal.ETCD_RANKING_KEY]["streaks"] == {"https://a:2379": 1}
+    assert canal.is_flag_set("calico.service.installed")
+
+    # and once it answers again the streak is over
+    kv[canal.ETCD_RANKING_KEY]["probed"] = 0
+    canal.rank_etcd_endpoints()
+    assert kv[canal.ETCD_RANKING_KEY]["streaks"] == {}
+    assert canal.is_flag_set("calico.service.installed")
+    assert canal.is_flag_set("flannel.service.installed")
@@ -0,0 +1,38 @@
+import pytest
+
+from charms.layer import datastore
+
+
+@pytest.mark.parametrize(
+    "nodes, replicas",
+    [(1, 1), (2, 2), (3, 3), (200, 3), (601, 4), (1000, 5), (10000, 20)],
+)
+def test_typha_replicas(nodes, replicas):
+    assert datastore.typha_replicas(nodes) == replicas
+
+
+def test_crds():
+    crds = {crd["kind"]: crd for crd in datastore.crds()}
+    assert crds["NetworkPolicy"] == {
+        "kind": "NetworkPolicy",
+        "plural": "networkpolicies",
+        "scope": "Namespaced",
+    }
+    assert crds["IPPool"]["plural"] == "ippools"
+    assert crds["BlockAffinity"]["plural"] == "blockaffinities"
+    assert crds["IPPool"]["scope"] == "Cluster"
+
+
+def test_ippool_resource():
+    pool = {
+        "apiVersion": "projectcalico.org/v3",
+        "kind": "IPPool",
+        "metadata": {"name": "default"},
+        "spec": {"cidr": "10.1.0.0/16", "natOutgoing": True},
+    }
+    assert datastore.ippool_resource(pool) == {
+        "apiVersion": "crd.projectcalico.org/v1",
+        "kind": "IPPool",
+        "metadata": {"name": "default"},
+        "spec": {"cidr": "10.1.0.0/16", "natOutgoing": True},
+    }
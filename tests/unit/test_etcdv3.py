@@ -0,0 +1,215 @@
+import json
+import threading
+from base64 import b64decode, b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from charms.layer import etcdv3
+
+
+class FakeEtcd(ThreadingHTTPServer):
+    """Just enough of the etcd v3 JSON gateway to exercise the client."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeEtcdHandler)
+        self.data = {}
+        self.revision = 1
+        self.connections = 0
+        self.requests = []
+        self.health = "true"
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def keys(self, req):
+        key = b64decode(req["key"])
+        if "range_end" not in req:
+            return [key] if key in self.data else []
+        end = b64decode(req["range_end"])
+        return sorted(k for k in self.data if key <= k < end)
+
+    def put(self, req):
+        self.revision += 1
+        self.data[b64decode(req["key"])] = (b64decode(req["value"]), self.revision)
+
+    def delete(self, req):
+        for key in self.keys(req):
+            del self.data[key]
+
+    def kv_range(self, req):
+        kvs = [
+            {
+                "key": b64encode(key).decode(),
+                "value": b64encode(self.data[key][0]).decode(),
+                "mod_revision": str(self.data[key][1]),
+            }
+            for key in self.keys(req)
+        ]
+        return {"kvs": kvs} if kvs else {}
+
+    def kv_txn(self, req):
+        for cmp in req["compare"]:
+            current = self.data.get(b64decode(cmp["key"]), (None, 0))[1]
+            if current != int(cmp["mod_revision"]):
+                return {}
+        for op in req["success"]:
+            if "request_put" in op:
+                self.put(op["request_put"])
+            else:
+                self.delete(op["request_delete_range"])
+        return {"succeeded": True}
+
+
+class FakeEtcdHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(self.path)
+        handlers = {
+            "/v3/kv/range": self.server.kv_range,
+            "/v3/kv/put": lambda r: self.server.put(r) or {},
+            "/v3/kv/deleterange": lambda r: self.server.delete(r) or {},
+            "/v3/kv/txn": self.server.kv_txn,
+        }
+        body = json.dumps(handlers[self.path](req)).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        body = json.dumps({"health": self.server.health}).encode()
+        self.send_response(200 if self.path == "/health" else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def etcd():
+    server = FakeEtcd()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_reuses_one_connection(etcd):
+    client = etcdv3.Client(etcd.endpoint)
+    client.put("/a/1", "one")
+    client.put("/a/2", "two")
+    client.put("/b", "other")
+    assert client.get("/a/1") == "one"
+    assert client.get("/missing") is None
+    assert [kv.key for kv in client.get_prefix("/a/")] == ["/a/1", "/a/2"]
+    client.delete("/a/1")
+    assert [kv.value for kv in client.get_prefix("/a/")] == ["two"]
+    assert etcd.connections == 1
+
+
+def test_fails_over_to_next_endpoint(etcd):
+    client = etcdv3.Client("http://127.0.0.1:1," + etcd.endpoint)
+    client.put("/key", "value")
+    assert client.get("/key") == "value"
+
+    with pytest.raises(etcdv3.EtcdError):
+        etcdv3.Client("http://127.0.0.1:1").get("/key")
+
+
+def test_txn(etcd):
+    client = etcdv3.Client(etcd.endpoint)
+    client.put("/pools/stale", "x")
+    (stale,) = client.get_prefix("/pools/")
+
+    # the stale pool changed underneath us, so nothing is applied
+    client.put("/pools/stale", "y")
+    assert not client.txn(
+        [etcdv3.mod_revision_is(stale.key, stale.mod_revision)],
+        [etcdv3.delete_op(stale.key), etcdv3.put_op("/pools/default", "z")],
+    )
+    assert client.get("/pools/default") is None
+
+    (stale,) = client.get_prefix("/pools/")
+    assert client.txn(
+        [
+            etcdv3.mod_revision_is(stale.key, stale.mod_revision),
+            etcdv3.mod_revision_is("/pools/default", 0),
+        ],
+        [etcdv3.delete_op(stale.key), etcdv3.put_op("/pools/default", "z")],
+    )
+    assert [(kv.key, kv.value) for kv in client.get_prefix("/pools/")] == [
+        ("/pools/default", "z")
+    ]
+    assert etcd.requests.count("/v3/kv/txn") == 2
+
+
+def test_endpoint_latencies(etcd):
+    down = "http://127.0.0.1:1"
+    latencies = etcdv3.endpoint_latencies([etcd.endpoint, down])
+    assert latencies[etcd.endpoint] > 0
+    assert latencies[down] is None
+
+    etcd.health = "false"
+    assert etcdv3.endpoint_latencies([etcd.endpoint]) == {etcd.endpoint: None}
+
+
+@pytest.mark.parametrize(
+    "latencies, current, expected",
+    [
+        ({"a": 0.030, "b": 0.002, "c": 0.010}, None, ["b", "c", "a"]),
+        # small differences don't reorder
+        ({"a": 0.011, "b": 0.010}, ["a", "b"], ["a", "b"]),
+        ({"a": 0.030, "b": 0.010}, ["a", "b"], ["b", "a"]),
+        # unhealthy members drop out, and come back in once they recover
+        ({"a": None, "b": 0.010, "c": 0.020}, ["a", "b", "c"], ["b", "c"]),
+        ({"a": 0.001, "b": 0.010, "c": 0.020}, ["b", "c"], ["a", "b", "c"]),
+        ({"a": None, "b": None}, None, ["a", "b"]),
+        ({"a": None, "b": None}, ["b"], ["b"]),
+    ],
+)
+def test_rank_endpoints(latencies, current, expected):
+    assert etcdv3.rank_endpoints(latencies, current) == expected
+
+
+def test_confirm_health():
+    current = ["a", "b"]
+    streaks = {}
+    # a member failing drops out on the third probe in a row
+    for _ in range(etcdv3.HEALTH_CHANGE_PROBES - 1):
+        latencies, streaks = etcdv3.confirm_health(
+            {"a": None, "b": 0.010}, current, streaks
+        )
+        assert latencies == {"a": float("inf"), "b": 0.010}
+        assert etcdv3.rank_endpoints(latencies, current) == ["b", "a"]
+    latencies, streaks = etcdv3.confirm_health(
+        {"a": None, "b": 0.010}, current, streaks
+    )
+    assert etcdv3.rank_endpoints(latencies, current) == ["b"]
+    assert streaks == {}
+
+    # and recovering takes as many
+    current = ["b"]
+    latencies, streaks = etcdv3.confirm_health(
+        {"a": 0.001, "b": 0.010}, current, streaks
+    )
+    assert latencies == {"a": None, "b": 0.010}
+    assert streaks == {"a": 1}
+    # a failed probe in between starts the count again
+    latencies, streaks = etcdv3.confirm_health(
+        {"a": None, "b": 0.010}, current, streaks
+    )
+    assert streaks == {}
+
+    # nothing to hold back on the first ranking
+    assert etcdv3.confirm_health({"a": None}, None, {}) == ({"a": None}, {})
@@ -0,0 +1,45 @@
+import pytest
+
+from charms.layer import felix
+from charms.layer.felix import InvalidOption
+
+
+def test_felix_env():
+    options = """
+    IptablesRefreshInterval: 60
+    LogSeverityScreen: Warning
+    ChainInsertMode: append
+    BPFEnabled: false
+    """
+    assert felix.felix_env(options) == {
+        "FELIX_BPFENABLED": "false",
+        "FELIX_CHAININSERTMODE": "append",
+        "FELIX_IPTABLESREFRESHINTERVAL": "60",
+        "FELIX_LOGSEVERITYSCREEN": "Warning",
+    }
+    assert felix.felix_env("") == {}
+
+
+@pytest.mark.parametrize(
+    "options, message",
+    [
+        ("- IptablesRefreshInterval", "must be a mapping"),
+        ("IptablesRefreshInterval: soon", "must be a non-negative integer"),
+        ("IptablesLockTimeoutSecs: -1", "must be a non-negative integer"),
+        ("RouteRefreshInterval: true", "must be a non-negative integer"),
+        ("LogSeverityFile: Loud", "must be one of Debug"),
+        ("IgnoreLooseRPF: true", "managed by the charm"),
+        ("iptables-refresh: 1", "not a Felix setting name"),
+        ("BPFEnabled: [true]", "must be a single value"),
+        ("a: [", "not valid YAML"),
+        ("HealthHost: 0.0.0.0 --privileged", "can't contain whitespace"),
+        ('HealthHost: "a\\tb"', "can't contain whitespace"),
+        ('HealthHost: "a\\x07b"', "can't contain whitespace"),
+        ("HealthHost: 100%", "can't contain whitespace"),
+        ("HealthHost: $HOSTNAME", "can't contain whitespace"),
+        ("LogFilePath: /var/log/calico felix.log", "can't contain whitespace"),
+    ],
+)
+def test_felix_env_invalid(options, message):
+    with pytest.raises(InvalidOption, match=message):
+        felix.felix_env(options)
@@ -0,0 +1,125 @@
+import pytest
+
+from reactive import flannel
+
+
+def test_install_flannel_service_kube_subnet_mgr(mocker):
+    config = {"flannel-subnet-manager": "kubernetes", "cidr": "10.1.0.0/16"}
+    mocker.patch.object(flannel, "config", side_effect=lambda key: config.get(key))
+    mocker.patch.object(flannel, "get_bind_address_interface", return_value="eth0")
+    mocker.patch.object(flannel, "cni_kubeconfig_path", return_value="/kubeconfig")
+    node_pod_cidr = mocker.patch.object(flannel, "node_pod_cidr", return_value=None)
+    render = mocker.patch.object(flannel, "render_if_changed", return_value=True)
+    waiting = mocker.patch.object(flannel.status, "waiting")
+    blocked = mocker.patch.object(flannel.status, "blocked")
+
+    # flannel keeps running from etcd until the node has a pod CIDR
+    flannel.install_flannel_service()
+    waiting.assert_called_once_with("Waiting for kubernetes to allocate a pod CIDR")
+    render.assert_not_called()
+
+    node_pod_cidr.return_value = "10.2.0.0/24"
+    flannel.install_flannel_service()
+    blocked.assert_called_once_with("Node pod CIDR 10.2.0.0/24 is outside cidr")
+    render.assert_not_called()
+
+    node_pod_cidr.return_value = "10.1.7.0/24"
+    flannel.install_flannel_service()
+    context = render.call_args[0][2]
+    assert context["subnet_manager"] == "kubernetes"
+    assert context["kubeconfig_path"] == "/kubeconfig"
+    assert context["net_config_path"] == flannel.FLANNEL_NET_CONF_PATH
+
+
+def test_release_etcd_lease(mocker):
+    kv = flannel.unitdata.kv()
+    mocker.patch.dict(kv, {flannel.FLANNEL_ETCD_LEASE_KEY: "10.1.5.0-24"}, clear=True)
+    restarted = mocker.patch.object(flannel.restarts, "restarted", return_value=False)
+    client = mocker.patch.object(flannel.etcdv3, "client").return_value
+    mocker.patch.object(flannel, "etcd_connection_string")
+
+    # flanneld still holds the lease while its restart is held
+    flannel.release_etcd_lease()
+    client.delete.assert_not_called()
+
+    restarted.return_value = True
+    flannel.release_etcd_lease()
+    client.delete.assert_called_once_with("/coreos.com/network/subnets/10.1.5.0-24")
+    assert flannel.FLANNEL_ETCD_LEASE_KEY not in kv
+
+
+@pytest.fixture
+def network(mocker):
+    config = {"flannel-subnet-manager": "etcd"}
+    mocker.patch.object(flannel, "config", side_effect=config.get)
+    mocker.patch.object(
+        flannel, "network_config", return_value={"Network": "10.1.0.0/16"}
+    )
+    mocker.patch.object(flannel, "set_state")
+    mocker.patch.object(flannel, "remove_state")
+    mocker.patch.object(flannel.status, "waiting")
+    return flannel.config_revision({"Network": "10.1.0.0/16"})
+
+
+def test_configure_network_leader(mocker, network):
+    mocker.patch.object(flannel, "is_leader", return_value=True)
+    configure_network = mocker.patch.object(
+        flannel, "configure_network", return_value=True
+    )
+    leader_set = mocker.patch.object(flannel, "leader_set")
+
+    flannel.invoke_configure_network("etcd")
+    configure_network.assert_called_once_with("etcd")
+    leader_set.assert_called_once_with({"flannel-network-revision": network})
+    flannel.set_state.assert_called_once_with("flannel.network.configured")
+
+
+@pytest.mark.parametrize("changed", [True, False])
+def test_configure_network_restarts_on_new_revision(mocker, network, changed):
+    mocker.patch.object(flannel, "is_leader", return_value=True)
+    mocker.patch.object(flannel, "configure_network", return_value=True)
+    mocker.patch.object(flannel, "leader_set")
+    data_changed = mocker.patch.object(flannel, "data_changed", return_value=changed)
+
+    # flannel only restarts when the network config it reads has changed
+    flannel.invoke_configure_network("etcd")
+    data_changed.assert_called_once_with("flannel-network-revision", network)
+    assert flannel.remove_state.called == changed
+
+
+@pytest.mark.parametrize("published, configured", [("stale", False), (None, True)])
+def test_configure_network_follower(mocker, network, published, configured):
+    mocker.patch.object(flannel, "is_leader", return_value=False)
+    configure_network = mocker.patch.object(flannel, "configure_network")
+    leader_set = mocker.patch.object(flannel, "leader_set")
+    mocker.patch.object(flannel, "leader_get", return_value=published or network)
+
+    # followers never write to etcd; they wait for the leader's revision
+    flannel.invoke_configure_network("etcd")
+    configure_network.assert_not_called()
+    leader_set.assert_not_called()
+    assert flannel.set_state.called == configured
+    if not configured:
+        flannel.status.waiting.assert_called_once_with(
+            "Waiting for leader to configure flannel network."
+        )
+
+
+@pytest.mark.parametrize(
+    "error, message",
+    [
+        (flannel.flannel_backend.InvalidBackend("bad"), "Invalid flannel backend: bad"),
+        (flannel.flannel_subnets.InvalidSubnets("bad"), "Invalid flannel subnets: bad"),
+    ],
+)
+def test_start_flannel_service_invalid_config(mocker, error, message):
+    mocker.patch.object(flannel, "network_config", side_effect=error)
+    blocked = mocker.patch.object(flannel.status, "blocked")
+    restart = mocker.patch.object(flannel.restarts, "restart")
+    set_state = mocker.patch.object(flannel, "set_state")
+
+    # the config changed to something invalid since the network was configured
+    flannel.start_flannel_service()
+    blocked.assert_called_once_with(message)
+    restart.assert_not_called()
+    set_state.assert_not_called()
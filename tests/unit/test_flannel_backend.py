@@ -0,0 +1,49 @@
+import pytest
+
+from charms.layer import flannel_backend
+from charms.layer.flannel_backend import InvalidBackend
+
+
+def test_parse_version():
+    assert flannel_backend.parse_version("Flannel v0.22.0\n") == (0, 22, 0)
+    assert flannel_backend.parse_version("0.11.0") == (0, 11, 0)
+    assert flannel_backend.parse_version("unknown") is None
+
+
+def test_backend_config():
+    assert flannel_backend.backend_config("host-gw") == {"Type": "host-gw"}
+    assert flannel_backend.backend_config(
+        "vxlan", "DirectRouting=True VNI=4 Port=8472", (0, 22, 0)
+    ) == {"Type": "vxlan", "DirectRouting": True, "VNI": 4, "Port": 8472}
+
+
+@pytest.mark.parametrize(
+    "backend_type, options, message",
+    [
+        ("udp", "", "unknown backend udp"),
+        ("host-gw", "VNI=1", "unknown host-gw option VNI"),
+        ("vxlan", "DirectRouting", "unknown vxlan option DirectRouting"),
+        ("vxlan", "VNI=one", "VNI must be an integer"),
+        ("vxlan", "GBP=yes", "GBP must be true or false"),
+        ("wireguard", "", "wireguard needs flannel v0.14.0, but the resource is"),
+        ("vxlan", "DirectRouting=true", "DirectRouting needs flannel v0.10.0"),
+    ],
+)
+def test_backend_config_invalid(backend_type, options, message):
+    with pytest.raises(InvalidBackend, match=message):
+        flannel_backend.backend_config(backend_type, options, (0, 9, 1))
+
+
+def test_interface():
+    assert flannel_backend.interface({"Type": "vxlan"}) == "flannel.1"
+    assert flannel_backend.interface({"Type": "vxlan", "VNI": 4}) == "flannel.4"
+    assert flannel_backend.interface({"Type": "wireguard"}) == "flannel-wg"
+    assert flannel_backend.interface({"Type": "host-gw"}) is None
+
+
+def test_mtu():
+    assert flannel_backend.link_mtu("lo") > 0
+    assert flannel_backend.link_mtu("no-such-iface") is None
+    assert flannel_backend.pod_mtu(9000, "vxlan") == 8950
+    assert flannel_backend.pod_mtu(1500, "wireguard") == 1420
+    assert flannel_backend.pod_mtu(1500, "host-gw") == 1500
@@ -0,0 +1,54 @@
+from ipaddress import ip_interface, ip_network
+from unittest.mock import mock_open, patch
+
+import pytest
+
+from charms.layer import flannel_lease
+
+
+def test_parse_lease():
+    lease = flannel_lease.parse_lease(
+        "\n"
+        "# written by flanneld\n"
+        "FLANNEL_NETWORK=10.1.0.0/16\n"
+        "\n"
+        "FLANNEL_SUBNET=10.1.5.1/24\n"
+        "FLANNEL_MTU=8950\n"
+        "FLANNEL_IPMASQ=true\n"
+        "EXTRA=a=b\n"
+        "garbage\n"
+    )
+    assert lease == flannel_lease.FlannelLease(
+        ip_network("10.1.0.0/16"), ip_interface("10.1.5.1/24"), 8950, True
+    )
+
+
+def test_parse_lease_partial():
+    lease = flannel_lease.parse_lease("FLANNEL_SUBNET=10.1.5.1/24\nFLANNEL_MTU=big")
+    assert lease.subnet == ip_interface("10.1.5.1/24")
+    assert lease.network is None
+    assert lease.mtu is None
+    assert not lease.ipmasq
+
+
+@pytest.mark.parametrize(
+    "text", ["", "FLANNEL_NETWORK=10.1.0.0/16", "FLANNEL_SUBNET=", "FLANNEL_SUBNET=x"]
+)
+def test_parse_lease_malformed(text):
+    with pytest.raises(flannel_lease.FlannelSubnetNotFound):
+        flannel_lease.parse_lease(text)
+
+
+def test_read_lease_cached(tmp_path):
+    subnet_env = tmp_path / "subnet.env"
+    with pytest.raises(flannel_lease.FlannelSubnetNotFound):
+        flannel_lease.read_lease(str(subnet_env))
+
+    subnet_env.write_text("FLANNEL_SUBNET=10.1.5.1/24\n")
+    lease = flannel_lease.read_lease(str(subnet_env))
+    with patch("builtins.open", mock_open()) as reopened:
+        assert flannel_lease.read_lease(str(subnet_env)) is lease
+    reopened.assert_not_called()
+
+    subnet_env.write_text("FLANNEL_SUBNET=10.1.6.1/24\nFLANNEL_MTU=1450\n")
+    assert flannel_lease.read_lease(str(subnet_env)).mtu == 1450
@@ -0,0 +1,49 @@
+import pytest
+
+from charms.layer import flannel_subnets
+from charms.layer.flannel_subnets import Capacity, InvalidSubnets
+
+
+@pytest.mark.parametrize(
+    "cidr, subnet_len, subnet_min, subnet_max, expected",
+    [
+        # flannel's defaults skip the first subnet
+        ("10.1.0.0/16", 0, "", "", Capacity(255, 253)),
+        ("10.1.0.0/16", 26, "", "", Capacity(1023, 61)),
+        ("10.1.0.0/16", 26, "10.1.0.0", "", Capacity(1024, 61)),
+        ("10.1.0.0/16", 24, "10.1.16.0", "10.1.31.0", Capacity(16, 253)),
+        # small networks are halved
+        ("10.1.0.0/24", 0, "", "", Capacity(1, 125)),
+        ("10.0.0.0/8", 0, "", "", Capacity(65535, 253)),
+    ],
+)
+def test_capacity(cidr, subnet_len, subnet_min, subnet_max, expected):
+    assert flannel_subnets.capacity(cidr, subnet_len, subnet_min, subnet_max) == (
+        expected
+    )
+
+
+@pytest.mark.parametrize(
+    "cidr, subnet_len, subnet_min, subnet_max, message",
+    [
+        ("10.1.0.0/16", 16, "", "", "between /17 and /30"),
+        ("10.1.0.0/16", 31, "", "", "between /17 and /30"),
+        ("10.1.0.0/16", 24, "10.2.0.0", "", "outside cidr"),
+        ("10.1.0.0/16", 24, "", "10.1.0.128", "subnet boundary"),
+        ("10.1.0.0/16", 24, "10.1.9.0", "10.1.8.0", "above the subnet maximum"),
+        ("10.1.0.0/16", 24, "ten", "", "not an address"),
+        ("fd00::/64", 0, "", "", "IPv4 cidr"),
+    ],
+)
+def test_capacity_invalid(cidr, subnet_len, subnet_min, subnet_max, message):
+    with pytest.raises(InvalidSubnets, match=message):
+        flannel_subnets.capacity(cidr, subnet_len, subnet_min, subnet_max)
+
+
+def test_subnet_config():
+    # defaults are left to flannel, so its network config doesn't change
+    assert flannel_subnets.subnet_config("10.1.0.0/16") == {}
+    assert flannel_subnets.subnet_config("10.1.0.0/16", 26, "10.1.0.0") == {
+        "SubnetLen": 26,
+        "SubnetMin": "10.1.0.0",
+    }
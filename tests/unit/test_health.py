@@ -0,0 +1,67 @@
+from subprocess import CompletedProcess
+
+from charms.layer import health
+
+
+def test_service_states_single_call(mocker):
+    run = mocker.patch.object(health, "run")
+    run.return_value = CompletedProcess([], 3, stdout="active\ninactive\n")
+
+    states = health.service_states(["flannel", "calico-node", "extra"])
+
+    assert states == {
+        "flannel": "active",
+        "calico-node": "inactive",
+        "extra": "unknown",
+    }
+    run.assert_called_once()
+    assert run.call_args[0][0] == [
+        "systemctl",
+        "is-active",
+        "flannel",
+        "calico-node",
+        "extra",
+    ]
+
+
+def test_probe_is_cached(mocker):
+    states = mocker.patch.object(health, "service_states")
+    states.return_value = {"flannel": "active", "calico-node": "failed"}
+    mocker.patch.object(health, "felix_ready", return_value=False)
+    mocker.patch.object(health, "flannel_ready", return_value=True)
+    now = mocker.patch.object(health.time, "monotonic", return_value=1000.0)
+    health._cache.clear()
+
+    probe = health.probe()
+    assert probe == health.Health(["calico-node"], False, True)
+    assert health.probe() is probe
+    now.return_value = 1000.0 + health.CACHE_TTL
+    health.probe()
+    assert states.call_count == 2
+
+
+def test_main(mocker, capsys):
+    probe = mocker.patch.object(health, "probe")
+    probe.return_value = health.Health([], True, True)
+    assert health.main() == 0
+
+    probe.return_value = health.Health(["flannel"], False, False)
+    assert health.main() == 2
+    assert capsys.readouterr().out.splitlines()[-1] == (
+        "CRITICAL: not running: flannel; Felix not ready; flannel.1 missing"
+    )
+
+
+def test_main_without_flannel_interface(mocker, tmp_path, capsys):
+    states = mocker.patch.object(health, "service_states")
+    states.return_value = {"flannel": "active", "calico-node": "active"}
+    mocker.patch.object(health, "felix_ready", return_value=True)
+    mocker.patch.object(health, "FLANNEL_SUBNET_ENV", str(tmp_path / "subnet.env"))
+    health._cache.clear()
+
+    assert health.main(["none"]) == 2
+    assert capsys.readouterr().out.strip() == "CRITICAL: flannel lease missing"
+
+    (tmp_path / "subnet.env").write_text("FLANNEL_SUBNET=10.1.5.1/24\n")
+    health._cache.clear()
+    assert health.main(["none"]) == 0
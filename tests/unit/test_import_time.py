@@ -0,0 +1,117 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# modules that only some handlers need, which must not be paid for at import;
+# threading isn't one, as subprocess imports it
+DEFERRED_MODULES = [
+    "conctl",
+    "gzip",
+    "http.client",
+    "inspect",
+    "ssl",
+    "tarfile",
+    "tempfile",
+    "urllib.request",
+    "uuid",
+    "yaml",
+]
+# a cold import of the reactive modules is timed against a cold import of
+# these, so the budget holds on faster and slower machines alike
+REFERENCE_MODULES = "argparse, decimal, email.message, logging"
+# the reactive modules took this many times as long as the reference when
+# their imports were last trimmed; fail if that doubles
+IMPORT_BASELINE = 1.5
+IMPORT_BUDGET = 2 * IMPORT_BASELINE
+RUNS = 3
+
+MARKER = "-- timed imports start here"
+
+# stand in for the framework with stubs that import nothing, so the only
+# modules imported after the marker are the ones the charm itself pulls in
+STUBS = """
+import json, sys, types
+
+def _stub(*args, **kwargs):
+    # decorators return what they decorate; anything else gets a stub back
+    if len(args) == 1 and callable(args[0]) and not kwargs:
+        return args[0]
+    return _stub
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__getattr__ = lambda attr: _stub
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+
+import charms.layer
+for name in [
+    "charms.reactive",
+    "charms.reactive.flags",
+    "charms.reactive.helpers",
+    "charms.leadership",
+    "charms.layer.status",
+    "charmhelpers",
+    "charmhelpers.core",
+    "charmhelpers.core.hookenv",
+    "charmhelpers.core.host",
+    "charmhelpers.core.templating",
+    "charmhelpers.core.unitdata",
+]:
+    _module(name)
+_module("charms.reactive.bus", Handler=type("Handler", (), {"invoke": _stub}))
+print(json.dumps(sorted(sys.modules)))
+sys.stderr.write("%s\\n")
+sys.stderr.flush()
+""" % MARKER
+
+
+def _cold_import(code):
+    """Run code in a fresh interpreter, timing the imports after MARKER.
+
+    Returns: Tuple of the modules loaded before MARKER, and a dict of each
+        module imported after it to the microseconds its own import took
+    """
+    src = Path(__file__).parents[2] / "src"
+    env = dict(os.environ, PYTHONPATH="{}:{}".format(src, src / "lib"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    preloaded = json.loads(result.stdout or "[]")
+    times = {}
+    for line in result.stderr.split(MARKER + "\n", 1)[1].splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and "[us]" not in line:
+            self_us, _, name = line.split(":", 1)[1].split("|")
+            times[name.strip()] = int(self_us)
+    return preloaded, times
+
+
+def test_reactive_imports_are_cheap():
+    charm, reference = [], []
+    for _ in range(RUNS):
+        preloaded, imported = _cold_import(
+            STUBS + "import reactive.calico, reactive.canal, reactive.flannel"
+        )
+        charm.append(sum(imported.values()))
+        _, imported_reference = _cold_import(
+            "import sys\nsys.stderr.write(%r)\nsys.stderr.flush()\nimport %s"
+            % (MARKER + "\n", REFERENCE_MODULES)
+        )
+        reference.append(sum(imported_reference.values()))
+
+    # nothing deferred is loaded before the timed imports, so none go unchecked
+    assert not set(DEFERRED_MODULES) & set(preloaded)
+    assert "reactive.calico" in imported
+    assert not set(DEFERRED_MODULES) & set(imported)
+    assert min(charm) / min(reference) < IMPORT_BUDGET
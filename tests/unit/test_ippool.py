@@ -0,0 +1,71 @@
+import json
+from base64 import b64decode
+from unittest.mock import MagicMock
+
+import pytest
+
+from charms.layer import ippool
+from charms.layer.etcdv3 import EtcdError, KeyValue
+
+
+def make_pool(name, cidr, **spec):
+    spec = dict({"cidr": cidr, "ipipMode": "Never", "natOutgoing": True}, **spec)
+    return {
+        "apiVersion": "projectcalico.org/v3",
+        "kind": "IPPool",
+        "metadata": {"name": name},
+        "spec": spec,
+    }
+
+
+def make_client(*pools):
+    client = MagicMock()
+    client.get_prefix.return_value = [
+        KeyValue(ippool.IPPOOL_PREFIX + pool["metadata"]["name"], json.dumps(pool), i)
+        for i, pool in enumerate(pools, 1)
+    ]
+    client.txn.return_value = True
+    return client
+
+
+def test_reconcile_noop():
+    # calico filling in defaults we don't manage is not a difference
+    live = make_pool("default", "10.1.0.0/16", blockSize=26)
+    client = make_client(live)
+
+    changes = ippool.reconcile(client, [make_pool("default", "10.1.0.0/16")])
+
+    assert changes == ippool.Plan([], [], [])
+    client.txn.assert_not_called()
+    client.put.assert_not_called()
+
+
+def test_reconcile_minimal_changes():
+    client = make_client(
+        make_pool("default", "10.1.0.0/16", blockSize=26),
+        make_pool("stale", "10.2.0.0/16"),
+    )
+
+    changes = ippool.reconcile(
+        client,
+        [make_pool("default", "10.3.0.0/16"), make_pool("extra", "10.4.0.0/16")],
+    )
+
+    assert changes == ippool.Plan(["extra"], ["default"], ["stale"])
+    (compare, ops), _ = client.txn.call_args
+    assert len(compare) == len(ops) == 3
+    updated = json.loads(b64decode(ops[1]["request_put"]["value"]))
+    assert updated["spec"] == {
+        "cidr": "10.3.0.0/16",
+        "ipipMode": "Never",
+        "natOutgoing": True,
+        "blockSize": 26,
+    }
+
+
+def test_reconcile_conflict():
+    client = make_client(make_pool("stale", "10.2.0.0/16"))
+    client.txn.return_value = False
+
+    with pytest.raises(EtcdError):
+        ippool.reconcile(client, [make_pool("default", "10.1.0.0/16")])
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from charms.layer import kube_controllers
+from charms.layer.kube_controllers import InvalidConfig
+
+CONFIG = Path(__file__).parents[2] / "src" / "config.yaml"
+DEFAULTS = {
+    option: spec["default"]
+    for option, spec in yaml.safe_load(CONFIG.read_text())["options"].items()
+}
+
+
+def test_deployment_config_defaults():
+    assert kube_controllers.deployment_config(DEFAULTS) == {
+        "enabled_controllers": "policy,namespace,serviceaccount,workloadendpoint,node",
+        "reconciler_period": "5m",
+        "resources": {},
+        "node_selector": {},
+        "priority_class": "system-cluster-critical",
+    }
+
+
+def test_deployment_config():
+    config = dict(
+        DEFAULTS,
+        **{
+            "kube-controllers-enabled": "policy, node",
+            "kube-controllers-reconciler-period": "1m30s",
+            "kube-controllers-cpu-request": "100m",
+            "kube-controllers-memory-limit": "512Mi",
+            "kube-controllers-node-selector": (
+                "node-role.kubernetes.io/control-plane= zone=a"
+            ),
+            "kube-controllers-priority-class": "",
+        }
+    )
+    assert kube_controllers.deployment_config(config) == {
+        "enabled_controllers": "policy,node",
+        "reconciler_period": "1m30s",
+        "resources": {"requests": {"cpu": "100m"}, "limits": {"memory": "512Mi"}},
+        "node_selector": {"node-role.kubernetes.io/control-plane": "", "zone": "a"},
+        "priority_class": "",
+    }
+
+
+def test_deployment_config_kubernetes_datastore():
+    config = dict(DEFAULTS, **{"calico-datastore": "kubernetes"})
+    assert kube_controllers.deployment_config(config)["enabled_controllers"] == "node"
+
+    config["kube-controllers-enabled"] = "policy,namespace"
+    with pytest.raises(InvalidConfig, match="only runs the node controller"):
+        kube_controllers.deployment_config(config)
+
+
+@pytest.mark.parametrize(
+    "option, value, message",
+    [
+        ("kube-controllers-enabled", "", "at least one controller"),
+        ("kube-controllers-enabled", "policy,ipam", "unknown controller ipam"),
+        ("kube-controllers-reconciler-period", "5", "must be a duration"),
+        ("kube-controllers-cpu-limit", "half", "must be a Kubernetes quantity"),
+        ("kube-controllers-memory-request", "1GB", "must be a Kubernetes quantity"),
+        ("kube-controllers-node-selector", "zone", "not a key=value node label"),
+        ("kube-controllers-node-selector", "zone=a b", "not a key=value node label"),
+        ("kube-controllers-priority-class", "High", "not a priority class name"),
+    ],
+)
+def test_deployment_config_invalid(option, value, message):
+    with pytest.raises(InvalidConfig, match=message):
+        kube_controllers.deployment_config(dict(DEFAULTS, **{option: value}))
@@ -0,0 +1,135 @@
+import io
+import tarfile
+
+import pytest
+
+from charms.layer import canal
+
+
+@pytest.fixture
+def kv(mocker):
+    store = {}
+    kv = mocker.patch.object(canal.unitdata, "kv").return_value
+    kv.get.side_effect = store.get
+    kv.set.side_effect = store.__setitem__
+    kv.unset.side_effect = lambda key: store.pop(key, None)
+    return store
+
+
+def make_archive(path, members):
+    with tarfile.open(path, "w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def test_unpack_binaries_skips_unchanged(tmp_path):
+    archive = make_archive(tmp_path / "r.tar.gz", {"./bin": b"bin", "./other": b"x"})
+    binaries = {"bin": str(tmp_path / "out" / "bin")}
+
+    cached = canal.unpack_binaries(archive, binaries)
+    assert (tmp_path / "out" / "bin").read_bytes() == b"bin"
+    assert not (tmp_path / "out" / "other").exists()
+    assert canal.unpack_binaries(archive, binaries, cached) is None
+
+    # a tampered binary is reinstalled even though the resource is unchanged
+    (tmp_path / "out" / "bin").write_bytes(b"tampered")
+    assert canal.unpack_binaries(archive, binaries, cached) == cached
+    assert (tmp_path / "out" / "bin").read_bytes() == b"bin"
+
+
+def test_unpack_binaries_missing_member(tmp_path):
+    archive = make_archive(tmp_path / "r.tar.gz", {"bin": b"bin"})
+    binaries = {"bin": str(tmp_path / "bin"), "gone": str(tmp_path / "gone")}
+
+    with pytest.raises(canal.ResourceError):
+        canal.unpack_binaries(archive, binaries)
+    assert list(tmp_path.iterdir()) == [tmp_path / "r.tar.gz"]
+
+
+def test_fetch_binaries(tmp_path, mocker):
+    resource_get = mocker.patch.object(canal.hookenv, "resource_get")
+    archive = make_archive(tmp_path / "r.tar.gz", {"bin": b"bin"})
+    binaries = {"bin": str(tmp_path / "out" / "bin")}
+
+    resource_get.return_value = archive
+    cached = canal.fetch_binaries("flannel-arm64", "flannel", binaries)
+    resource_get.assert_called_once_with("flannel-arm64")
+    assert cached == canal.unpack_binaries(archive, binaries)
+    assert canal.fetch_binaries("flannel-arm64", "flannel", binaries, cached) is None
+
+    # the errors carry the status message, and what went wrong as their cause
+    resource_get.side_effect = OSError("no resource-get")
+    with pytest.raises(canal.ResourceError, match="Error fetching the flannel"):
+        canal.fetch_binaries("flannel", "flannel", binaries)
+    resource_get.side_effect = None
+    resource_get.return_value = False
+    with pytest.raises(canal.ResourceError, match="^Missing flannel resource.$"):
+        canal.fetch_binaries("flannel", "flannel", binaries)
+    resource_get.return_value = make_archive(tmp_path / "empty.tar.gz", {})
+    with pytest.raises(canal.ResourceError, match="^Incomplete flannel") as excinfo:
+        canal.fetch_binaries("flannel", "flannel", binaries)
+    assert "is missing bin" in str(excinfo.value.__cause__)
+
+
+def test_retry_defers_with_backoff(kv, mocker):
+    now = mocker.patch.object(canal.time, "time", return_value=1000.0)
+    sleep = mocker.patch.object(canal.time, "sleep")
+    mocker.patch.object(canal.random, "uniform", return_value=0)
+    outcomes = [False, False, True]
+
+    @canal.retry(attempts=5, base_delay=10, max_delay=60, deadline=600)
+    def flaky():
+        return outcomes.pop(0)
+
+    assert not flaky()
+    # too early; handed back without another attempt
+    now.return_value = 1005.0
+    assert not flaky()
+    assert outcomes == [False, True]
+
+    now.return_value = 1010.0
+    assert not flaky()
+    # the second delay has doubled
+    now.return_value = 1029.0
+    assert not flaky()
+    now.return_value = 1030.0
+    assert flaky()
+    sleep.assert_not_called()
+    assert kv == {}
+
+
+def test_retry_inline_gives_up_at_deadline(kv, mocker):
+    now = mocker.patch.object(canal.time, "time", return_value=0.0)
+    sleep = mocker.patch.object(canal.time, "sleep")
+    sleep.side_effect = lambda secs: setattr(now, "return_value", now() + secs)
+    mocker.patch.object(canal.random, "uniform", return_value=0)
+    calls = []
+
+    @canal.retry(attempts=10, base_delay=10, max_delay=60, deadline=50, defer=False)
+    def broken():
+        calls.append(now())
+        return False
+
+    assert not broken()
+    assert calls == [0, 10, 30, 50]
+    assert kv == {}
+
+
+def test_render_if_changed(tmp_path, mocker):
+    render = mocker.patch("charmhelpers.core.templating.render")
+    render.return_value = "content\n"
+    target = tmp_path / "etc" / "service"
+
+    assert canal.render_if_changed("service", str(target), {})
+    assert target.read_text() == "content\n"
+    assert target.stat().st_mode & 0o777 == 0o444
+    assert not canal.render_if_changed("service", str(target), {})
+
+    render.return_value = "changed\n"
+    assert canal.render_if_changed("service", str(target), {})
+    assert target.read_text() == "changed\n"
+    # only the target is left behind, not the file it was staged in
+    assert [p.name for p in target.parent.iterdir()] == ["service"]
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from charms.layer import pipeline
+
+
+@pytest.fixture(autouse=True)
+def steps(mocker):
+    mocker.patch.object(pipeline, "_steps", [])
+    mocker.patch.object(pipeline, "_attempted", set())
+    mocker.patch.object(pipeline, "status")
+    return mocker.patch.object(pipeline, "is_flag_set", return_value=False)
+
+
+def test_steps_run_concurrently():
+    # each work waits for the other, so this only passes if they overlap
+    barrier = threading.Barrier(2, timeout=5)
+    finished = []
+
+    def prepare(result):
+        return lambda: (barrier.wait(), result)[1]
+
+    def finish(fetched):
+        finished.append(fetched())
+
+    pipeline.add_step("a", "a.done", lambda: prepare("a"), finish)
+    pipeline.add_step("b", "b.done", lambda: prepare("b"), finish)
+    durations = pipeline.run()
+    assert finished == ["a", "b"]
+    assert set(durations) == {"a", "b"}
+    pipeline.status.maintenance.assert_called_once_with("Preparing a, b")
+
+
+def test_steps_skipped(steps, mocker):
+    done = mocker.Mock()
+    waiting = mocker.Mock(return_value=None)
+    pipeline.add_step("done", "done.flag", done, done)
+    pipeline.add_step("waiting", "waiting.flag", waiting, done)
+    steps.side_effect = lambda flag: flag == "done.flag"
+    assert pipeline.run() == {}
+    done.assert_not_called()
+    waiting.assert_called_once_with()
+    pipeline.status.maintenance.assert_not_called()
+
+
+def test_add_step_replaces():
+    pipeline.add_step("a", "a.done", None, None)
+    pipeline.add_step("b", "b.done", None, None)
+    pipeline.add_step("a", "a.ready", None, None)
+    assert [(step.name, step.flag) for step in pipeline._steps] == [
+        ("b", "b.done"),
+        ("a", "a.ready"),
+    ]
+
+
+def test_failure_finishes_the_rest(mocker):
+    finished = mocker.Mock()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    pipeline.add_step("a", "a.done", lambda: fail, lambda fetched: fetched())
+    pipeline.add_step("b", "b.done", lambda: lambda: "b", finished)
+    with pytest.raises(RuntimeError, match="boom"):
+        pipeline.run()
+    assert finished.call_args[0][0]() == "b"
+
+
+def test_steps_tried_once(mocker):
+    work = mocker.Mock(side_effect=RuntimeError("boom"))
+    prepare = mocker.Mock(return_value=None)
+    pipeline.add_step("a", "a.done", prepare, lambda fetched: fetched())
+
+    # a step that can't run yet is prepared again
+    pipeline.run()
+    prepare.return_value = work
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+
+    # but once its work ran, another handler in the same hook doesn't retry it
+    assert pipeline.run() == {}
+    assert prepare.call_count == 2
+    work.assert_called_once_with()
+
+    pipeline._attempted.clear()
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+    assert work.call_count == 2
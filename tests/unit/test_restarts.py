@@ -0,0 +1,81 @@
+import pytest
+
+from charms.layer import restarts
+
+
+@pytest.fixture(autouse=True)
+def queue(mocker):
+    mocker.patch.dict(
+        restarts._pending, {"daemon-reload": False, "services": set(), "requests": 0}
+    )
+    mocker.patch.object(restarts, "_callbacks", [])
+    mocker.patch.object(restarts, "_restarted", set())
+    mocker.patch.object(restarts, "_gate", None)
+    mocker.patch.dict(restarts.unitdata.kv(), clear=True)
+
+
+def test_restarts_coalesce(mocker):
+    atexit = mocker.patch.object(restarts.hookenv, "atexit")
+    calls = mocker.Mock()
+    mocker.patch.object(restarts, "check_call", calls.check_call)
+    mocker.patch.object(restarts, "service_restart", calls.service_restart)
+
+    restarts.restart("calico-node")
+    restarts.daemon_reload()
+    restarts.restart("flannel")
+    restarts.restart("calico-node")
+    restarts.daemon_reload()
+    restarts.after_restarts(calls.callback)
+    assert restarts.pending("flannel") and restarts.pending()
+    atexit.assert_called_once_with(restarts.flush)
+    calls.assert_not_called()
+
+    restarts.flush()
+    assert calls.mock_calls == [
+        mocker.call.check_call(["systemctl", "daemon-reload"]),
+        mocker.call.service_restart("flannel"),
+        mocker.call.service_restart("calico-node"),
+        mocker.call.callback(),
+    ]
+    assert restarts.unitdata.kv()[restarts.AVOIDED_KEY] == 2
+    assert not restarts.pending()
+    assert restarts.restarted("flannel") and restarts.restarted("calico-node")
+
+    # nothing left to do
+    calls.reset_mock()
+    restarts.flush()
+    calls.assert_not_called()
+
+
+def test_restart_unknown_service():
+    with pytest.raises(ValueError):
+        restarts.restart("kubelet")
+
+
+def test_held_restarts(mocker):
+    mocker.patch.object(restarts.hookenv, "atexit")
+    service_restart = mocker.patch.object(restarts, "service_restart")
+    gate = mocker.Mock(return_value=False)
+    restarts.set_gate(gate)
+
+    restarts.restart("calico-node")
+    restarts.restart("flannel")
+    restarts.flush()
+    gate.assert_called_once_with(["flannel", "calico-node"])
+    service_restart.assert_not_called()
+    assert not restarts.restarted("flannel")
+
+
+@pytest.mark.parametrize(
+    "waiting, granted, batch_size, expected",
+    [
+        (["canal/10", "canal/2", "canal/1"], [], 2, ["canal/1", "canal/2"]),
+        # a unit keeps its slot until it's healthy, however the queue looks
+        (["canal/1", "canal/3"], ["canal/3"], 1, ["canal/3"]),
+        # healthy units free their slots for the next ones
+        (["canal/3", "canal/4"], ["canal/1", "canal/2"], 2, ["canal/3", "canal/4"]),
+        ([], ["canal/1"], 1, []),
+    ],
+)
+def test_next_grants(waiting, granted, batch_size, expected):
+    assert restarts.next_grants(waiting, granted, batch_size) == expected
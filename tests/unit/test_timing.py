@@ -0,0 +1,130 @@
+import json
+import subprocess
+import sys
+import types
+
+import pytest
+
+from charms.layer import timing
+
+
+@pytest.fixture
+def timing_log(monkeypatch, tmp_path):
+    log_path = tmp_path / "timing.jsonl"
+    monkeypatch.setattr(timing, "enabled", lambda: True)
+    monkeypatch.setattr(timing, "LOG_PATH", str(log_path))
+    monkeypatch.setattr(timing.hookenv, "hook_name", lambda: "update-status")
+    return log_path
+
+
+class Handler:
+    """Enough of reactive's Handler to dispatch an action."""
+
+    def __init__(self, action, *args):
+        self._action = action
+        self._args = args
+
+    def invoke(self):
+        self._action(*self._args)
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    module = types.ModuleType("charms.reactive.bus")
+    module.Handler = type("Handler", (Handler,), {})
+    monkeypatch.setitem(sys.modules, "charms.reactive.bus", module)
+    timing.install()
+    # installing again doesn't time handlers twice
+    timing.install()
+    return module
+
+
+def test_handler_records_commands(timing_log, bus):
+    true = timing.command(subprocess.check_call)
+    run = timing.command(subprocess.run)
+
+    def configure(etcd):
+        true(["true"])
+        with pytest.raises(subprocess.CalledProcessError):
+            true(["false"])
+        run(["false"])
+
+    bus.Handler(configure, "etcd").invoke()
+
+    (record,) = [json.loads(line) for line in timing_log.read_text().splitlines()]
+    assert record["handler"].endswith(".configure")
+    assert [(c["command"], c["rc"]) for c in record["commands"]] == [
+        ("true", 0),
+        ("false", 1),
+        ("false", 1),
+    ]
+
+
+def test_handler_traceback(timing_log, bus):
+    def boom():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError) as excinfo:
+        bus.Handler(boom).invoke()
+    frame = excinfo.traceback[-1]
+    assert frame.name == "boom"
+    assert frame.statement.lines[0].strip() == 'raise RuntimeError("boom")'
+    assert len(timing_log.read_text().splitlines()) == 1
+
+
+def test_log_rotates(timing_log, bus, monkeypatch):
+    monkeypatch.setattr(timing, "MAX_BYTES", 10)
+
+    def noop():
+        pass
+
+    for _ in range(5):
+        bus.Handler(noop).invoke()
+    rotated = sorted(p.name for p in timing_log.parent.iterdir())
+    assert rotated == [
+        "timing.jsonl",
+        "timing.jsonl.1",
+        "timing.jsonl.2",
+        "timing.jsonl.3",
+    ]
+    assert len(list(timing.read_records())) == 4
+
+
+def test_summarize():
+    records = [
+        {"handler": "a", "duration": 1.0, "commands": []},
+        {
+            "handler": "b",
+            "duration": 3.0,
+            "commands": [{"command": "kubectl", "duration": 2.5, "rc": 1}],
+        },
+        {
+            "handler": "a",
+            "duration": 1.5,
+            "commands": [{"command": "kubectl", "duration": 0.5, "rc": 0}],
+            "steps": [{"step": "flannel binaries", "duration": 0.25}],
+        },
+    ]
+    summary = timing.summarize(records, count=1)
+    assert summary["handlers"] == [
+        {"name": "b", "count": 1, "total": 3.0, "mean": 3.0, "max": 3.0}
+    ]
+    assert summary["commands"] == [
+        {
+            "name": "kubectl",
+            "count": 2,
+            "total": 3.0,
+            "mean": 1.5,
+            "max": 2.5,
+            "failures": 1,
+        }
+    ]
+    assert summary["steps"] == [
+        {
+            "name": "flannel binaries",
+            "count": 1,
+            "total": 0.25,
+            "mean": 0.25,
+            "max": 0.25,
+        }
+    ]